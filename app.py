@@ -1,5 +1,5 @@
 import streamlit as st
-import psycopg2
+import db
 import os
 import json
 import datetime
@@ -8,11 +8,15 @@ import math
 import re
 import socket
 import threading
+import html
+from urllib.parse import quote, urlencode
 from http.server import HTTPServer, SimpleHTTPRequestHandler
-from image_server import start_image_server
+from image_server import start_image_server, IMAGE_RAW_FALLBACK
+from manifest import find_image
+from thumbnails import THUMB_SIZES
+from profiler import RunProfiler, CAPTURE_MODES
+from search import build_page_query, build_count_query, build_card_query, row_cursor, db_features, use_card_search, can_fan_out, fetch_page_fanout, SORT_OPTIONS, SEARCH_MODES, DEFAULT_SEARCH_MODE
 import extra_streamlit_components as stx
-import urllib.request
-import urllib.error
 import streamlit.components.v1 as components
 
 # Importieren der Konfiguration aus config.py
@@ -23,13 +27,28 @@ try:
     DB_CONFIG = config.DB_CONFIG
     # Optional config
     IMAGE_SERVER_BASE_URL = getattr(config, "IMAGE_SERVER_BASE_URL", None)
+    # Schnelle Trefferzahl: nur bis hierhin zählen, darüber "10.000+"
+    SEARCH_COUNT_CAP = getattr(config, "SEARCH_COUNT_CAP", 10000)
 except ImportError:
     st.error("Konfigurationsdatei 'config.py' nicht gefunden oder fehlerhaft. Bitte erstelle sie basierend auf dem Beispiel.")
     st.stop()
 
+# Vorschaubild im Grid (src ohne srcset): kleinste Breite, die die ~300px-Spalte füllt
+GRID_THUMB_SIZE = min((w for w in THUMB_SIZES if w >= 300), default=max(THUMB_SIZES))
+
 # --- SETUP & STYLES ---
 st.set_page_config(layout="wide", page_title="Char Archive Ultimate", page_icon="🗃️")
 
+# Zeiten dieses Reruns für das Debug-Panel (profiler.py). Endete der vorige
+# Lauf vor profiler.finish() (st.rerun, st.stop, Exception), läuft sein
+# Capture noch und wird hier gestoppt.
+previous_profiler = st.session_state.get("run_profiler")
+if previous_profiler is not None:
+    previous_profiler.stop_capture()
+profiler = st.session_state["run_profiler"] = RunProfiler()
+if st.session_state.pop("profile_next_run", False):
+    profiler.start_capture(st.session_state.get("profile_mode", CAPTURE_MODES[0]))
+
 # Handle Session State Initialization
 if "page" not in st.session_state:
     st.session_state.page = 0
@@ -49,7 +68,9 @@ DEFAULT_SETTINGS = {
     "selected_sources": ["chub", "risuai"],
     "selected_fields": ["tags"],
     "token_range": [0, 8000],
-    "unlimited": False
+    "unlimited": False,
+    "approx_count": True,
+    "search_mode": DEFAULT_SEARCH_MODE
 }
 
 # 1. Initialize session state with defaults (if not set)
@@ -94,9 +115,12 @@ if not st.session_state.get("cookies_initialized", False):
         else:
             st.session_state.cookies_initialized = True
             st.session_state["debug_sync_msg"] = f"No settings found after {elapsed:.1f}s wait."
+profiler.lap("cookie_sync")
 
 # Check Query Params for Tag Search (Click on Badge)
-if "q" in st.query_params:
+# Nur einmal pro Wert übernehmen, sonst setzt jeder Rerun die Seite zurück
+if "q" in st.query_params and st.session_state.get("applied_q") != st.query_params["q"]:
+    st.session_state.applied_q = st.query_params["q"]
     st.session_state.search_input = st.query_params["q"]
     st.session_state.page = 0
     st.session_state.p_jump = 1
@@ -270,7 +294,7 @@ st.markdown("""
     }
 
     /* Download Buttons Custom styling for integration */
-    .stDownloadButton > button {
+    .stDownloadButton > button, .stLinkButton > a {
         width: 100%;
         font-size: 0.8rem !important;
         margin-bottom: 6px !important;
@@ -485,72 +509,60 @@ def change_page(new_page):
     st.session_state.page = new_page
     st.session_state.p_jump = new_page + 1
 
-@st.cache_resource
-def get_db_connection():
-    """Hält die DB-Verbindung offen, damit es schneller geht"""
-    return psycopg2.connect(**DB_CONFIG)
-
 @st.cache_data(show_spinner=False, ttl=600)
 def run_query_cached(sql, params):
     """Führt die Query aus und cached das Ergebnis für 10 Minuten"""
-    conn = psycopg2.connect(**DB_CONFIG)
-    cur = conn.cursor()
-    cur.execute(sql, params)
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
-    return rows
+    # Verbindung kommt aus dem gemeinsamen Pool (db.py)
+    return db.fetch_all(sql, params)
 
-def get_image_path(image_hash, debug=False):
-    """Findet das Bild im Sharding-Dschungel (nun auch rekursiv)"""
-    if not image_hash: return None, []
-    
-    extensions = [".png", ".webp", ".jpg", ".jpeg", ""]
-    candidates = []
-    
-    # Paths to check
-    checks = []
-    
-    # 0. User Specific: Split Filename Sharding (hashed-data/a/b/c/defg...)
-    # Hash: 2b2b9b... -> Path: hashed-data/2/b/2/b9b...
-    if len(image_hash) > 3:
-        checks.append(os.path.join(IMAGE_ROOT, "hashed-data", image_hash[0], image_hash[1], image_hash[2], image_hash[3:]))
+@st.cache_data(show_spinner=False, ttl=600)
+def run_fanout_cached(selected_sources, selected_fields, search_query, token_range, unlimited_tokens,
+                      sort_option, limit, offset, after, mode):
+    """Wie run_query_cached, aber je Quelle parallel abgefragt (search.fetch_page_fanout)"""
+    return fetch_page_fanout(list(selected_sources), list(selected_fields), search_query, token_range, unlimited_tokens,
+                             sort_option, limit, offset=offset, after=after, mode=mode)
 
-    # 1. Nested Sharding (hashed-data/a/b/abcde...)
-    if len(image_hash) >= 2:
-        checks.append(os.path.join(IMAGE_ROOT, "hashed-data", image_hash[0], image_hash[1], image_hash))
+@st.cache_data(show_spinner=False, ttl=600)
+def count_matches_cached(selected_sources, selected_fields, search_query, token_range, unlimited_tokens, cap, mode):
+    """Trefferzahl, unabhängig von Sortierung und Seite gecached -> (anzahl, gekappt)"""
+    count_sql, params = build_count_query(selected_sources, selected_fields, search_query, token_range, unlimited_tokens, cap=cap, mode=mode)
+    if not count_sql:
+        return 0, False
+    total = db.fetch_all(count_sql, tuple(params))[0][0]
+    if cap and total > cap:
+        return cap, True
+    return total, False
 
-    # 2. Simple Sharding (hashed-data/a/abcde...)
-    if len(image_hash) >= 1:
-        checks.append(os.path.join(IMAGE_ROOT, "hashed-data", image_hash[0], image_hash))
-        
-    # 3. Flat (hashed-data/abcde...)
-    checks.append(os.path.join(IMAGE_ROOT, "hashed-data", image_hash))
-    
-    # Generate Candidate List (with Exts) for Debugging
-    for c in checks:
-        for ext in extensions:
-            candidates.append(c + ext)
-            
-    # Real Search
-    for path_base in checks:
-        # Check Direct File + Ext
-        for ext in extensions:
-            p = path_base + ext
-            if os.path.exists(p) and os.path.isfile(p):
-                return p, candidates
+@st.cache_data(show_spinner=False, ttl=600)
+def load_card_details(src, image_hash):
+    """Volle metadata/definition einer Karte für das Details-Panel -> (metadata, definition)"""
+    sql, params = build_card_query(src, image_hash)
+    rows = db.fetch_all(sql, params) if sql else []
+    if not rows:
+        return {}, {}
+    return rows[0][0] or {}, rows[0][1] or {}
+
+def mogrify_sql(sql, params):
+    """Setzt die Parameter ein (nur für die Debug-Anzeige)"""
+    with db.connection() as conn:
+        with conn.cursor() as cur:
+            return cur.mogrify(sql, params).decode('utf-8')
+
+def get_server_url():
+    """Basis-URL des Image Servers für Links im Browser"""
+    # PRIORITY 1: Configured Base URL
+    if IMAGE_SERVER_BASE_URL:
+        return IMAGE_SERVER_BASE_URL
+    # PRIORITY 2: Auto-detected URL from verify_server functionality
+    if img_server_url and not img_server_url.startswith("Error"):
+        return img_server_url
+    # PRIORITY 3: Fallback logic
+    return f"http://{socket.gethostname()}:{8505}"
 
-        # Check Directory (Deep Search) - Fallback
-        if os.path.exists(path_base) and os.path.isdir(path_base):
-            if debug: candidates.append(f"[DIR FOUND] {path_base} -> Scanning...")
-            for root, _, files in os.walk(path_base):
-                for f in files:
-                    if f.lower().endswith(tuple([".png", ".webp", ".jpg", ".jpeg"])):
-                        found = os.path.join(root, f)
-                        if debug: candidates.append(f"[DEEP MATCH] {found}")
-                        return found, candidates
-            
-    return None, candidates
+def get_image_path(image_hash, debug=False):
+    """Findet das Bild im Sharding-Dschungel (nun auch rekursiv)"""
+    # Manifest-Lookup, sonst alle Sharding-Layouts durchprobieren (manifest.find_image)
+    return find_image(image_hash, debug=debug)
 
 def get_safety_badges(metadata):
     """Extrahiert Safety-Badges aus Metadata"""
@@ -610,8 +622,8 @@ def format_tags(tags_data):
 def render_badges(tags_list):
     html_str = ""
     for t in tags_list: 
-        # Link to ?q=TAGNAME to trigger search on reload
-        html_str += f'<a href="?q={t}" target="_self" class="tag-badge">{t}</a>'
+        # Link to ?q=TAGNAME to trigger search on reload (exact tag match in the "Tags" field)
+        html_str += f'<a href="?q={quote(t)}" target="_self" class="tag-badge">{html.escape(t)}</a>'
     return html_str
 
 # --- HAUPTBEREICH ---
@@ -627,6 +639,7 @@ st.markdown("# 🗃️ Character Archive: Local Edition")
 # Init Session State for Pagination
 if 'page' not in st.session_state: st.session_state.page = 0
 if 'last_query' not in st.session_state: st.session_state.last_query = ""
+profiler.lap("setup")
 
 # Sidebar
 with st.sidebar:
@@ -686,13 +699,12 @@ with st.sidebar:
         key="selected_fields"
     )
     
-    st.selectbox("Sortierung", [
-        "Neueste zuerst", 
-        "Älteste zuerst", 
-        "Name (A-Z)", 
-        "Token Count (Viel)", 
-        "Token Count (Wenig)"
-    ], key="sort_option")
+    st.radio("Suchmodus", list(SEARCH_MODES), key="search_mode", horizontal=True,
+             help="Volltext: ganze Wörter in allen Feldern (Name, Tags, Beschreibung, Scenario, First Message, Creator Notes), "
+                  "\"Zitate\", OR und -Ausschluss möglich, sortierbar nach Relevanz.")
+
+    st.selectbox("Sortierung", list(SORT_OPTIONS), key="sort_option",
+                 help="Relevanz gilt nur im Volltext-Modus.")
 
     st.divider()
     st.write("📊 Token-Filter")
@@ -700,6 +712,8 @@ with st.sidebar:
     st.slider("Token-Bereich", 0, 16000, key="token_range_ui", step=100, 
               value=tuple(st.session_state.token_range))
     st.checkbox("Nach oben offen", key="unlimited")
+    st.checkbox("Schnelle Trefferzahl", key="approx_count",
+                help=f"Zählt höchstens {SEARCH_COUNT_CAP} Treffer (danach \"+\"), breite Suchen laden dadurch schneller.")
     
     # Sync the UI-only token range back to the main state
     st.session_state.token_range = list(st.session_state.token_range_ui)
@@ -725,11 +739,21 @@ with st.sidebar:
         st.write("Sync Waits:", st.session_state.get("sync_waits"))
         st.write("Current Session State:", {k: st.session_state.get(k) for k in DEFAULT_SETTINGS})
         st.write("Image Server Status:", img_server_url)
+        st.write("DB Pool:", db.get_pool().stats())
+        st.write("DB Features (migrate.py):", sorted(db_features()))
+        st.write("Suche über:", "card_search" if use_card_search() else "UNION ALL der Quelltabellen")
         st.write("Cookies Raw:", cookies)
     explain_mode = False
     if debug_mode:
         st.info(f"Root: `{IMAGE_ROOT}`")
         explain_mode = st.checkbox("Zeige Query Plan (EXPLAIN ANALYZE)", value=False)
+        st.selectbox("Profiler", CAPTURE_MODES, key="profile_mode")
+        if st.button("🔬 Nächsten Lauf profilieren", width="stretch"):
+            st.session_state.profile_next_run = True
+            st.rerun()
+        # Wird am Ende des Skripts gefüllt, wenn alle Zeiten feststehen
+        profile_slot = st.container()
+profiler.lap("sidebar")
 
 def get_json_field(path_list):
     """Helper für SQL JSON Access"""
@@ -745,49 +769,6 @@ def get_json_field(path_list):
         sql_frag += f"{arrow}'{key}'"
     return sql_frag
 
-def build_search_conditions(fields_to_search):
-    """Baut die WHERE Conditions basierend auf fields_to_search"""
-    if not fields_to_search: return "1=1"
-    
-    conditions = []
-    
-    # For Tags, we use Regex with boundaries (\y) by default for precision
-    tag_op = "~*"
-    tag_fmt = lambda col: f"{col} {tag_op} %s"
-    
-    # For other fields, we use standard ILIKE for flexibility
-    def_fmt = lambda col: f"{col} ILIKE %s"
-    
-    if "name" in fields_to_search:
-        conditions.append(def_fmt("name"))
-        
-    if "author" in fields_to_search:
-        conditions.append(def_fmt("author"))
-        
-    if "tags" in fields_to_search:
-        # Use Regex boundaries specifically for tags to avoid 'ntr' in 'country'
-        conditions.append(tag_fmt("metadata->>'tags'"))
-        conditions.append(tag_fmt("definition->>'tags'"))
-        conditions.append(tag_fmt("definition->'data'->>'tags'"))
-        
-    if "description" in fields_to_search:
-        conditions.append(def_fmt("definition->>'description'"))
-        conditions.append(def_fmt("definition->'data'->>'description'"))
-    
-    if "creator_notes" in fields_to_search:
-        conditions.append(def_fmt("definition->>'creator_notes'"))
-        conditions.append(def_fmt("definition->'data'->>'creator_notes'"))
-        
-    if "first_mes" in fields_to_search:
-        conditions.append(def_fmt("definition->>'first_message'"))
-        conditions.append(def_fmt("definition->'data'->>'first_message'"))
-        
-    if "scenario" in fields_to_search:
-        conditions.append(def_fmt("definition->>'scenario'"))
-        conditions.append(def_fmt("definition->'data'->>'scenario'"))
-        
-    return " OR ".join(conditions)
-
 def extract_card_data(definition):
     """Python-seitiges Parsen der JSON Definition"""
     data = {}
@@ -832,172 +813,60 @@ if st.session_state.get('search_input') and st.session_state.selected_sources an
     unlimited_tokens = st.session_state.unlimited
     
     search_query = st.session_state.search_input
-    conn = get_db_connection()
-    cur = conn.cursor()
+    search_mode = SEARCH_MODES.get(st.session_state.search_mode, "ilike")
     
-    sql_parts = []
-    params = []
-    
-    where_clause = build_search_conditions(st.session_state.selected_fields)
-    
-    # We need to wrap TAG and NON-TAG params differently
-    tag_param = f"\\y{search_query}\\y"
-    def_param = f"%{search_query}%"
-    
-    # Identify which field each %s belongs to
-    chub_params = []
-    if "name" in selected_fields: chub_params.append(def_param)
-    if "author" in selected_fields: chub_params.append(def_param)
-    if "tags" in selected_fields: 
-        chub_params.extend([tag_param] * 3) # metadata, definition, data->tags
-    if "description" in selected_fields: chub_params.extend([def_param] * 2)
-    if "creator_notes" in selected_fields: chub_params.extend([def_param] * 2)
-    if "first_mes" in selected_fields: chub_params.extend([def_param] * 2)
-    if "scenario" in selected_fields: chub_params.extend([def_param] * 2)
-
-    # Standard Fields + Full Definition
-    # 1. Name, 2. Image, 3. Source, 4. Metadata, 5. Added, 6. Author, 7. Tagline, 8. Definition, 9. tokens_count
-    
-    # helper for tokens_count expression
-    tokens_expr = "COALESCE((metadata->>'totalTokens')::int, (metadata->>'total_token_count')::int, (definition->'data'->>'total_token_count')::int, 0)"
-    base_select = f"SELECT name, image_hash, '{{src}}', metadata, added, author, {{tagline_expr}}, definition, {tokens_expr} as tokens_count FROM {{table}}"
-
-    # 1. CHUB
-    if "chub" in st.session_state.selected_sources:
-        q = base_select.format(src="chub", tagline_expr="NULL", table="chub_character_def")
-        q += f" WHERE {where_clause}"
-        sql_parts.append(q)
-        params.extend(chub_params)
-
-    # 2. RISU
-    if "risuai" in st.session_state.selected_sources:
-        q = base_select.format(src="risuai", tagline_expr="NULL", table="risuai_character_def")
-        q += f" WHERE {where_clause}"
-        sql_parts.append(q)
-        params.extend(chub_params)
-
-    # 3. TAVERN
-    if "char_tavern" in st.session_state.selected_sources:
-        q = base_select.format(src="tavern", tagline_expr="NULL", table="char_tavern_character_def")
-        q += f" WHERE {where_clause}"
-        sql_parts.append(q)
-        params.extend(chub_params)
-
-    # 4. GENERIC
-    if "generic" in st.session_state.selected_sources:
-        q = base_select.format(src="generic", tagline_expr="tagline", table="generic_character_def")
-        q += f" WHERE {where_clause}"
-        sql_parts.append(q)
-        params.extend(chub_params)
-    
-    # 5. LOREBOOKS
-    if "chub_lorebook" in st.session_state.selected_sources:
-        q = base_select.format(src="lorebook", tagline_expr="NULL", table="chub_lorebook_def")
-        q += f" WHERE {where_clause}"
-        sql_parts.append(q)
-        params.extend(chub_params)
-
-    # 6. BOORU
-    if "booru" in st.session_state.selected_sources:
-        booru_conds = []
-        # Booru uses Regex boundaries for Tags by default
-        if "name" in st.session_state.selected_fields: booru_conds.append("name ILIKE %s")
-        if "author" in st.session_state.selected_fields: booru_conds.append("author ILIKE %s")
-        if "description" in st.session_state.selected_fields: booru_conds.append("summary ILIKE %s")
-        if "tags" in st.session_state.selected_fields: booru_conds.append("array_to_string(tags, ',') ~* %s")
-        
-        if not booru_conds: booru_str = "FALSE"
-        else: booru_str = " OR ".join(booru_conds)
-        
-        # Build Booru Params
-        booru_params = []
-        if "name" in st.session_state.selected_fields: booru_params.append(def_param)
-        if "author" in st.session_state.selected_fields: booru_params.append(def_param)
-        if "description" in st.session_state.selected_fields: booru_params.append(def_param)
-        if "tags" in st.session_state.selected_fields: booru_params.append(tag_param)
-        
-        sql_parts.append(f"""
-            SELECT name, image_hash, 'booru', jsonb_build_object('tags', tags, 'totalTokens', 0), added, author, tagline, 
-            jsonb_build_object('description', summary) as definition, 0 as tokens_count
-            FROM booru_character_def 
-            WHERE {booru_str}
-        """)
-        params.extend(booru_params)
-
-    # 7. NYAIME
-    if "nyaime" in st.session_state.selected_sources:
-        q = base_select.format(src="nyaime", tagline_expr="NULL", table="nyaime_character_def")
-        q += f" WHERE {where_clause}"
-        sql_parts.append(q)
-        params.extend(chub_params)
-
-    # 8. WEBRING
-    if "webring" in selected_sources:
-        q = base_select.format(src="webring", tagline_expr="tagline", table="webring_character_def")
-        q += f" WHERE {where_clause}"
-        sql_parts.append(q)
-        params.extend(chub_params)
+    # --- SQL (search.py) ---
+    # Keyset-Paginierung: Cursor der letzten Zeile jeder besuchten Seite merken.
+    # Ändert sich die Suche, sind alle Cursor ungültig.
+    query_sig = (tuple(selected_sources), tuple(selected_fields), search_query, tuple(token_range), unlimited_tokens, sort_option, limit, search_mode)
+    if st.session_state.get("cursor_sig") != query_sig:
+        st.session_state.cursor_sig = query_sig
+        st.session_state.page_cursors = {}
+    page_cursors = st.session_state.page_cursors
+    # Ohne Cursor (erste Seite oder Sprung per Seitenzahl) wird OFFSET genutzt
+    after = page_cursors.get(st.session_state.page) if st.session_state.page > 0 else None
+    # Eine Zeile mehr holen: so wissen wir ohne Gesamtzahl, ob es eine nächste Seite gibt
+    with profiler.phase("sql_build"):
+        full_sql, params = build_page_query(
+            selected_sources, selected_fields, search_query, token_range, unlimited_tokens,
+            sort_option, limit + 1, offset=st.session_state.page * limit, after=after, mode=search_mode
+        )
 
     # --- EXECUTE ---
-    if sql_parts:
-        # Wrap everything in a subquery so we can use complex ORDER BY and WHERE with UNION
-        combined_sql = " UNION ALL ".join(sql_parts)
-        
-        # Determine Token Range Filter
-        min_tokens, max_tokens = token_range
-        if not unlimited_tokens:
-            range_cond = f"WHERE tokens_count BETWEEN {min_tokens} AND {max_tokens}"
-        else:
-            range_cond = f"WHERE tokens_count >= {min_tokens}"
-
-        # Prepare full results query with total count
-        full_count_sql = f"SELECT *, COUNT(*) OVER() as full_count FROM ({combined_sql}) AS search_results {range_cond}"
-        full_sql = full_count_sql
-        
-        # Sortierung
-        s_opt = st.session_state.sort_option
-        if s_opt == "Neueste zuerst": full_sql += " ORDER BY added DESC NULLS LAST"
-        elif s_opt == "Älteste zuerst": full_sql += " ORDER BY added ASC NULLS LAST"
-        elif s_opt == "Token Count (Viel)": 
-            # Nutze tokens_count column
-            full_sql += " ORDER BY tokens_count DESC"
-        elif s_opt == "Token Count (Wenig)": 
-            # Unbekannte (0) ans Ende
-            full_sql += " ORDER BY CASE WHEN tokens_count = 0 THEN 9999999 ELSE tokens_count END ASC"
-        else: full_sql += " ORDER BY name ASC"
-        
-        # Pagination Calculation
-        offset = st.session_state.page * st.session_state.limit
-        
-        full_sql += f" LIMIT {st.session_state.limit} OFFSET {offset}"
-        
+    if full_sql:
         try:
             # DEBUG: EXPLAIN MODE
             if debug_mode:
                 # Show raw SQL
                 st.caption("🛠️ Generated SQL:")
-                st.code(cur.mogrify(full_sql, tuple(params)).decode('utf-8'), language="sql")
+                if can_fan_out(selected_sources, sort_option, search_mode):
+                    st.caption("Ausführung: je Quelle parallel (gleiche Bedingungen), Merge in Python")
+                st.code(mogrify_sql(full_sql, tuple(params)), language="sql")
                 
             if explain_mode:
                 explain_sql = "EXPLAIN ANALYZE " + full_sql
                 with st.expander("🔍 Database Query Plan", expanded=True):
                     try:
-                        cur.execute(explain_sql, tuple(params))
-                        plan = cur.fetchall()
+                        plan = db.fetch_all(explain_sql, tuple(params))
                         plan_str = "\n".join([row[0] for row in plan])
                         st.code(plan_str, language="sql")
                     except Exception as ex:
                         st.error(f"Explain fehlgeschlagen: {ex}")
 
             with st.spinner(f"Lade Seite {st.session_state.page + 1}..."):
-                start_time = time.time()
                 # Nutze cached query um Doppel-Runs bei Download zu vermeiden
-                rows = run_query_cached(full_sql, tuple(params))
-                end_time = time.time()
-                
-                # Spinner ends
-                total_matches = rows[0][-1] if rows else 0
-                total_pages = math.ceil(total_matches / limit) if total_matches > 0 else 1
+                with profiler.phase("query"):
+                    if can_fan_out(selected_sources, sort_option, search_mode):
+                        rows = run_fanout_cached(
+                            tuple(selected_sources), tuple(selected_fields), search_query, tuple(token_range), unlimited_tokens,
+                            sort_option, limit + 1, st.session_state.page * limit, after, search_mode
+                        )
+                    else:
+                        rows = run_query_cached(full_sql, tuple(params))
+                has_next = len(rows) > limit
+                rows = rows[:limit]
+                if rows:
+                    page_cursors[st.session_state.page + 1] = row_cursor(rows[-1])
             
             # Mark this position as scroll target for page changes
             # We use a simple JS injection to force scroll to top
@@ -1039,32 +908,26 @@ if st.session_state.get('search_input') and st.session_state.selected_sources an
                         
                     with grid_cols[j]:
                         row = rows[idx]
-                        name, img_hash, src, metadata, added, author, tagline, definition, tokens_count, full_count = row
+                        (name, img_hash, src, added, author, tagline, tokens_count,
+                         creator_notes, description, tags_raw, badge_meta, has_definition, sort_cursor) = row
+                        profiler.start_card(img_hash, src)
                         
                         # --- DATA PREP ---
-                        real_path, checked_paths = get_image_path(img_hash, debug=debug_mode)
-                        card_data = extract_card_data(definition) if definition else {}
+                        # Nur die Anzeige-Felder kommen aus der Liste (search.display_columns),
+                        # metadata/definition lädt erst das Details-Panel (load_card_details)
+                        with profiler.phase("image_path"):
+                            real_path, checked_paths = get_image_path(img_hash, debug=debug_mode)
                         
-                        summary_text = card_data.get('creator_notes') or tagline or ""
-                        if not summary_text and card_data.get('description'):
-                            desc = card_data['description'].split('\n')[0]
-                            summary_text = desc[:200] + "..." if len(desc) > 200 else desc
+                        summary_text = creator_notes or tagline or ""
+                        if not summary_text and description:
+                            summary_text = description[:200] + "..." if len(description) > 200 else description
 
                         # CLASSIC SPLIT: Image/Buttons Left (C1), Info/Tags Right (C2)
                         c1, c2 = st.columns([2, 4.5])
                         
                         with c1:
                             # 1. URL Resolution
-                            # 1. URL Resolution
-                            # PRIORITY 1: Configured Base URL
-                            if IMAGE_SERVER_BASE_URL:
-                                srv_url = IMAGE_SERVER_BASE_URL
-                            # PRIORITY 2: Auto-detected URL from verify_server functionality
-                            elif img_server_url and not img_server_url.startswith("Error"):
-                                srv_url = img_server_url
-                            # PRIORITY 3: Fallback logic
-                            else:
-                                srv_url = f"http://{socket.gethostname()}:{8505}"
+                            srv_url = get_server_url()
                             direct_url = None
                             
                             if real_path:
@@ -1076,9 +939,13 @@ if st.session_state.get('search_input') and st.session_state.selected_sources an
                             
                             # 2. Render Image with Overlay
                             if direct_url:
-                                badges = get_safety_badges(metadata)
+                                badges = get_safety_badges(badge_meta)
                                 
-                                img_html = f'<div class="image-wrapper"><img src="{direct_url}" />'
+                                # Grid shows thumbnails (/thumb), the full card only behind PNG/SillyTavern
+                                thumb_url = f"{srv_url}/thumb/{{}}/{img_hash}"
+                                srcset = ", ".join(f"{thumb_url.format(w)} {w}w" for w in THUMB_SIZES)
+                                img_html = (f'<div class="image-wrapper"><img src="{thumb_url.format(GRID_THUMB_SIZE)}" srcset="{srcset}" '
+                                            f'sizes="(max-width: 640px) 40vw, 300px" loading="lazy" decoding="async" alt="" />')
                                 
                                 if badges:
                                     badge_html = ""
@@ -1096,24 +963,15 @@ if st.session_state.get('search_input') and st.session_state.selected_sources an
                                 st.markdown(f"🖼️ *Bild fehlt*\n\n`{img_hash[:6]}`")
                             
                             # Row 1: Downloads
+                            # Nur Links: PNG/JSON erzeugt der Image Server erst beim Klick (/card/<hash>.png|json)
                             b1, b2 = st.columns(2, gap="small")
-                            if real_path and direct_url:
-                                # Fetch from server to get embedded metadata
-                                file_data = None
-                                try:
-                                    with urllib.request.urlopen(direct_url) as response:
-                                        file_data = response.read()
-                                except:
-                                    # Fallback to local file (no metadata but better than nothing)
-                                    with open(real_path, "rb") as f:
-                                        file_data = f.read()
-                                
-                                if file_data:
-                                    with b1: st.download_button("💾 PNG", file_data, file_name=f"{name}.png", key=f"dl_{img_hash}_{idx}")
+                            card_url = f"{srv_url}/card/{img_hash}"
+                            # Ohne Definition liefert der Server das reine Bild (IMAGE_RAW_FALLBACK)
+                            if real_path and (has_definition or IMAGE_RAW_FALLBACK):
+                                with b1: st.link_button("💾 PNG", f"{card_url}.png?download=1", width="stretch")
                             
-                            if definition:
-                                json_str = json.dumps(definition, indent=2, ensure_ascii=False)
-                                with b2: st.download_button("💾 JSON", json_str, file_name=f"{name}.json", key=f"dl_json_{img_hash}_{idx}")
+                            if has_definition:
+                                with b2: st.link_button("💾 JSON", f"{card_url}.json?download=1", width="stretch")
 
                             # Row 2: SillyTavern Link (using st.code for reliable copy)
                             if direct_url:
@@ -1134,15 +992,12 @@ if st.session_state.get('search_input') and st.session_state.selected_sources an
                             if summary_text:
                                 safe_summary = clean_html(summary_text)
                                 st.markdown("<div class='char-preview-box' style='max-height: 200px; font-size: 0.85rem;'>", unsafe_allow_html=True)
-                                render_preview_html(safe_summary)
+                                with profiler.phase("preview_html"):
+                                    render_preview_html(safe_summary)
                                 st.markdown("</div>", unsafe_allow_html=True)
 
                             # TAGS & DETAILS
-                            tags_raw = metadata.get('tags') if metadata else []
                             tags_list = format_tags(tags_raw)
-                            if not tags_list and definition:
-                                dev_tags = definition.get('data', {}).get('tags') or definition.get('tags') if isinstance(definition, dict) else None
-                                if dev_tags: tags_list = format_tags(dev_tags)
 
                             if tags_list:
                                 disp_lim = 8
@@ -1158,25 +1013,46 @@ if st.session_state.get('search_input') and st.session_state.selected_sources an
                                 tags_html += '</div>'
                                 st.markdown(tags_html, unsafe_allow_html=True)
 
-                            with st.expander("📝 Details"):
-                                # Use tabs for clean detail view
-                                content_map = {}
-                                if card_data.get('description'): content_map["Desc"] = card_data['description']
-                                if card_data.get('first_mes'): content_map["First"] = card_data['first_mes']
-                                tab_names = list(content_map.keys()) + ["Info", "Raw"]
-                                t_rows = st.tabs(tab_names)
-                                t_idx = 0
-                                for k in content_map:
-                                    with t_rows[t_idx]: st.markdown(content_map[k])
-                                    t_idx += 1
-                                with t_rows[t_idx]:
-                                    st.table({"Added": added.strftime("%Y-%m-%d") if added else "?", "Source": src})
-                                    t_idx += 1
-                                with t_rows[t_idx]: st.json(metadata)
+                            # Lazy: der Inhalt läuft erst, wenn das Panel geöffnet ist
+                            details = st.expander("📝 Details", key=f"details_{idx}_{src}_{img_hash}", on_change="rerun")
+                            with details:
+                                if details.open:
+                                    with profiler.phase("details_load"):
+                                        metadata, definition = load_card_details(src, img_hash)
+                                    card_data = extract_card_data(definition) if definition else {}
+                                    # Use tabs for clean detail view
+                                    content_map = {}
+                                    if card_data.get('description'): content_map["Desc"] = card_data['description']
+                                    if card_data.get('first_mes'): content_map["First"] = card_data['first_mes']
+                                    tab_names = list(content_map.keys()) + ["Info", "Raw"]
+                                    t_rows = st.tabs(tab_names)
+                                    t_idx = 0
+                                    for k in content_map:
+                                        with t_rows[t_idx]: st.markdown(content_map[k])
+                                        t_idx += 1
+                                    with t_rows[t_idx]:
+                                        st.table({"Added": added.strftime("%Y-%m-%d") if added else "?", "Source": src})
+                                        t_idx += 1
+                                    with t_rows[t_idx]: st.json(metadata)
                         
                         # Add visual separator between cards
                         st.markdown("<div style='margin-bottom: 20px;'></div>", unsafe_allow_html=True)
+                        profiler.end_card()
             
+            # --- TOTAL COUNT ---
+            # Erst nach den Karten: die Seite steht schon, während gezählt wird.
+            # Normalisiert gecached, damit Sortierung/Blättern nicht neu zählt.
+            count_cap = SEARCH_COUNT_CAP if st.session_state.approx_count else None
+            with st.spinner("Zähle Treffer..."), profiler.phase("count"):
+                total_matches, count_capped = count_matches_cached(
+                    tuple(sorted(selected_sources)), tuple(sorted(selected_fields)), search_query,
+                    tuple(token_range), unlimited_tokens, count_cap, search_mode
+                )
+            total_pages = max(math.ceil(total_matches / limit), 1)
+            if has_next:
+                total_pages = max(total_pages, st.session_state.page + 2)
+            pages_label = f"{total_pages}+" if count_capped else f"{total_pages}"
+
             # --- PAGINATION CONTROLS (Bottom) ---
             try:
                 col_b_res, col_b_prev, col_b_page, col_b_next = st.columns([3, 0.6, 1.2, 0.6], vertical_alignment="center")
@@ -1184,7 +1060,7 @@ if st.session_state.get('search_input') and st.session_state.selected_sources an
                 col_b_res, col_b_prev, col_b_page, col_b_next = st.columns([3, 0.6, 1.2, 0.6])
             
             with col_b_res:
-                st.markdown(f'<p class="pag-label">S. {st.session_state.page+1} / {total_pages}</p>', unsafe_allow_html=True)
+                st.markdown(f'<p class="pag-label">S. {st.session_state.page+1} / {pages_label}</p>', unsafe_allow_html=True)
             with col_b_prev:
                  if st.session_state.page > 0:
                      if st.button("⬅️", key="prev_bottom"):
@@ -1194,18 +1070,46 @@ if st.session_state.get('search_input') and st.session_state.selected_sources an
                 if total_pages > 1:
                     st.number_input("Seite", 1, total_pages, key="p_jump_b", label_visibility="collapsed", on_change=lambda: change_page(st.session_state.p_jump_b - 1))
             with col_b_next:
-                 if st.session_state.page < total_pages - 1:
+                 if has_next:
                      if st.button("➡️", key="next_bottom"):
                          change_page(st.session_state.page + 1)
                          st.rerun()
 
+            # --- EXPORT ---
+            # Der Image Server streamt alle Treffer als ZIP (/export.zip), unabhängig von der Seite
+            with st.popover(f"📦 Alle Treffer exportieren ({total_matches}{'+' if count_capped else ''})"):
+                export_formats = {"PNG": "png", "JSON": "json", "PNG + JSON": "both"}
+                export_format = st.radio("Format", list(export_formats), key="export_format", horizontal=True)
+                export_params = (
+                    [("source", s) for s in selected_sources] + [("field", f) for f in selected_fields] +
+                    [("q", search_query), ("min_tokens", token_range[0]), ("max_tokens", token_range[1]),
+                     ("unlimited", int(unlimited_tokens)), ("sort", sort_option), ("mode", search_mode),
+                     ("format", export_formats[export_format])]
+                )
+                st.link_button("💾 ZIP herunterladen", f"{get_server_url()}/export.zip?{urlencode(export_params)}", width="stretch")
+                st.caption("Wird beim Herunterladen erzeugt, auch bei vielen Tausend Karten.")
+
         except Exception as e:
             st.error(f"Fehler: {e}")
             if debug_mode: st.code(full_sql)
 
-    cur.close()
-
 elif not st.session_state.selected_sources:
     st.warning("Wähle eine Quelle.")
 else:
     st.info("Suche starten...")
+
+# --- PROFILER (Debug-Modus) ---
+profiler.lap("render")
+profiler.finish()
+if debug_mode:
+    with profile_slot:
+        st.write("--- PROFILER ---")
+        st.write(f"Rerun: {profiler.total * 1000:.0f} ms")
+        st.dataframe(profiler.phase_rows(), hide_index=True)
+        if profiler.cards:
+            st.caption("Langsamste Karten (ms)")
+            st.dataframe(profiler.slowest_cards(), hide_index=True)
+        st.download_button("💾 Profil (JSON)", profiler.to_json(), file_name="profil.json", mime="application/json")
+        if profiler.capture_report:
+            with st.expander(f"{profiler.capture_mode} dieses Laufs"):
+                st.code(profiler.capture_report, language="text")
@@ -0,0 +1,550 @@
+"""Reproducible benchmark of the search path on a synthetic dataset.
+
+`generate` fills the database from config.py with the tables app.py
+searches (every *_character_def table of search.SOURCES, booru with its own
+schema and tags array) in realistic shapes: V2 cards with definition->'data',
+flat V1 definitions, empty definitions, Zipf-distributed tags, tag strings
+instead of arrays, token counts under both metadata keys, NULL dates. Rows
+are derived from their id by a hash, so a scale and seed always produce the
+same data.
+
+`run` replays canonical searches through search.py exactly like the app
+(fan-out included) and reports p50/p95 latency and a summary of the plan
+per case. Results can be saved as a baseline and later runs compared
+against it, e.g. before and after a change to the SQL builder.
+
+Generated tables carry a comment; tables without it are never touched, so
+pointing this at a real database fails instead of dropping data. Use a
+scratch database.
+
+Usage:
+    python benchmark.py generate --rows 1M --migrate
+    python benchmark.py run --save-baseline
+    python benchmark.py run --compare          # after changing search.py
+    python benchmark.py run --cases tag_click_common deep_keyset --plans
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+import psycopg2
+
+import db
+import search
+from search import (SOURCES, RELEVANCE_SORT, DEFAULT_SORT, build_page_query, build_count_query,
+                    can_fan_out, fetch_page_fanout, row_cursor, db_features)
+
+try:
+    import config
+except ImportError:
+    config = None
+
+BENCHMARK_BASELINE = getattr(config, "BENCHMARK_BASELINE",
+                             os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark.baseline.json"))
+# p95 slower than the baseline by this factor (and by more than the noise floor) counts as a regression
+BENCHMARK_REGRESSION_FACTOR = getattr(config, "BENCHMARK_REGRESSION_FACTOR", 1.25)
+BENCHMARK_NOISE_MS = getattr(config, "BENCHMARK_NOISE_MS", 2.0)
+
+# Set on every generated table, --drop only ever removes tables carrying it
+TABLE_MARKER = "charasearch benchmark data"
+
+# Share of the rows per source, roughly like the real archive
+SOURCE_WEIGHTS = {
+    "chub": 0.45,
+    "risuai": 0.08,
+    "char_tavern": 0.10,
+    "generic": 0.05,
+    "chub_lorebook": 0.03,
+    "booru": 0.15,
+    "nyaime": 0.06,
+    "webring": 0.08,
+}
+
+# Sources with a tagline column (search.SOURCES selects it), booru has its own schema
+TAGLINE_SOURCES = {"generic", "webring"}
+
+# Most frequent first; picked Zipf-like, so TAGS[0] matches a large share of
+# the rows and the long tail only a few
+TAGS = [
+    "Female", "Male", "Fantasy", "Romance", "OC", "Anime", "NSFW", "SFW", "Roleplay", "Human",
+    "Dominant", "Submissive", "Monster Girl", "Elf", "Villain", "Comedy", "Drama", "Sci-Fi", "Horror", "Adventure",
+    "Original Character", "Game Characters", "Scenario", "Multiple Characters", "Vampire", "Demon", "Angel",
+    "Knight", "Magic", "School", "Modern", "Historical", "Cyberpunk", "Post-Apocalyptic", "Mystery", "Tsundere",
+    "Yandere", "Kuudere", "Maid", "Royalty", "Pirate", "Ninja", "Robot", "Android", "Alien", "Dragon",
+    "Werewolf", "Catgirl", "Foxgirl", "Mermaid", "Witch", "Wizard", "Detective", "Soldier", "Doctor", "Teacher",
+    "Furry", "Non-human", "Giant", "Ghost", "Zombie", "Superhero", "Mafia", "Western", "Steampunk", "Slice of Life",
+    "Wholesome", "Angst", "Fluff", "Dark Fantasy", "Isekai", "RPG", "Dungeon", "Text Adventure", "Simulator",
+    "Assistant", "Lorebook", "Dark Elf", "Kemonomimi", "Bodyguard",
+]
+LONG_TAIL_TAGS = 400
+
+FIRST_NAMES = [
+    "Alice", "Aria", "Mara", "Lyra", "Elena", "Marcus", "Kai", "Luna", "Selene", "Rin", "Yuki", "Akira", "Freya",
+    "Sigrid", "Astrid", "Victor", "Dante", "Nero", "Isolde", "Morgana", "Cassandra", "Valeria", "Amara", "Zara",
+    "Hana", "Mei", "Sakura", "Kaito", "Ren", "Sora", "Aiden", "Lucian", "Seraphina", "Ophelia", "Rhea", "Thalia",
+    "Nova", "Iris", "Ivy", "Raven", "Ember", "Willow", "Jasper", "Felix", "Hugo", "Silas", "Mila", "Nadia",
+]
+SURNAMES = [
+    "Blackwood", "Ashford", "Nightshade", "Silverleaf", "Stormborn", "Valentine", "Moreau", "Kurosawa", "Takahashi",
+    "Ironheart", "Frost", "Vale", "Thorne", "Hale", "Rook", "Sterling", "Crane", "Winter",
+]
+TITLES = ["the Knight", "the Witch", "the Maid", "the Dragon", "the Detective", "of the North", "the Exile"]
+WORDS = (
+    "the a an and but with without her his their your you she he they is was has had will would can could "
+    "always never often quietly secretly kind cold cruel gentle shy proud loyal cunning brave tired curious "
+    "village city castle forest academy tavern ship station kingdom empire guild temple ruins mansion office "
+    "knight mage princess servant mercenary hunter scholar merchant thief guard captain healer bard priestess "
+    "dragon elf demon vampire wolf fox spirit golem android witch "
+    "loves hates protects serves hunts studies guards rules travels fights hides waits remembers forgets "
+    "sword magic blood moon sun storm shadow fire ice rain night dawn war peace secret promise debt curse "
+    "old young ancient new lost forgotten broken hidden royal noble poor rich wild dark bright silent "
+    "in on at from to into under over behind beyond between through after before during since until "
+    "smiles frowns laughs sighs whispers shouts nods blushes grins stares"
+).split()
+
+# Paragraph pool the descriptions, first messages and notes are assembled from
+PARAGRAPHS = 2000
+TAGLINES = 300
+
+def parse_rows(value):
+    """'10k', '1M', '10M' or a plain number -> int"""
+    value = value.strip().lower()
+    factor = {"k": 1000, "m": 1000 ** 2}.get(value[-1:], 1)
+    if factor > 1:
+        value = value[:-1]
+    return int(float(value) * factor)
+
+def text_pools(seed):
+    """Deterministic paragraph, tagline and tag lists for the generator."""
+    rng = random.Random(seed)
+
+    def sentence(min_words, max_words):
+        words = rng.choices(WORDS, k=rng.randint(min_words, max_words))
+        return " ".join(words).capitalize() + "."
+
+    paragraphs = [" ".join(sentence(6, 18) for _ in range(rng.randint(2, 8))) for _ in range(PARAGRAPHS)]
+    taglines = [sentence(4, 10) for _ in range(TAGLINES)]
+    tags = TAGS + [f"{rng.choice(WORDS)}-{rng.choice(WORDS)}-{i}" for i in range(LONG_TAIL_TAGS)]
+    return paragraphs, taglines, tags
+
+# Session-local helpers (pg_temp): uniform [0, 1) and log-uniform index from (row id, salt)
+HELPER_FUNCTIONS = [
+    """
+    CREATE FUNCTION pg_temp.bench_rand(g bigint, salt int) RETURNS float8
+    LANGUAGE sql IMMUTABLE PARALLEL SAFE
+    AS $$ SELECT (hashint8(g * 1009 + salt) & 2147483647)::float8 / 2147483648 $$
+    """,
+    """
+    CREATE FUNCTION pg_temp.bench_zipf(n int, r float8) RETURNS int
+    LANGUAGE sql IMMUTABLE PARALLEL SAFE
+    AS $$ SELECT least(n, floor(exp(r * ln(n + 1)))::int) $$
+    """,
+    # 1..k distinct tags of the pool, most of them from the head
+    """
+    CREATE FUNCTION pg_temp.bench_tags(g bigint, pool text[]) RETURNS text[]
+    LANGUAGE sql IMMUTABLE PARALLEL SAFE
+    AS $$
+        SELECT array_agg(DISTINCT pool[pg_temp.bench_zipf(cardinality(pool), pg_temp.bench_rand(g, 100 + i))])
+        FROM generate_series(0, (pg_temp.bench_rand(g, 99) * 11)::int) AS i
+    $$
+    """,
+    # 1..3 paragraphs of the pool
+    """
+    CREATE FUNCTION pg_temp.bench_text(g bigint, salt int, pool text[]) RETURNS text
+    LANGUAGE sql IMMUTABLE PARALLEL SAFE
+    AS $$
+        SELECT string_agg(pool[1 + floor(pg_temp.bench_rand(g, salt + i) * cardinality(pool))::int], E'\n\n')
+        FROM generate_series(0, (pg_temp.bench_rand(g, salt) * 2.99)::int) AS i
+    $$
+    """,
+]
+
+# Per row values shared by all JSON sources; g is unique over all tables
+ROW_SELECT = """
+    SELECT g,
+        md5(%(seed)s || ':' || g) AS image_hash,
+        (%(first_names)s::text[])[pg_temp.bench_zipf(cardinality(%(first_names)s::text[]), pg_temp.bench_rand(g, 1))]
+            || CASE WHEN pg_temp.bench_rand(g, 2) < 0.35
+                    THEN ' ' || (%(surnames)s::text[])[1 + floor(pg_temp.bench_rand(g, 3) * cardinality(%(surnames)s::text[]))::int]
+                    WHEN pg_temp.bench_rand(g, 2) < 0.45
+                    THEN ' ' || (%(titles)s::text[])[1 + floor(pg_temp.bench_rand(g, 3) * cardinality(%(titles)s::text[]))::int]
+                    ELSE '' END AS name,
+        'creator' || pg_temp.bench_zipf(greatest(%(authors)s, 1), pg_temp.bench_rand(g, 4)) AS author,
+        CASE WHEN pg_temp.bench_rand(g, 5) < 0.03 THEN NULL
+             ELSE timestamptz '2023-01-01 00:00:00+00' + pg_temp.bench_rand(g, 6) * interval '1000 days' END AS added,
+        -- 150 .. 13000 tokens, 8 percent unknown
+        CASE WHEN pg_temp.bench_rand(g, 7) < 0.08 THEN NULL
+             ELSE floor(exp(5 + pg_temp.bench_rand(g, 8) * 4.5))::int END AS tokens,
+        pg_temp.bench_tags(g, %(tags)s::text[]) AS tags,
+        pg_temp.bench_rand(g, 9) AS shape,
+        pg_temp.bench_text(g, 20, %(paragraphs)s::text[]) AS description,
+        pg_temp.bench_text(g, 30, %(paragraphs)s::text[]) AS first_mes,
+        CASE WHEN pg_temp.bench_rand(g, 10) < 0.5 THEN pg_temp.bench_text(g, 40, %(paragraphs)s::text[]) END AS creator_notes,
+        (%(paragraphs)s::text[])[1 + floor(pg_temp.bench_rand(g, 11) * cardinality(%(paragraphs)s::text[]))::int] AS scenario,
+        (%(taglines)s::text[])[1 + floor(pg_temp.bench_rand(g, 12) * cardinality(%(taglines)s::text[]))::int] AS tagline
+    FROM generate_series(%(start)s::bigint, %(end)s::bigint) AS g
+"""
+
+# metadata: chub style (totalTokens, stats, safety) or the total_token_count of the other scrapers;
+# tags as JSON array, in 5 percent of the rows as comma separated string
+METADATA_EXPR = """
+    jsonb_strip_nulls(CASE WHEN %(chub_style)s THEN jsonb_build_object(
+             'tags', to_jsonb(r.tags), 'totalTokens', r.tokens,
+             'starCount', floor(pg_temp.bench_rand(r.g, 13) * 500)::int,
+             'nChats', floor(pg_temp.bench_rand(r.g, 14) * 10000)::int,
+             'fullPath', r.author || '/' || lower(replace(r.name, ' ', '-')) || '-' || r.g,
+             'nsfw', pg_temp.bench_rand(r.g, 15) < 0.4,
+             'safety', CASE WHEN pg_temp.bench_rand(r.g, 16) < 0.2 THEN jsonb_build_object(
+                 'categories', jsonb_build_object('sexual', pg_temp.bench_rand(r.g, 17) < 0.6,
+                                                  'violence', pg_temp.bench_rand(r.g, 18) < 0.2),
+                 'bad_shit', '{}'::jsonb) END)
+         WHEN pg_temp.bench_rand(r.g, 19) < 0.05 THEN jsonb_build_object(
+             'tags', array_to_string(r.tags, ','), 'total_token_count', r.tokens)
+         ELSE jsonb_build_object('tags', to_jsonb(r.tags), 'total_token_count', r.tokens) END)
+"""
+
+# definition: 65 percent V2 card, 25 percent flat V1, 10 percent empty; lorebooks have entries instead
+DEFINITION_EXPR = """
+    CASE WHEN %(lorebook)s THEN jsonb_build_object(
+             'name', r.name, 'description', r.description,
+             'entries', jsonb_build_array(jsonb_build_object('keys', to_jsonb(r.tags), 'content', r.scenario)))
+         WHEN r.shape < 0.65 THEN jsonb_build_object(
+             'spec', 'chara_card_v2', 'spec_version', '2.0',
+             'data', jsonb_build_object(
+                 'name', r.name, 'description', r.description, 'personality', r.tagline, 'scenario', r.scenario,
+                 'first_mes', r.first_mes, 'mes_example', '<START>', 'creator_notes', r.creator_notes,
+                 'system_prompt', '', 'post_history_instructions', '', 'alternate_greetings', '[]'::jsonb,
+                 'tags', to_jsonb(r.tags), 'creator', r.author, 'character_version', '1.0',
+                 'total_token_count', r.tokens, 'extensions', '{}'::jsonb))
+         WHEN r.shape < 0.9 THEN jsonb_strip_nulls(jsonb_build_object(
+             'name', r.name, 'description', r.description, 'personality', r.tagline, 'scenario', r.scenario,
+             'first_mes', r.first_mes, 'mes_example', '', 'creator_notes', r.creator_notes))
+         ELSE '{}'::jsonb END
+"""
+
+def insert_sql(key, table):
+    """INSERT .. SELECT of one id range into a source table"""
+    if key == "booru":
+        return (f"INSERT INTO {table} (name, author, tagline, summary, tags, image_hash, added) "
+                f"SELECT r.name, r.author, r.tagline, r.description, "
+                f"ARRAY(SELECT lower(replace(t, ' ', '_')) FROM unnest(r.tags) AS t), r.image_hash, r.added "
+                f"FROM ({ROW_SELECT}) AS r")
+    tagline = "r.tagline, " if key in TAGLINE_SOURCES else ""
+    columns = "name, author, " + ("tagline, " if key in TAGLINE_SOURCES else "") + "image_hash, added, metadata, definition"
+    return (f"INSERT INTO {table} ({columns}) "
+            f"SELECT r.name, r.author, {tagline}r.image_hash, r.added, {METADATA_EXPR}, {DEFINITION_EXPR} "
+            f"FROM ({ROW_SELECT}) AS r")
+
+def create_table_sql(key, table):
+    if key == "booru":
+        return (f"CREATE TABLE {table} (id bigserial PRIMARY KEY, name text, author text, tagline text, "
+                f"summary text, tags text[], image_hash text, added timestamptz)")
+    tagline = "tagline text, " if key in TAGLINE_SOURCES else ""
+    return (f"CREATE TABLE {table} (id bigserial PRIMARY KEY, name text, author text, {tagline}"
+            f"image_hash text, added timestamptz, metadata jsonb, definition jsonb)")
+
+def prepare_tables(cur, drop):
+    """Creates the source tables; refuses to touch tables that were not generated here."""
+    for key, (table, _, _) in SOURCES.items():
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL, obj_description(to_regclass(%s), 'pg_class')", (table, table))
+        exists, comment = cur.fetchone()
+        if exists and comment != TABLE_MARKER:
+            sys.exit(f"{table} exists and was not created by benchmark.py, refusing to touch it. Use a scratch database.")
+        if exists and not drop:
+            sys.exit(f"{table} already holds benchmark data, pass --drop to generate it again")
+        if exists:
+            # CASCADE: the card_search view of migrate.py depends on the tables
+            cur.execute(f"DROP TABLE {table} CASCADE")
+        cur.execute(create_table_sql(key, table))
+        cur.execute(f"COMMENT ON TABLE {table} IS %s", (TABLE_MARKER,))
+
+def generate(rows, seed=1, batch=200000, drop=False):
+    paragraphs, taglines, tags = text_pools(seed)
+    conn = psycopg2.connect(**db.DB_CONFIG)
+    try:
+        with conn.cursor() as cur:
+            prepare_tables(cur, drop)
+            for sql in HELPER_FUNCTIONS:
+                cur.execute(sql)
+            conn.commit()
+
+            start = time.time()
+            first_id = 1
+            for key, (table, _, _) in SOURCES.items():
+                count = max(1, round(rows * SOURCE_WEIGHTS.get(key, 0.0)))
+                for batch_start in range(first_id, first_id + count, batch):
+                    batch_end = min(batch_start + batch, first_id + count) - 1
+                    cur.execute(insert_sql(key, table), {
+                        "seed": str(seed), "start": batch_start, "end": batch_end,
+                        "first_names": FIRST_NAMES, "surnames": SURNAMES, "titles": TITLES,
+                        "authors": rows // 20, "tags": tags, "paragraphs": paragraphs, "taglines": taglines,
+                        "chub_style": key == "chub", "lorebook": key == "chub_lorebook",
+                    })
+                    conn.commit()
+                    print(f"{table}: {batch_end - first_id + 1}/{count} rows ({time.time() - start:.0f}s)")
+                first_id += count
+
+            conn.autocommit = True
+            for table, _, _ in SOURCES.values():
+                cur.execute(f"VACUUM ANALYZE {table}")
+    finally:
+        conn.close()
+    print(f"Generated {rows} rows in {time.time() - start:.0f}s")
+
+# --- Suite ---
+
+ALL_SOURCES = list(SOURCES)
+# One case per sort option of the sidebar (Relevanz: see fts_description)
+SORT_CASES = {
+    "sort_newest": "Neueste zuerst",
+    "sort_oldest": "Älteste zuerst",
+    "sort_name": "Name (A-Z)",
+    "sort_tokens_desc": "Token Count (Viel)",
+    "sort_tokens_asc": "Token Count (Wenig)",
+}
+DEFAULT_CASE = {
+    "sources": ALL_SOURCES, "fields": ["tags"], "query": TAGS[0], "token_range": [0, 8000], "unlimited": True,
+    "sort": DEFAULT_SORT, "mode": "ilike", "limit": 24, "page": 0, "paging": "offset", "count": None,
+}
+
+def canonical_cases():
+    """name -> search, in the shape of the app's session state"""
+    cases = {
+        "tag_click_common": {},
+        "tag_click_rare": {"query": TAGS[-1]},
+        "tag_click_two": {"query": f"{TAGS[2]}, {TAGS[13]}"},
+        "tag_click_missing": {"query": "no such tag"},
+        "name_ilike": {"fields": ["name"], "query": "mar"},
+        "name_ilike_rare": {"fields": ["name"], "query": "ironheart"},
+        "description_search": {"fields": ["description"], "query": "forgotten castle"},
+        "description_missing": {"fields": ["description"], "query": "zzyzx"},
+        "all_fields": {"fields": ["name", "tags", "description", "creator_notes", "first_mes"], "query": "dragon"},
+        "single_source": {"sources": ["chub"]},
+        "fts_description": {"fields": ["description", "creator_notes"], "query": "ancient dragon",
+                            "mode": "fts", "sort": RELEVANCE_SORT},
+        "deep_offset": {"sort": "Neueste zuerst", "page": 200},
+        "deep_keyset": {"sort": "Neueste zuerst", "page": 200, "paging": "keyset"},
+        "deep_offset_name": {"page": 200},
+        "tokens_narrow": {"token_range": [1000, 1500], "unlimited": False},
+        "tokens_large_only": {"token_range": [8000, 8000], "unlimited": True, "sort": "Token Count (Viel)"},
+        "count_capped": {"count": getattr(config, "SEARCH_COUNT_CAP", 10000)},
+        "count_exact": {"count": 0},
+        "count_description": {"fields": ["description"], "query": "forgotten castle", "count": 0},
+    }
+    for name, sort_option in SORT_CASES.items():
+        cases[name] = {"sort": sort_option}
+    return {name: {**DEFAULT_CASE, **overrides} for name, overrides in cases.items()}
+
+def case_query(case, after=None):
+    """(sql, params) of a case as the app would build it"""
+    if case["count"] is not None:
+        return build_count_query(case["sources"], case["fields"], case["query"], case["token_range"],
+                                 case["unlimited"], cap=case["count"] or None, mode=case["mode"])
+    limit = case["limit"] + 1  # app.py fetches one row more to know if there is a next page
+    return build_page_query(case["sources"], case["fields"], case["query"], case["token_range"], case["unlimited"],
+                            case["sort"], limit, offset=case["page"] * case["limit"], after=after, mode=case["mode"])
+
+def keyset_cursor(case):
+    """Cursor of the last row before case['page'], taken from an untimed OFFSET query."""
+    if case["paging"] != "keyset" or not case["page"]:
+        return None
+    sql, params = build_page_query(case["sources"], case["fields"], case["query"], case["token_range"],
+                                   case["unlimited"], case["sort"], 1, offset=case["page"] * case["limit"] - 1,
+                                   mode=case["mode"])
+    rows = db.fetch_all(sql, tuple(params)) if sql else []
+    return row_cursor(rows[0]) if rows else None
+
+def execute_case(case, after):
+    """Runs a case once like app.py (fan-out where the app fans out) -> row count"""
+    if case["count"] is None and can_fan_out(case["sources"], case["sort"], case["mode"]):
+        rows = fetch_page_fanout(case["sources"], case["fields"], case["query"], case["token_range"], case["unlimited"],
+                                 case["sort"], case["limit"] + 1, offset=case["page"] * case["limit"], after=after,
+                                 mode=case["mode"])
+        return len(rows)
+    sql, params = case_query(case, after)
+    return len(db.fetch_all(sql, tuple(params))) if sql else 0
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile of an ascending list"""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, round(q / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+def walk_plan(node):
+    yield node
+    for child in node.get("Plans", []):
+        yield from walk_plan(child)
+
+def explain(sql, params):
+    """EXPLAIN ANALYZE of a statement -> (summary dict, plan text)"""
+    with db.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + sql, tuple(params))
+            plan = cur.fetchone()[0][0]
+            cur.execute("EXPLAIN (ANALYZE, BUFFERS) " + sql, tuple(params))
+            text = "\n".join(row[0] for row in cur.fetchall())
+    nodes = list(walk_plan(plan["Plan"]))
+    summary = {
+        "execution_ms": round(plan["Execution Time"], 3),
+        "planning_ms": round(plan["Planning Time"], 3),
+        "seq_scans": sorted({n["Relation Name"] for n in nodes if n["Node Type"] in ("Seq Scan", "Parallel Seq Scan")}),
+        "indexes": sorted({n["Index Name"] for n in nodes if "Index Name" in n}),
+        "shared_hit": plan["Plan"].get("Shared Hit Blocks", 0),
+        "shared_read": plan["Plan"].get("Shared Read Blocks", 0),
+    }
+    return summary, text
+
+def environment():
+    """What the numbers depend on besides the code"""
+    counts = {}
+    for table, _, _ in SOURCES.values():
+        try:
+            counts[table] = db.fetch_all("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(%s)", (table,))[0][0]
+        except Exception:
+            counts[table] = None
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                  cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        revision = None
+    return {
+        "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "revision": revision,
+        "postgres": db.fetch_all("SHOW server_version")[0][0],
+        "features": sorted(db_features()),
+        "card_search": search.use_card_search(),
+        "fanout": search.SEARCH_FANOUT,
+        "rows": counts,
+    }
+
+def run_suite(case_names=None, repeat=20, warmup=2, plans=False):
+    cases = canonical_cases()
+    unknown = [n for n in (case_names or []) if n not in cases]
+    if unknown:
+        sys.exit(f"Unknown cases: {', '.join(unknown)} (see --list)")
+    results = {"environment": environment(), "cases": {}}
+    for name in case_names or cases:
+        case = cases[name]
+        after = keyset_cursor(case)
+        sql, params = case_query(case, after)
+        if not sql:
+            print(f"{name}: no query for this search, skipped")
+            continue
+        for _ in range(warmup):
+            execute_case(case, after)
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            rows = execute_case(case, after)
+            timings.append((time.perf_counter() - start) * 1000)
+        timings.sort()
+        # Fan-out cases run one query per source; the plan shown is the single UNION ALL statement
+        plan, plan_text = explain(sql, params)
+        results["cases"][name] = {
+            "search": case,
+            "fanout": case["count"] is None and can_fan_out(case["sources"], case["sort"], case["mode"]),
+            "sql_hash": hashlib.sha1(sql.encode("utf-8")).hexdigest()[:12],
+            "rows": rows,
+            "p50_ms": round(percentile(timings, 50), 3),
+            "p95_ms": round(percentile(timings, 95), 3),
+            "max_ms": round(timings[-1], 3),
+            "plan": plan,
+        }
+        if plans:
+            results["cases"][name]["plan_text"] = plan_text
+        print_case(name, results["cases"][name])
+        if plans:
+            print(plan_text + "\n")
+    return results
+
+def print_case(name, result):
+    plan = result["plan"]
+    scans = f" seq:{','.join(plan['seq_scans'])}" if plan["seq_scans"] else ""
+    print(f"{name:<22} p50 {result['p50_ms']:>9.2f} ms  p95 {result['p95_ms']:>9.2f} ms  "
+          f"{result['rows']:>6} rows  {'fan-out ' if result['fanout'] else ''}"
+          f"idx:{len(plan['indexes'])}{scans}")
+
+def compare(results, baseline):
+    """Prints the p95 change per case -> names of the regressed cases"""
+    regressions = []
+    print(f"\nBaseline from {baseline['environment']['started_at']} (revision {baseline['environment'].get('revision')})")
+    if baseline["environment"]["rows"] != results["environment"]["rows"]:
+        print("Warning: the row counts differ from the baseline, the comparison is not like for like")
+    for name, result in results["cases"].items():
+        old = baseline["cases"].get(name)
+        if old is None:
+            print(f"{name:<22} new case")
+            continue
+        ratio = result["p95_ms"] / old["p95_ms"] if old["p95_ms"] else float("inf")
+        notes = []
+        if result["sql_hash"] != old["sql_hash"]:
+            notes.append("SQL changed")
+        if result["plan"]["seq_scans"] != old["plan"]["seq_scans"] or result["plan"]["indexes"] != old["plan"]["indexes"]:
+            notes.append("plan changed")
+        if result["rows"] != old["rows"]:
+            notes.append(f"rows {old['rows']} -> {result['rows']}")
+        regressed = (ratio > BENCHMARK_REGRESSION_FACTOR
+                     and result["p95_ms"] - old["p95_ms"] > BENCHMARK_NOISE_MS)
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<22} p95 {old['p95_ms']:>9.2f} -> {result['p95_ms']:>9.2f} ms  x{ratio:.2f}"
+              f"{'  REGRESSION' if regressed else ''}{'  (' + ', '.join(notes) + ')' if notes else ''}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic dataset and latency benchmark for the search.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    gen = commands.add_parser("generate", help="Fill the database from config.py with synthetic cards")
+    gen.add_argument("--rows", default="10k", help="Total rows over all sources, e.g. 10k, 1M, 10M")
+    gen.add_argument("--seed", type=int, default=1, help="Same seed and rows -> same data")
+    gen.add_argument("--batch", type=int, default=200000, help="Rows per INSERT")
+    gen.add_argument("--drop", action="store_true", help="Replace tables generated by an earlier run")
+    gen.add_argument("--migrate", action="store_true", help="Run migrate.py afterwards (indexes, card_search)")
+
+    bench = commands.add_parser("run", help="Replay the canonical searches")
+    bench.add_argument("--cases", nargs="+", help="Only these cases (default: all)")
+    bench.add_argument("--list", action="store_true", help="List the cases and exit")
+    bench.add_argument("--repeat", type=lambda v: max(1, int(v)), default=20, help="Timed runs per case")
+    bench.add_argument("--warmup", type=int, default=2, help="Untimed runs per case first")
+    bench.add_argument("--plans", action="store_true", help="Print and keep the full EXPLAIN ANALYZE output")
+    bench.add_argument("--output", help="Write the results as JSON")
+    bench.add_argument("--save-baseline", nargs="?", const=BENCHMARK_BASELINE, metavar="PATH",
+                       help="Save the results as baseline (default: BENCHMARK_BASELINE)")
+    bench.add_argument("--compare", nargs="?", const=BENCHMARK_BASELINE, metavar="PATH",
+                       help="Compare against a saved baseline, exit code 1 on regressions")
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        generate(parse_rows(args.rows), seed=args.seed, batch=args.batch, drop=args.drop)
+        if args.migrate:
+            import migrate
+            migrate.run()
+        else:
+            print("Run migrate.py next, the tables have no search indexes yet")
+        return
+
+    if args.list:
+        for name, case in canonical_cases().items():
+            print(f"{name:<22} {case['fields']} {case['query']!r} sort={case['sort']!r} page={case['page']}")
+        return
+    results = run_suite(args.cases, repeat=args.repeat, warmup=args.warmup, plans=args.plans)
+    for path in filter(None, [args.output, args.save_baseline]):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False, default=str)
+        print(f"Saved {path}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if compare(results, baseline):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+"""Caches for the image server."""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # No flock (Windows): there is no pre-fork mode there, the thread lock is enough
+    fcntl = None
+
+# Bump when the rendered output changes, so old cache entries are no longer hit
+RENDER_VERSION = 1
+
+def definition_fingerprint(definition):
+    """Stable hash of a character definition (key order does not matter)."""
+    canonical = json.dumps(definition, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+def render_key(image_hash, definition):
+    """Cache key / ETag for a card: changes with the image or the definition."""
+    raw = f"{RENDER_VERSION}:{image_hash}:{definition_fingerprint(definition)}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:40]
+
+class RenderCache:
+    """Size-bounded on-disk LRU of rendered files, shared by all processes.
+
+    Files live under directory/<key[:2]>/<key><suffix> and are written
+    atomically (temp file + rename), so readers never see partial output.
+    The directory is the index: the pre-fork workers and pregen.py's pool
+    all write into it, so the total size is kept in a small state file that
+    is only changed under an exclusive lock (flock) on it. A put that takes
+    the total over max_bytes sweeps the directory and evicts the least
+    recently used files (by atime, which get() bumps) down to
+    SWEEP_TARGET * max_bytes, so the bound holds across processes.
+    """
+
+    STATE_FILE = ".state"
+    # A sweep evicts down to this share of max_bytes, so it does not run on every put
+    SWEEP_TARGET = 0.9
+
+    def __init__(self, directory, max_bytes, suffix=".png"):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0  # by this process
+        self._lock = threading.Lock()
+        self._state_fd = None
+        self._state_pid = None
+        os.makedirs(directory, exist_ok=True)
+        with self._locked() as fd:
+            # Also catches files left behind by an older layout and a lowered max_bytes
+            self._write_state(fd, *self._sweep(self.max_bytes))
+
+    def _state(self):
+        # flock belongs to the open file description, which fork() shares:
+        # every process opens the state file on its own
+        if self._state_pid != os.getpid():
+            self._state_fd = os.open(os.path.join(self.directory, self.STATE_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+            self._state_pid = os.getpid()
+        return self._state_fd
+
+    @contextmanager
+    def _locked(self):
+        """Exclusive access to the state file, against threads and other processes."""
+        with self._lock:
+            fd = self._state()
+            if fcntl:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                yield fd
+            finally:
+                if fcntl:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _read_state(fd):
+        """(total bytes, entries) as recorded by the last writer"""
+        try:
+            total, entries = os.pread(fd, 64, 0).split()
+            return int(total), int(entries)
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _write_state(fd, total, entries):
+        # Fixed width, so a reader without the lock never sees a mix of old and new digits
+        os.pwrite(fd, f"{total:20d} {entries:20d}\n".encode("ascii"), 0)
+
+    def _scan(self):
+        """[(atime, size, path)] of all cached files"""
+        found = []
+        for shard in os.scandir(self.directory):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if not entry.name.endswith(self.suffix):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                found.append((st.st_atime, st.st_size, entry.path))
+        return found
+
+    def _sweep(self, limit, keep=None):
+        """Evicts the least recently used files until at most `limit` bytes remain -> (total, entries)"""
+        found = sorted(self._scan())
+        total = sum(size for _, size, _ in found)
+        entries = len(found)
+        for _, size, path in found:
+            if total <= limit or entries <= 1:
+                break
+            if path == keep:
+                continue
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            entries -= 1
+            self.evictions += 1
+        return total, entries
+
+    def path_for(self, key):
+        return os.path.join(self.directory, key[:2], key + self.suffix)
+
+    def get(self, key):
+        """Path of the cached file or None.
+
+        Another process may evict the file any time after this returns;
+        to read it, use open().
+        """
+        path = self.path_for(key)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        self._hit(path, st)
+        return path
+
+    def open(self, key):
+        """The cached file opened for reading ("rb"), or None.
+
+        An open file stays readable when another process evicts (unlinks) it.
+        """
+        try:
+            f = open(self.path_for(key), "rb")
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        self._hit(f.name, os.fstat(f.fileno()))
+        return f
+
+    def _hit(self, path, st):
+        with self._lock:
+            self.hits += 1
+        try:
+            # Keep mtime (Last-Modified), bump atime for the LRU order
+            os.utime(path, (time.time(), st.st_mtime))
+        except OSError:
+            pass
+
+    def put(self, key, chunks):
+        """Stores the byte chunks under key and returns the file path."""
+        path = self.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        size = 0
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for buf in chunks:
+                    f.write(buf)
+                    size += len(buf)
+            with self._locked() as state_fd:
+                state = self._read_state(state_fd)
+                try:
+                    old_size = os.stat(path).st_size
+                except FileNotFoundError:
+                    old_size = None
+                os.replace(tmp_path, path)
+                if state is None:
+                    state = self._sweep(self.max_bytes, keep=path)
+                else:
+                    total, entries = state
+                    state = (total + size - (old_size or 0), entries + (old_size is None))
+                    if state[0] > self.max_bytes:
+                        state = self._sweep(int(self.max_bytes * self.SWEEP_TARGET), keep=path)
+                self._write_state(state_fd, *state)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        return path
+
+    def stats(self):
+        total, entries = self._read_state(self._state()) or (0, 0)
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": entries,
+                "bytes": total,
+                "max_bytes": self.max_bytes,
+            }
+
+# Returned by DefinitionCache.get() when the cache knows nothing about a key
+MISS = object()
+
+class DefinitionCache:
+    """Process-wide LRU of image hash -> definition with TTL and a size bound.
+
+    Hashes that are in no table are remembered for negative_ttl seconds
+    (as None), so clients probing random hashes cannot hammer the DB.
+    Sizes are estimated from the JSON length of each definition.
+    """
+
+    def __init__(self, ttl, max_bytes, negative_ttl, max_negative=100_000):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.negative_ttl = negative_ttl
+        self.max_negative = max_negative
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.total_bytes = 0
+        self._entries = OrderedDict()   # key -> (expires, size, definition)
+        self._negative = OrderedDict()  # key -> expires
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Definition, None for a known miss, or MISS if it has to be queried."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[2]
+                del self._entries[key]
+                self.total_bytes -= entry[1]
+
+            expires = self._negative.get(key)
+            if expires is not None:
+                if expires > now:
+                    self.negative_hits += 1
+                    return None
+                del self._negative[key]
+
+            self.misses += 1
+            return MISS
+
+    def put(self, key, definition):
+        """Caches a lookup result; None marks the hash as not found."""
+        now = time.monotonic()
+        with self._lock:
+            if definition is None:
+                self._negative[key] = now + self.negative_ttl
+                self._negative.move_to_end(key)
+                while len(self._negative) > self.max_negative:
+                    self._negative.popitem(last=False)
+                return
+
+            size = len(json.dumps(definition, ensure_ascii=False))
+            if size > self.max_bytes:
+                return
+            self._negative.pop(key, None)
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[1]
+            self._entries[key] = (now + self.ttl, size, definition)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, (_, old_size, _) = self._entries.popitem(last=False)
+                self.total_bytes -= old_size
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.negative_hits + self.misses
+            return {
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses,
+                "hit_ratio": (self.hits + self.negative_hits) / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "negative_entries": len(self._negative),
+                "bytes": self.total_bytes,
+            }
@@ -0,0 +1,223 @@
+"""Shared PostgreSQL access for app.py and image_server.py.
+
+All queries go through one thread-safe connection pool per process, so
+connection setup stays out of the request path and concurrent Streamlit
+sessions / image requests no longer share (or re-open) a single connection.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+
+try:
+    import config
+    DB_CONFIG = config.DB_CONFIG
+except ImportError:
+    config = None
+    DB_CONFIG = {}
+
+# Optional tuning knobs (can be set in config.py)
+DB_POOL_MIN = getattr(config, "DB_POOL_MIN", 1)
+DB_POOL_MAX = getattr(config, "DB_POOL_MAX", 20)
+# Seconds to wait for a free connection before giving up
+DB_POOL_TIMEOUT = getattr(config, "DB_POOL_TIMEOUT", 30)
+# Connections older than this are closed and replaced
+DB_POOL_MAX_LIFETIME = getattr(config, "DB_POOL_MAX_LIFETIME", 3600)
+# Connections idle longer than this are checked with SELECT 1 before reuse
+DB_POOL_CHECK_IDLE = getattr(config, "DB_POOL_CHECK_IDLE", 30)
+
+class PoolTimeout(Exception):
+    """No connection became available within the pool timeout."""
+
+class ConnectionPool:
+    """Thread-safe, blocking psycopg2 connection pool.
+
+    Unlike psycopg2.pool.ThreadedConnectionPool it waits for a free
+    connection instead of failing, validates connections on checkout and
+    recycles them after max_lifetime seconds. Wait times are recorded so the
+    pool size can be tuned from the stats.
+    """
+
+    def __init__(self, db_config, minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX, timeout=DB_POOL_TIMEOUT,
+                 max_lifetime=DB_POOL_MAX_LIFETIME, check_idle=DB_POOL_CHECK_IDLE):
+        self.db_config = db_config
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.check_idle = check_idle
+        self.pid = os.getpid()
+
+        self._idle = []      # (conn, created, last_used), most recently used last
+        self._created = {}   # id(conn) -> creation time of checked out connections
+        self._size = 0
+        self._cond = threading.Condition()
+
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.timeouts = 0
+        self.connects = 0
+        self.recycled = 0
+        self.discarded = 0
+
+        try:
+            for _ in range(minconn):
+                conn = self._connect()
+                self._idle.append((conn, time.monotonic(), time.monotonic()))
+                self._size += 1
+        except psycopg2.Error as e:
+            # DB not reachable yet, connections are opened on demand later
+            print(f"DB Pool: could not pre-open connections: {e}")
+
+    def _connect(self):
+        conn = psycopg2.connect(**self.db_config)
+        self.connects += 1
+        return conn
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _is_healthy(self, conn):
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        start = time.monotonic()
+        waited = False
+        conn = None
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, created, last_used = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    self._size += 1
+                    break
+                remaining = self.timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeout(f"No DB connection available after {self.timeout}s")
+                waited = True
+                self._cond.wait(remaining)
+
+            waited_for = time.monotonic() - start
+            self.checkouts += 1
+            if waited:
+                self.waits += 1
+                self.wait_time_total += waited_for
+                self.wait_time_max = max(self.wait_time_max, waited_for)
+
+        now = time.monotonic()
+        if conn is not None:
+            if conn.closed or now - created > self.max_lifetime:
+                self.recycled += 1
+                self._close(conn)
+                conn = None
+            elif now - last_used > self.check_idle and not self._is_healthy(conn):
+                self.discarded += 1
+                self._close(conn)
+                conn = None
+
+        if conn is None:
+            try:
+                conn = self._connect()
+            except BaseException:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+            created = time.monotonic()
+
+        with self._cond:
+            self._created[id(conn)] = created
+        return conn
+
+    def putconn(self, conn, discard=False):
+        with self._cond:
+            created = self._created.pop(id(conn), None)
+        if created is None:
+            raise ValueError("Connection does not belong to this pool")
+
+        if not discard and not conn.closed:
+            # Never hand out a connection with an open or failed transaction
+            if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    discard = True
+
+        with self._cond:
+            if discard or conn.closed:
+                self.discarded += 1
+                self._size -= 1
+                self._close(conn)
+            else:
+                self._idle.append((conn, created, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """Checks out a connection; commits on success, rolls back on errors."""
+        conn = self.getconn()
+        discard = False
+        try:
+            yield conn
+            conn.commit()
+        except BaseException as e:
+            # Broken connections are dropped instead of going back into the pool
+            discard = conn.closed or isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+            raise
+        finally:
+            self.putconn(conn, discard=discard)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": len(self._created),
+                "max": self.maxconn,
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "wait_time_avg_ms": round(1000 * self.wait_time_total / self.waits, 2) if self.waits else 0.0,
+                "wait_time_max_ms": round(1000 * self.wait_time_max, 2),
+                "timeouts": self.timeouts,
+                "connects": self.connects,
+                "recycled": self.recycled,
+                "discarded": self.discarded,
+            }
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """The process-wide pool; a forked child gets its own, never the parent's sockets."""
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            _pool = ConnectionPool(DB_CONFIG)
+        return _pool
+
+@contextmanager
+def connection():
+    with get_pool().connection() as conn:
+        yield conn
+
+def fetch_all(sql, params=None):
+    with connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql, params)
+            return cur.fetchall()
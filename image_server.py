@@ -1,37 +1,203 @@
 import http.server
 import socketserver
 import threading
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import contextlib
+import multiprocessing
+import signal
+import time
 import os
 import io
 import json
 import base64
-import psycopg2
+import shutil
+import tempfile
+import email.utils
+import re
+import urllib.parse
+import zipfile
+import db
+import metrics
+import search
 import socket
 from http import HTTPStatus
 from PIL import Image, PngImagePlugin
+from png_chunks import is_png, PngTextSplice, COPY_BUFSIZE
+from manifest import get_manifest, find_image, hash_from_rel_path, sniff_format
+from cache import RenderCache, DefinitionCache, MISS, render_key, definition_fingerprint
+from thumbnails import (THUMB_SIZES, THUMB_FORMATS, DEFAULT_THUMB_FORMAT, thumb_cache, thumb_key,
+                        render_thumbnail, cached_thumbnail)
 
 # Try to import config, assuming this file is in the same directory as config.py
 try:
-    from config import IMAGE_ROOT, DB_CONFIG
+    import config
+    IMAGE_ROOT = config.IMAGE_ROOT
+    DB_CONFIG = config.DB_CONFIG
 except ImportError:
     print("Error: config.py not found.")
+    config = None
     IMAGE_ROOT = "."
     DB_CONFIG = {}
 
+# Optional tuning knobs (can be set in config.py)
+# Max. number of connections handled at the same time
+IMAGE_SERVER_WORKERS = getattr(config, "IMAGE_SERVER_WORKERS", 32)
+# Seconds an idle keep-alive connection may hold its worker
+IMAGE_SERVER_KEEPALIVE = getattr(config, "IMAGE_SERVER_KEEPALIVE", 15)
+# Set to False when the standalone pre-fork server (python image_server.py) runs instead
+IMAGE_SERVER_EMBEDDED = getattr(config, "IMAGE_SERVER_EMBEDDED", True)
+# Pre-fork mode: a worker whose accept loop is silent this long is restarted
+IMAGE_SERVER_HEARTBEAT_TIMEOUT = getattr(config, "IMAGE_SERVER_HEARTBEAT_TIMEOUT", 60)
+# On-disk cache of rendered cards; set IMAGE_CACHE_DIR = None to disable
+IMAGE_CACHE_DIR = getattr(config, "IMAGE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "charasearch-cards"))
+IMAGE_CACHE_MAX_BYTES = getattr(config, "IMAGE_CACHE_MAX_BYTES", 2 * 1024**3)
+# Serve the plain image instead of a 404 when a PNG request has no definition in the DB
+IMAGE_RAW_FALLBACK = getattr(config, "IMAGE_RAW_FALLBACK", True)
+
+# Cards are content-addressed (hash + definition in the ETag), clients may
+# reuse them for a while and revalidate cheaply afterwards
+CARD_CACHE_CONTROL = "public, max-age=600"
+# Raw files are named by the hash of their content and never change
+RAW_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# The plain file behind a card URL (IMAGE_RAW_FALLBACK) is only a stand-in until a
+# definition resolves, e.g. after a DB error; clients revalidate it every time
+RAW_FALLBACK_CACHE_CONTROL = "no-cache"
+
+# Content types of sniffed image formats (files on disk have no extension)
+RAW_CONTENT_TYPES = {"png": "image/png", "webp": "image/webp", "jpeg": "image/jpeg", "gif": "image/gif"}
+
+# In-process cache of hash -> definition, plus short-lived "not found" entries
+DEFINITION_CACHE_TTL = getattr(config, "DEFINITION_CACHE_TTL", 600)
+DEFINITION_CACHE_MAX_BYTES = getattr(config, "DEFINITION_CACHE_MAX_BYTES", 64 * 1024**2)
+DEFINITION_NEGATIVE_TTL = getattr(config, "DEFINITION_NEGATIVE_TTL", 30)
+
+# /card/<hash>.png or /card/<hash>.json
+CARD_URL_RE = re.compile(r"^/card/([0-9A-Za-z]+)\.(png|json)$")
+
+# /thumb/<width>/<hash>[.webp|.jpg]
+THUMB_URL_RE = re.compile(r"^/thumb/(\d+)/([0-9A-Za-z]+)(?:\.(webp|jpg))?$")
+# Thumbnails only depend on the (content-addressed) image
+THUMB_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Bulk export of a whole search result (see serve_export)
+EXPORT_PATH = "/export.zip"
+# Rows fetched per round trip from the server-side cursor; also the batch size of the definition lookups
+EXPORT_FETCH_SIZE = getattr(config, "EXPORT_FETCH_SIZE", 500)
+# Upper bound of cards per archive, None = no limit
+EXPORT_MAX_CARDS = getattr(config, "EXPORT_MAX_CARDS", None)
+EXPORT_FORMATS = ("png", "json", "both")
+
+render_cache = RenderCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES) if IMAGE_CACHE_DIR else None
+definition_cache = DefinitionCache(DEFINITION_CACHE_TTL, DEFINITION_CACHE_MAX_BYTES, DEFINITION_NEGATIVE_TTL)
+
 class ImageRequestHandler(http.server.SimpleHTTPRequestHandler):
+    # HTTP/1.1 keeps connections alive between requests, so a result page
+    # reuses a handful of sockets instead of opening one per card.
+    # Every response therefore needs a Content-Length.
+    protocol_version = "HTTP/1.1"
+    # Socket timeout; also closes idle keep-alive connections
+    timeout = IMAGE_SERVER_KEEPALIVE
+
     def __init__(self, *args, **kwargs):
         # We need to pass the directory explicitly to SimpleHTTPRequestHandler
         # But we also intercept requests before they hit the default handler logic for PNGs
         super().__init__(*args, directory=IMAGE_ROOT, **kwargs)
 
+    # --- Metrics (metrics.py) ---
+
+    def setup(self):
+        super().setup()
+        self.wfile = metrics.CountingWriter(self.wfile)
+        self.request_metrics = None
+
+    def parse_request(self):
+        # Starts after the request line arrived, idle keep-alive time does not count
+        self.request_metrics = metrics.RequestMetrics(self.wfile.bytes)
+        metrics.registry.inc("charasearch_http_requests_in_flight")
+        return super().parse_request()
+
+    def handle_one_request(self):
+        try:
+            super().handle_one_request()
+        finally:
+            if self.request_metrics is not None:
+                metrics.registry.inc("charasearch_http_requests_in_flight", -1)
+                self.request_metrics.finish(self.wfile.bytes, self.command, self.path, self.client_address[0])
+                self.request_metrics = None
+
+    def send_response(self, code, message=None):
+        if self.request_metrics is not None:
+            self.request_metrics.status = int(code)
+        super().send_response(code, message)
+
+    def log_request(self, code="-", size="-"):
+        if metrics.ACCESS_LOG_FORMAT == "text":
+            super().log_request(code, size)
+
+    def phase(self, name):
+        """Times a part of the request (resolve, db, render, send) for the phase histogram."""
+        if self.request_metrics is None:
+            return contextlib.nullcontext()
+        return self.request_metrics.phase(name)
+
+    def set_route(self, route):
+        self.request_metrics.route = route
+
     def do_GET(self):
         # Decode path to handle special characters if any
-        path = self.path
+        url = urllib.parse.urlsplit(self.path)
+        path = urllib.parse.unquote(url.path)
+        query = urllib.parse.parse_qs(url.query)
+        download = query.get("download", ["0"])[0] not in ("", "0")
+
+        if path == "/stats":
+            self.set_route("stats")
+            self.serve_stats()
+            return
+
+        if path == "/metrics":
+            self.set_route("metrics")
+            self.serve_metrics()
+            return
+
+        thumb = THUMB_URL_RE.match(path)
+        if thumb:
+            self.set_route("thumb")
+            try:
+                self.serve_thumbnail(thumb.group(2), int(thumb.group(1)), thumb.group(3) or DEFAULT_THUMB_FORMAT)
+            except Exception as e:
+                self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR, f"Error serving thumbnail: {str(e)}")
+            return
+
+        if path == EXPORT_PATH:
+            self.set_route("export")
+            try:
+                export = parse_export_query(query)
+            except ValueError as e:
+                self.send_error(HTTPStatus.BAD_REQUEST, str(e))
+                return
+            self.serve_export(**export)
+            return
+
+        # Download endpoints by hash: /card/<hash>.png and /card/<hash>.json
+        card = CARD_URL_RE.match(path)
+        if card:
+            self.set_route(f"card_{card.group(2)}")
+            try:
+                if card.group(2) == "json":
+                    self.serve_card_json(card.group(1), download)
+                else:
+                    self.serve_card_png(card.group(1), download)
+            except Exception as e:
+                self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR, f"Error serving card: {str(e)}")
+            return
         
         # We only care about PNGs that surely need metadata
         # The URL structure is expected to be: /hashed-data/e/b/0/eb0c83ae....png
         # or simplified versions supported by app.py logic.
         if path.lower().endswith(".png"):
+            self.set_route("image")
             try:
                 self.serve_image_with_metadata(path)
                 return
@@ -41,10 +207,227 @@ class ImageRequestHandler(http.server.SimpleHTTPRequestHandler):
                 self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR, f"Error serving image: {str(e)}")
                 return
 
-        # For non-png or other requests, fall back to default behavior (serving raw files)
-        # However, the user request specifically talked about the "additional webserver" for files.
-        # If we want to be strict, we can keep using default for everything else (e.g. .jpg)
-        return super().do_GET()
+        # Everything else (webp, jpg, ...) is served as is
+        self.set_route("raw")
+        self.serve_raw_path()
+
+    def do_HEAD(self):
+        # Only raw files answer HEAD themselves; cards are rendered on GET
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        if path.lower().endswith(".png") or path in ("/stats", "/metrics", EXPORT_PATH) or path.startswith(("/card/", "/thumb/")):
+            self.send_error(HTTPStatus.METHOD_NOT_ALLOWED)
+            return
+        self.set_route("raw")
+        self.serve_raw_path(head_only=True)
+
+    def serve_raw_path(self, head_only=False):
+        """Raw file for the request path (directories keep the default handling)."""
+        with self.phase("resolve"):
+            full_path = self.translate_path(self.path)
+            is_dir = os.path.isdir(full_path)
+            if not is_dir and not os.path.isfile(full_path):
+                # Files on disk have no extension, the URL may carry one
+                stem = os.path.splitext(full_path)[0]
+                full_path = stem if stem != full_path and os.path.isfile(stem) else None
+        if is_dir:
+            if head_only:
+                return super().do_HEAD()
+            return super().do_GET()
+        if full_path is None:
+            self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+            return
+        self.serve_raw_file(full_path, head_only=head_only)
+
+    def serve_raw_file(self, full_path, head_only=False, cache_control=RAW_CACHE_CONTROL, disposition=None):
+        """Sends a file unchanged via sendfile, with Range, conditional requests and long caching.
+
+        `disposition` is an optional Content-Disposition header (downloads).
+        """
+        try:
+            f = open(full_path, "rb")
+        except OSError:
+            self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+            return
+        with f:
+            st = os.fstat(f.fileno())
+            size = st.st_size
+            etag = f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+            if self.etag_matches(etag) or self.not_modified_since(st.st_mtime):
+                self.send_not_modified(etag, cache_control)
+                return
+
+            byte_range = None
+            if_range = self.headers.get("If-Range")
+            if self.headers.get("Range") and (not if_range or if_range.strip() == etag):
+                try:
+                    byte_range = parse_range(self.headers["Range"], size)
+                except ValueError:
+                    self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                    self.send_header("Content-Range", f"bytes */{size}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+            start, end = byte_range if byte_range else (0, size - 1)
+            length = end - start + 1 if size else 0
+            self.send_response(HTTPStatus.PARTIAL_CONTENT if byte_range else HTTPStatus.OK)
+            self.send_header("Content-type", raw_content_type(full_path, self.guess_type(full_path)))
+            self.send_header("Content-Length", str(length))
+            if byte_range:
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", self.date_time_string(st.st_mtime))
+            self.send_header("Cache-Control", cache_control)
+            if disposition:
+                self.send_header("Content-Disposition", disposition)
+            self.end_headers()
+            if head_only or not length:
+                return
+            self.wfile.flush()
+            # Kernel copies file -> socket (os.sendfile), no Python buffers involved
+            with self.phase("send"):
+                self.wfile.count(self.connection.sendfile(f, start, length))
+
+    def serve_card_png(self, image_hash, download=False):
+        with self.phase("resolve"):
+            full_path, _ = find_image(image_hash)
+        if not full_path:
+            self.send_error(HTTPStatus.NOT_FOUND, "File not found on disk")
+            return
+        # Without a definition the download is the plain image, like app.py's local file before
+        self.serve_card(image_hash, full_path, download, raw_fallback=IMAGE_RAW_FALLBACK)
+
+    def serve_card_json(self, image_hash, download=False):
+        character_data = self.get_character_definition(image_hash)
+        if not character_data:
+            self.send_error(HTTPStatus.NOT_FOUND, f"No character definition found for hash: {image_hash}")
+            return
+
+        etag = f'"{definition_fingerprint(character_data)[:40]}"'
+        if self.etag_matches(etag):
+            self.send_not_modified(etag)
+            return
+        body = json.dumps(character_data, indent=2, ensure_ascii=False).encode("utf-8")
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", CARD_CACHE_CONTROL)
+        if download:
+            self.send_header("Content-Disposition", content_disposition(character_data, image_hash, "json"))
+        self.end_headers()
+        with self.phase("send"):
+            self.wfile.write(body)
+
+    def serve_thumbnail(self, image_hash, width, fmt):
+        """Downscaled WebP/JPEG of the image for the result grid, without embedded definition."""
+        if width not in THUMB_SIZES:
+            self.send_error(HTTPStatus.NOT_FOUND, f"Thumbnail width must be one of {', '.join(map(str, THUMB_SIZES))}")
+            return
+        etag = f'"{thumb_key(image_hash, width, fmt)}"'
+        if self.etag_matches(etag):
+            self.send_not_modified(etag, THUMB_CACHE_CONTROL)
+            return
+        with self.phase("resolve"):
+            full_path, _ = find_image(image_hash)
+        if not full_path:
+            self.send_error(HTTPStatus.NOT_FOUND, "File not found on disk")
+            return
+
+        with self.phase("render"):
+            if thumb_cache:
+                body = cached_thumbnail(image_hash, full_path, width, fmt)
+            else:
+                body = render_thumbnail(full_path, width, fmt)
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-type", THUMB_FORMATS[fmt][1])
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", THUMB_CACHE_CONTROL)
+        self.end_headers()
+        with self.phase("send"):
+            self.wfile.write(body)
+
+    def serve_stats(self):
+        """Cache counters of this process as JSON."""
+        stats = {
+            "pid": os.getpid(),
+            "db_pool": db.get_pool().stats(),
+            "definition_cache": definition_cache.stats(),
+            "render_cache": render_cache.stats() if render_cache else None,
+            "thumb_cache": thumb_cache.stats() if thumb_cache else None,
+        }
+        body = json.dumps(stats, indent=2).encode("utf-8")
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def serve_export(self, search_args, fmt, max_cards=None):
+        """Streams all cards of a search as a ZIP (PNGs with embedded definition and/or JSON).
+
+        Rows come from a server-side cursor in blocks of EXPORT_FETCH_SIZE and
+        the archive is written straight into a chunked response, so memory
+        stays bounded however many cards match (duplicates are dropped in SQL). The size is not known up
+        front, hence no Content-Length; once the headers are out, errors can
+        only be signalled by dropping the connection.
+        """
+        sql, params = search.build_export_query(**search_args)
+        if not sql:
+            self.send_error(HTTPStatus.BAD_REQUEST, "Nothing to export (no sources selected)")
+            return
+
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-type", "application/zip")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("Content-Disposition", 'attachment; filename="charasearch-export.zip"')
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+
+        out = ChunkedWriter(self.wfile)
+        written = skipped = 0
+        try:
+            with db.connection() as conn:
+                with conn.cursor(name="charasearch_export") as rows_cur, conn.cursor() as lookup_cur:
+                    rows_cur.itersize = EXPORT_FETCH_SIZE
+                    rows_cur.execute(sql, params)
+                    with zipfile.ZipFile(out, "w") as zf:
+                        while max_cards is None or written < max_cards:
+                            rows = rows_cur.fetchmany(EXPORT_FETCH_SIZE)
+                            if not rows:
+                                break
+                            # Unique already (see SearchPlan.export_query)
+                            hashes = [h for _, h, _ in rows if h]
+                            with self.phase("db"):
+                                definitions = lookup_definitions(lookup_cur, hashes)
+                            for image_hash in hashes:
+                                if max_cards is not None and written >= max_cards:
+                                    break
+                                character_data = definitions.get(image_hash)
+                                if character_data and write_export_entry(zf, image_hash, character_data, fmt):
+                                    written += 1
+                                else:
+                                    skipped += 1
+            out.close()
+        except Exception as e:
+            # Headers are sent: drop the connection so the client sees a truncated download
+            print(f"Export aborted after {written} cards: {e}")
+            self.close_connection = True
+            return
+        print(f"Export: {written} cards written, {skipped} skipped")
+
+    def serve_metrics(self):
+        """Prometheus text format, summed over all pre-fork workers (metrics.py)."""
+        body = metrics.registry.render().encode("utf-8")
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(body)
 
     def serve_image_with_metadata(self, path):
         # 1. Reconstruct Hash from Path
@@ -59,12 +442,6 @@ class ImageRequestHandler(http.server.SimpleHTTPRequestHandler):
         if clean_path.lower().endswith(".png"):
             clean_path = os.path.splitext(clean_path)[0]
 
-        # Check if file exists on disk first
-        full_path = os.path.join(IMAGE_ROOT, clean_path)
-        if not os.path.exists(full_path):
-            self.send_error(HTTPStatus.NOT_FOUND, "File not found on disk")
-            return
-
         # Try to parse the hash from the path components
         # We assume the standard structure created by the app
         parts = clean_path.split('/')
@@ -76,17 +453,7 @@ class ImageRequestHandler(http.server.SimpleHTTPRequestHandler):
             idx = parts.index("hashed-data")
             # The parts after hashed-data are the sharding + filename
             # /hashed-data/e/b/0/c83ae....png  -> ['e', 'b', '0', 'c83ae....png']
-            # Reconstructing hash: e + b + 0 + stem(c83ae...)
-            
-            # We need at least the filename to get the rest of the hash
-            remainder = parts[idx+1:]
-            if len(remainder) >= 1:
-                filename = remainder[-1]
-                stem = os.path.splitext(filename)[0]
-                
-                # If we have shards (e, b, 0), prepend them
-                shards = remainder[:-1]
-                image_hash = "".join(shards) + stem
+            image_hash = hash_from_rel_path("/".join(parts[idx+1:]))
         else:
             # Fallback: Just take the filename stem if it looks like a hash (32 chars usually)
             filename = parts[-1]
@@ -98,97 +465,487 @@ class ImageRequestHandler(http.server.SimpleHTTPRequestHandler):
             self.send_error(HTTPStatus.BAD_REQUEST, "Could not extract image hash from URL")
             return
 
+        # Resolve the file: manifest lookup first, the URL path otherwise
+        with self.phase("resolve"):
+            full_path = None
+            m = get_manifest()
+            if m:
+                entry = m.lookup(image_hash)
+                if entry:
+                    full_path = entry.path
+            if full_path is None:
+                full_path = os.path.join(IMAGE_ROOT, clean_path)
+                if not os.path.exists(full_path):
+                    full_path = None
+        if full_path is None:
+            self.send_error(HTTPStatus.NOT_FOUND, "File not found on disk")
+            return
+
+        self.serve_card(image_hash, full_path, raw_fallback=IMAGE_RAW_FALLBACK)
+
+    def serve_card(self, image_hash, full_path, download=False, raw_fallback=False):
         # 2. Fetch Metadata from DB
         character_data = self.get_character_definition(image_hash)
         
         if not character_data:
-             self.send_error(HTTPStatus.NOT_FOUND, f"No character definition found for hash: {image_hash}")
-             return
+            if raw_fallback:
+                disposition = None
+                if download:
+                    disposition = content_disposition({}, image_hash, sniff_format(full_path) or "png")
+                self.serve_raw_file(full_path, cache_control=RAW_FALLBACK_CACHE_CONTROL, disposition=disposition)
+                return
+            self.send_error(HTTPStatus.NOT_FOUND, f"No character definition found for hash: {image_hash}")
+            return
+
+        # 3. Embed Metadata and Serve (or answer from the client's / our cache)
+        key = render_key(image_hash, character_data)
+        etag = f'"{key}"'
+        if self.etag_matches(etag):
+            self.send_not_modified(etag)
+            return
 
-        # 3. Embed Metadata and Serve
+        # An open file survives eviction by another worker, a path would not
+        f = render_cache.open(key) if render_cache else None
+        if render_cache and f is None:
+            with self.phase("render"):
+                _, chunks = render_card(full_path, character_data)
+                cached_path = render_cache.put(key, chunks)
+            try:
+                f = open(cached_path, "rb")
+            except FileNotFoundError:
+                # Swept again right away (cache far too small): stream it below
+                pass
+
+        if f is not None:
+            with f:
+                st = os.fstat(f.fileno())
+                if self.not_modified_since(st.st_mtime):
+                    self.send_not_modified(etag)
+                    return
+                self.send_response(HTTPStatus.OK)
+                self.send_header("Content-type", "image/png")
+                self.send_header("Content-Length", str(st.st_size))
+                self.send_header("ETag", etag)
+                self.send_header("Last-Modified", self.date_time_string(st.st_mtime))
+                self.send_header("Cache-Control", CARD_CACHE_CONTROL)
+                if download:
+                    self.send_header("Content-Disposition", content_disposition(character_data, image_hash, "png"))
+                self.end_headers()
+                with self.phase("send"):
+                    shutil.copyfileobj(f, self.wfile)
+            return
+
+        # Cache disabled (or the file is gone): stream straight to the client
+        with self.phase("render"):
+            length, chunks = render_card(full_path, character_data)
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-type", "image/png")
+        self.send_header("Content-Length", str(length))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", CARD_CACHE_CONTROL)
+        if download:
+            self.send_header("Content-Disposition", content_disposition(character_data, image_hash, "png"))
+        self.end_headers()
+        with self.phase("send"):
+            for buf in chunks:
+                self.wfile.write(buf)
+
+    def etag_matches(self, etag):
+        """True if the request's If-None-Match contains etag."""
+        header = self.headers.get("If-None-Match")
+        if not header:
+            return False
+        if header.strip() == "*":
+            return True
+        return etag in [t.strip() for t in header.split(",")]
+
+    def not_modified_since(self, mtime):
+        """If-Modified-Since check, only used when the client sent no If-None-Match."""
+        header = self.headers.get("If-Modified-Since")
+        if not header or self.headers.get("If-None-Match"):
+            return False
         try:
-             # Load Image
-             with Image.open(full_path) as img:
-                 img.load() # Force load image data
-                 
-                 # Create PngInfo for metadata
-                 metadata = PngImagePlugin.PngInfo()
-                 
-                 # Preserve existing textual chunks? Usually we want to OVERWRITE or ADD the CCV2 formatted one.
-                 # Tavern uses 'chara' key with base64 encoded JSON.
-                 
-                 # Prepare the JSON. The DB returns the 'definition' column which is already a dict (jsonb)
-                 json_str = json.dumps(character_data)
-                 b64_data = base64.b64encode(json_str.encode('utf-8')).decode('utf-8')
-                 
-                 metadata.add_text("chara", b64_data)
-                 
-                 # Save to buffer
-                 output = io.BytesIO()
-                 img.save(output, format="PNG", pnginfo=metadata)
-                 output.seek(0)
-                 
-                 # Send Headers
-                 self.send_response(HTTPStatus.OK)
-                 self.send_header("Content-type", "image/png")
-                 self.send_header("Content-Length", str(output.getbuffer().nbytes))
-                 self.end_headers()
-                 
-                 # Send Body
-                 self.wfile.write(output.read())
-                 
-        except Exception as e:
-            raise e # Caught by do_GET
+            since = email.utils.parsedate_to_datetime(header)
+        except (TypeError, ValueError, IndexError, OverflowError):
+            return False
+        if since is None:
+            return False
+        return int(mtime) <= since.timestamp()
+
+    def send_not_modified(self, etag, cache_control=CARD_CACHE_CONTROL):
+        self.send_response(HTTPStatus.NOT_MODIFIED)
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", cache_control)
+        self.end_headers()
 
     def get_character_definition(self, image_hash):
-        """Query the database for the character definition using the image hash."""
-        # We need to check multiple tables as per app.py logic
-        tables = [
-            "chub_character_def", 
-            "risuai_character_def", 
-            "char_tavern_character_def", 
-            "generic_character_def", 
-            "chub_lorebook_def", 
-            "nyaime_character_def", 
-            "webring_character_def"
-        ]
-        
-        # Special case for Booru: it doesn't have a 'definition' column in the same way,
-        # app.py constructs it. We might skip booru for embedding or handle it separately.
-        # User asked for "JSON, was sie erst als Charakterdaten verwendbar macht".
-        # Booru data might not be enough for full card import, but let's check standard tables first.
-        
-        conn = None
+        """Definition for the image hash, served from definition_cache when possible."""
+        cached = definition_cache.get(image_hash)
+        if cached is not MISS:
+            return cached
+
         try:
-            conn = psycopg2.connect(**DB_CONFIG)
-            cur = conn.cursor()
-            
-            # Try efficient union or sequential check. Since hash is indexed (likely unique image), 
-            # we can try to find it in any table.
-            
-            # We select 'definition' column.
-            for table in tables:
-                sql = f"SELECT definition FROM {table} WHERE image_hash = %s LIMIT 1"
-                cur.execute(sql, (image_hash,))
-                row = cur.fetchone()
-                if row:
-                    return row[0] # Return the definition dict
-            
-            # If not found in main tables, check booru
-            # Booru table: booru_character_def (columns: name, summary, tags, etc.)
-            # app.py constructs a fake definition for it.
-            # We can skip expensive construction unless requested, but let's stick to the main ones first.
-            
-            return None
-            
+            with self.phase("db"):
+                definition = query_character_definition(image_hash)
         except Exception as e:
+            # Not cached, the next request retries
             print(f"DB Error: {e}")
             return None
+        definition_cache.put(image_hash, definition)
+        return definition
+
+# Tables with a 'definition' column, in lookup priority order
+DEFINITION_TABLES = [
+    ("chub", "chub_character_def"),
+    ("risuai", "risuai_character_def"),
+    ("char_tavern", "char_tavern_character_def"),
+    ("generic", "generic_character_def"),
+    ("chub_lorebook", "chub_lorebook_def"),
+    ("nyaime", "nyaime_character_def"),
+    ("webring", "webring_character_def"),
+]
+
+# Booru has no 'definition' column, build a minimal V2 card from its columns
+BOORU_DEFINITION_SQL = """jsonb_build_object(
+    'spec', 'chara_card_v2', 'spec_version', '2.0',
+    'data', jsonb_build_object(
+        'name', name, 'description', COALESCE(summary, ''), 'creator', COALESCE(author, ''),
+        'creator_notes', COALESCE(tagline, ''), 'tags', COALESCE(to_jsonb(tags), '[]'::jsonb),
+        'personality', '', 'scenario', '', 'first_mes', '', 'mes_example', ''))"""
+
+def _build_definition_lookup_sql():
+    # One indexed probe per table, all in a single statement. The priority
+    # column keeps the old "first table wins" order for duplicate hashes.
+    branches = [
+        f"(SELECT {prio} AS prio, '{src}' AS src, definition FROM {table} WHERE image_hash = %(hash)s LIMIT 1)"
+        for prio, (src, table) in enumerate(DEFINITION_TABLES)
+    ]
+    branches.append(
+        f"(SELECT {len(DEFINITION_TABLES)} AS prio, 'booru' AS src, {BOORU_DEFINITION_SQL} AS definition "
+        f"FROM booru_character_def WHERE image_hash = %(hash)s LIMIT 1)"
+    )
+    return "SELECT src, definition FROM (" + " UNION ALL ".join(branches) + ") AS found ORDER BY prio LIMIT 1"
+
+DEFINITION_LOOKUP_SQL = _build_definition_lookup_sql()
+
+def lookup_definition(cur, image_hash):
+    """Resolves a hash to (source, definition) in one round trip, or None."""
+    cur.execute(DEFINITION_LOOKUP_SQL, {"hash": image_hash})
+    return cur.fetchone()
+
+def _build_definitions_lookup_sql():
+    # Batched variant of DEFINITION_LOOKUP_SQL: same priority, one row per hash
+    branches = [
+        f"SELECT {prio} AS prio, image_hash, definition FROM {table} WHERE image_hash = ANY(%(hashes)s)"
+        for prio, (_, table) in enumerate(DEFINITION_TABLES)
+    ]
+    branches.append(
+        f"SELECT {len(DEFINITION_TABLES)} AS prio, image_hash, {BOORU_DEFINITION_SQL} AS definition "
+        f"FROM booru_character_def WHERE image_hash = ANY(%(hashes)s)"
+    )
+    return ("SELECT DISTINCT ON (image_hash) image_hash, definition FROM (" + " UNION ALL ".join(branches) + ") AS found "
+            "ORDER BY image_hash, prio")
+
+DEFINITIONS_LOOKUP_SQL = _build_definitions_lookup_sql()
+
+def lookup_definitions(cur, hashes):
+    """Resolves many hashes at once -> {image_hash: definition} (missing hashes are left out)."""
+    if not hashes:
+        return {}
+    cur.execute(DEFINITIONS_LOOKUP_SQL, {"hashes": list(hashes)})
+    return {image_hash: definition for image_hash, definition in cur.fetchall() if definition}
+
+def query_character_definition(image_hash):
+    """Query the database for the character definition using the image hash."""
+    with db.connection() as conn:
+        with conn.cursor() as cur:
+            row = lookup_definition(cur, image_hash)
+    return row[1] if row else None
+
+def card_filename_stem(character_data, image_hash):
+    """File name (without extension) for a card: the character name, made safe for file systems."""
+    data = character_data.get("data") if isinstance(character_data.get("data"), dict) else character_data
+    name = data.get("name") or character_data.get("name") or image_hash
+    return re.sub(r'[\\/:*?"<>|\x00-\x1f]+', "_", str(name)).strip(" .") or image_hash
+
+def parse_range(header, size):
+    """Single byte range of a Range header -> (start, end) inclusive, or None to send the whole file.
+
+    Multiple ranges and malformed headers are ignored (RFC 9110 allows that);
+    ValueError means the range is not satisfiable (416).
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, sep, last = (part.strip() for part in spec.partition("-"))
+    if not sep or not (first or last) or not (first + last).isdigit():
+        return None
+    if size == 0:
+        raise ValueError("Empty file")
+    if not first:
+        # Suffix range: the last N bytes
+        if int(last) == 0:
+            raise ValueError("Empty suffix range")
+        return max(size - int(last), 0), size - 1
+    start = int(first)
+    end = int(last) if last else size - 1
+    if start >= size:
+        raise ValueError("Range starts after the end of the file")
+    if end < start:
+        return None
+    return start, min(end, size - 1)
+
+def raw_content_type(path, guessed):
+    """Content type from the file's magic bytes when the extension says nothing."""
+    if guessed != "application/octet-stream":
+        return guessed
+    return RAW_CONTENT_TYPES.get(sniff_format(path), guessed)
+
+def content_disposition(character_data, image_hash, ext):
+    """Attachment header named after the character (ASCII fallback + RFC 5987 UTF-8 name)."""
+    filename = f"{card_filename_stem(character_data, image_hash)}.{ext}"
+    fallback = filename.encode("ascii", "replace").decode("ascii").replace("?", "_")
+    return f'attachment; filename="{fallback}"; filename*=UTF-8\'\'{urllib.parse.quote(filename)}'
+
+def render_card(full_path, character_data):
+    """Embeds the definition into the image as a Tavern 'chara' chunk.
+
+    Returns (content_length, iterable of byte chunks) of the resulting PNG.
+    """
+    # Tavern uses the 'chara' key with base64 encoded JSON.
+    # The DB returns the 'definition' column which is already a dict (jsonb)
+    json_str = json.dumps(character_data)
+    b64_data = base64.b64encode(json_str.encode('utf-8')).decode('utf-8')
+
+    if is_png(full_path):
+        # Splice the chunk into the original bytes, no decode/re-encode
+        splice = PngTextSplice(full_path, "chara", b64_data)
+        return splice.content_length, splice.iter_bytes()
+
+    # Other formats (webp, jpg, ...) have to be converted to PNG
+    with Image.open(full_path) as img:
+        img.load() # Force load image data
+
+        metadata = PngImagePlugin.PngInfo()
+        metadata.add_text("chara", b64_data)
+
+        # Save to buffer
+        output = io.BytesIO()
+        img.save(output, format="PNG", pnginfo=metadata)
+        body = output.getvalue()
+    return len(body), [body]
+
+def parse_export_query(query):
+    """Search parameters of /export.zip -> keyword arguments of serve_export.
+
+    Same settings as the app's sidebar: source and field (repeatable), q,
+    min_tokens, max_tokens, unlimited, sort, mode (ilike/fts) and format
+    (png/json/both), optionally limit. Raises ValueError on invalid input.
+    """
+    def one(name, default=None):
+        return query.get(name, [default])[0]
+
+    sources = [s for s in query.get("source", []) if s in search.SOURCES]
+    fields = [f for f in query.get("field", []) if f in search.FIELD_EXPRESSIONS]
+    search_query = (one("q") or "").strip()
+    if not sources or not fields or not search_query:
+        raise ValueError("source, field and q are required")
+
+    fmt = one("format", "png")
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"format must be one of {', '.join(EXPORT_FORMATS)}")
+    mode = one("mode", "ilike")
+    if mode not in search.SEARCH_MODES.values():
+        raise ValueError(f"Unknown search mode: {mode}")
+    sort_option = one("sort", search.DEFAULT_SORT)
+    if sort_option not in search.SORT_OPTIONS:
+        raise ValueError(f"Unknown sort option: {sort_option}")
+
+    try:
+        token_range = [int(one("min_tokens", 0)), int(one("max_tokens", 16000))]
+        limit = int(one("limit")) if one("limit") else None
+    except ValueError:
+        raise ValueError("min_tokens, max_tokens and limit must be integers")
+    if EXPORT_MAX_CARDS is not None:
+        limit = min(limit, EXPORT_MAX_CARDS) if limit is not None else EXPORT_MAX_CARDS
+
+    return {
+        "search_args": {
+            "selected_sources": sources,
+            "selected_fields": fields,
+            "search_query": search_query,
+            "token_range": token_range,
+            "unlimited_tokens": one("unlimited", "0") not in ("", "0"),
+            "sort_option": sort_option,
+            "mode": mode,
+        },
+        "fmt": fmt,
+        "max_cards": limit,
+    }
+
+def write_export_entry(zf, image_hash, character_data, fmt):
+    """Adds one card to the export archive; False if there was nothing to write."""
+    stem = card_filename_stem(character_data, image_hash)
+    if stem != image_hash:
+        # Names are not unique
+        stem += f"_{image_hash[:8]}"
+    date_time = time.localtime()[:6]
+    wrote = False
+
+    if fmt in ("png", "both"):
+        full_path, _ = find_image(image_hash)
+        if full_path:
+            # PNGs are compressed already, store them as they are
+            info = zipfile.ZipInfo(f"{stem}.png", date_time=date_time)
+            info.compress_type = zipfile.ZIP_STORED
+            # Reuse a rendered file if there is one, but do not flood the
+            # render cache with the whole export
+            cached = render_cache.open(render_key(image_hash, character_data)) if render_cache else None
+            with zf.open(info, "w") as entry:
+                if cached:
+                    with cached:
+                        shutil.copyfileobj(cached, entry, COPY_BUFSIZE)
+                else:
+                    _, chunks = render_card(full_path, character_data)
+                    for buf in chunks:
+                        entry.write(buf)
+            wrote = True
+
+    if fmt in ("json", "both"):
+        info = zipfile.ZipInfo(f"{stem}.json", date_time=date_time)
+        info.compress_type = zipfile.ZIP_DEFLATED
+        zf.writestr(info, json.dumps(character_data, indent=2, ensure_ascii=False).encode("utf-8"))
+        wrote = True
+    return wrote
+
+class ChunkedWriter:
+    """Write-only file object that sends its data as HTTP/1.1 chunked transfer encoding.
+
+    Small writes (zip headers) are collected up to bufsize per chunk. There
+    is no tell()/seek(), so zipfile treats it as an unseekable stream and
+    writes data descriptors instead of patching local headers.
+    """
+
+    def __init__(self, wfile, bufsize=COPY_BUFSIZE):
+        self.wfile = wfile
+        self.bufsize = bufsize
+        self._buf = bytearray()
+
+    def write(self, data):
+        self._buf += data
+        if len(self._buf) >= self.bufsize:
+            self._send()
+        return len(data)
+
+    def _send(self):
+        if self._buf:
+            self.wfile.write(b"%x\r\n" % len(self._buf) + self._buf + b"\r\n")
+            self._buf = bytearray()
+
+    def flush(self):
+        self._send()
+        self.wfile.flush()
+
+    def close(self):
+        """Sends the rest and the terminating zero-length chunk."""
+        self._send()
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+class ImageHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """HTTP server that handles each connection on a bounded worker pool.
+
+    A slow PNG only blocks its own worker. Once all workers are busy the
+    accept loop waits for a free slot, so excess connections queue up in
+    the kernel backlog instead of spawning unbounded threads.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class, max_workers=None, reuse_port=False, bind_and_activate=True):
+        self.max_workers = max_workers or IMAGE_SERVER_WORKERS
+        max_workers = self.max_workers
+        self.reuse_port = reuse_port
+        # Liveness of the accept loop for the pre-fork supervisor (see responsive)
+        self._last_tick = time.monotonic()
+        self._waiting_for_slot = False
+        self._slots = threading.BoundedSemaphore(max_workers)
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="image-server")
+        super().__init__(server_address, handler_class, bind_and_activate)
+
+    def server_bind(self):
+        if self.reuse_port:
+            # Several processes bind the same port, the kernel balances connections between them
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def service_actions(self):
+        # Called by serve_forever() after every request and poll timeout
+        self._last_tick = time.monotonic()
+        metrics.registry.flush()
+
+    def responsive(self, timeout):
+        """True unless the accept loop made no progress for `timeout` seconds.
+
+        Waiting for a free slot does not count as hanging: idle keep-alive
+        connections and long exports can hold every slot of a healthy server.
+        """
+        return self._waiting_for_slot or time.monotonic() - self._last_tick < timeout
+
+    def process_request(self, request, client_address):
+        self._waiting_for_slot = True
+        try:
+            self._slots.acquire()
+        finally:
+            self._waiting_for_slot = False
+            self._last_tick = time.monotonic()
+        try:
+            self._pool.submit(self._process_request_slot, request, client_address)
+        except RuntimeError:
+            # Pool already shut down
+            self._slots.release()
+            self.shutdown_request(request)
+
+    def _process_request_slot(self, request, client_address):
+        try:
+            self.process_request_thread(request, client_address)
         finally:
-            if conn: conn.close()
-            
-def start_image_server(root_path, port=8505):
-    """Starts the background server."""
+            self._slots.release()
+
+    def server_close(self):
+        super().server_close()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+def collect_cache_metrics():
+    """Cache and DB pool counters of this process for /metrics."""
+    caches = [("definition", definition_cache), ("render", render_cache), ("thumb", thumb_cache)]
+    for name, cache in caches:
+        if cache is None:
+            continue
+        stats = cache.stats()
+        yield "charasearch_cache_hits_total", {"cache": name}, stats["hits"] + stats.get("negative_hits", 0)
+        yield "charasearch_cache_misses_total", {"cache": name}, stats["misses"]
+        if isinstance(cache, RenderCache):
+            yield "charasearch_disk_cache_bytes", {"cache": name}, stats["bytes"]
+        else:
+            yield "charasearch_cache_bytes", {"cache": name}, stats["bytes"]
+        if "evictions" in stats:
+            yield "charasearch_cache_evictions_total", {"cache": name}, stats["evictions"]
+    pool = db.get_pool().stats()
+    yield "charasearch_db_pool_connections", {"state": "in_use"}, pool["in_use"]
+    yield "charasearch_db_pool_connections", {"state": "idle"}, pool["idle"]
+    yield "charasearch_db_pool_waits_total", {}, pool["waits"]
+    yield "charasearch_db_pool_timeouts_total", {}, pool["timeouts"]
+
+metrics.registry.add_collector(collect_cache_metrics)
+
+# Only one server per process, even though Streamlit re-runs app.py on every interaction
+_server = None
+_server_lock = threading.Lock()
+
+def get_base_host(port=8505):
+    """External base URL of the image server (EXTERNAL_URL or local IP)."""
     
     # helper to find IP similar to app.py
     external_url = os.environ.get("EXTERNAL_URL")
@@ -203,16 +960,212 @@ def start_image_server(root_path, port=8505):
         except:
             local_ip = "localhost"
         base_host = f"http://{local_ip}:{port}"
+    return base_host
+
+def start_image_server(root_path, port=8505, max_workers=None):
+    """Starts the background server (once per process)."""
+    global _server
+
+    base_host = get_base_host(port)
+    if not IMAGE_SERVER_EMBEDDED:
+        # Served by the standalone process
+        return base_host
 
-    def run_server():
-        # Allow reuse address to prevent "Address already in use" on restarts
-        socketserver.TCPServer.allow_reuse_address = True
-        with socketserver.TCPServer(("", port), ImageRequestHandler) as httpd:
-            print(f"Image Server serving at port {port}")
-            httpd.serve_forever()
+    with _server_lock:
+        if _server is None:
+            try:
+                _server = ImageHTTPServer(("", port), ImageRequestHandler, max_workers=max_workers)
+            except OSError as e:
+                # Port taken, e.g. by a standalone image server
+                print(f"Image Server could not bind port {port}: {e}")
+                return base_host
 
-    # Daemon thread so it dies when main app dies
-    thread = threading.Thread(target=run_server, daemon=True)
-    thread.start()
+            print(f"Image Server serving at port {port} ({_server.max_workers} workers)")
+            # Daemon thread so it dies when main app dies
+            thread = threading.Thread(target=_server.serve_forever, daemon=True)
+            thread.start()
     
     return base_host
+
+
+# --- PRE-FORK MODE ---
+
+def _run_worker(port, max_workers, slot, heartbeats, listen_socket=None):
+    """Body of a pre-fork worker process. Never returns."""
+    # The parent's handlers are inherited through fork(); reset them
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    if listen_socket is None:
+        httpd = ImageHTTPServer(("", port), ImageRequestHandler, max_workers=max_workers, reuse_port=True)
+    else:
+        # Fallback without SO_REUSEPORT: accept on the socket bound by the parent
+        httpd = ImageHTTPServer(("", port), ImageRequestHandler, max_workers=max_workers, bind_and_activate=False)
+        httpd.socket.close()
+        httpd.socket = listen_socket
+        httpd.server_address = listen_socket.getsockname()
+        httpd.server_name = socket.getfqdn(httpd.server_address[0])
+        httpd.server_port = httpd.server_address[1]
+
+    stopped = threading.Event()
+
+    def heartbeat():
+        # Own thread: beats as long as the accept loop is alive, even while it waits for a free slot
+        while not stopped.is_set():
+            if httpd.responsive(IMAGE_SERVER_HEARTBEAT_TIMEOUT / 2):
+                heartbeats[slot] = time.time()
+            metrics.registry.flush()
+            stopped.wait(1)
+
+    def stop(signum, frame):
+        # shutdown() blocks until serve_forever() returns, so call it from another thread
+        threading.Thread(target=httpd.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    heartbeats[slot] = time.time()
+    threading.Thread(target=heartbeat, daemon=True, name="heartbeat").start()
+    code = 0
+    try:
+        httpd.serve_forever()
+    except Exception as e:
+        print(f"Image Server worker {os.getpid()} crashed: {e}")
+        code = 1
+    finally:
+        stopped.set()
+        httpd.server_close()
+        metrics.registry.flush(force=True)
+    os._exit(code)
+
+def serve_prefork(port=8505, processes=None, max_workers=None):
+    """Runs `processes` worker processes that share `port` and supervises them.
+
+    Each worker is a full ImageHTTPServer with its own thread pool, so the
+    CPU-bound Pillow work scales past the GIL. With SO_REUSEPORT (Linux)
+    every worker binds the port itself and the kernel spreads connections
+    evenly; elsewhere the workers inherit one socket bound by the parent.
+
+    The parent restarts workers that exit or that stopped sending heartbeats
+    for IMAGE_SERVER_HEARTBEAT_TIMEOUT seconds. A worker's heartbeat thread
+    keeps beating while its accept loop runs or waits for a free slot. Workers
+    that die right after starting are restarted with an increasing delay.
+    """
+    if not hasattr(os, "fork"):
+        raise RuntimeError("Pre-fork mode needs os.fork(); run with --processes 1 on this platform")
+
+    processes = processes or os.cpu_count() or 1
+    # Workers share their metrics through snapshot files
+    metrics.init_shared_dir()
+    heartbeats = multiprocessing.Array("d", processes, lock=False)
+
+    listen_socket = None
+    if not hasattr(socket, "SO_REUSEPORT"):
+        listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listen_socket.bind(("", port))
+        listen_socket.listen(ImageHTTPServer.request_queue_size)
+
+    workers = {}  # pid -> slot
+    started = [0.0] * processes
+    backoff = [0.0] * processes
+
+    def spawn(slot):
+        heartbeats[slot] = time.time()
+        pid = os.fork()
+        if pid == 0:
+            _run_worker(port, max_workers, slot, heartbeats, listen_socket)
+        workers[pid] = slot
+        started[slot] = time.time()
+
+    running = True
+
+    def stop(signum, frame):
+        nonlocal running
+        running = False
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for slot in range(processes):
+        spawn(slot)
+    print(f"Image Server serving at port {port} ({processes} processes x {max_workers or IMAGE_SERVER_WORKERS} workers)")
+
+    pending = []  # (respawn_at, slot)
+    while running:
+        time.sleep(1)
+        now = time.time()
+
+        # Reap dead workers
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            slot = workers.pop(pid, None)
+            if slot is None:
+                continue
+            print(f"Image Server worker {pid} exited (status {status}), restarting")
+            if now - started[slot] < 5:
+                backoff[slot] = min(max(backoff[slot] * 2, 1.0), 30.0)
+            else:
+                backoff[slot] = 0.0
+            pending.append((now + backoff[slot], slot))
+
+        # Kill hung workers, they get restarted once reaped
+        for pid, slot in list(workers.items()):
+            if now - heartbeats[slot] > IMAGE_SERVER_HEARTBEAT_TIMEOUT:
+                print(f"Image Server worker {pid} missed its heartbeat, killing it")
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                # Avoid killing it again before it is reaped
+                heartbeats[slot] = now
+
+        for item in [p for p in pending if p[0] <= now]:
+            pending.remove(item)
+            spawn(item[1])
+
+    # Graceful shutdown
+    for pid in workers:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    deadline = time.time() + 10
+    while workers and time.time() < deadline:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid == 0:
+            time.sleep(0.1)
+            continue
+        workers.pop(pid, None)
+    for pid in workers:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+def main():
+    parser = argparse.ArgumentParser(description="Standalone image server for the character archive.")
+    parser.add_argument("--port", type=int, default=8505)
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1,
+                        help="Worker processes (default: number of cores)")
+    parser.add_argument("--workers", type=int, default=IMAGE_SERVER_WORKERS,
+                        help="Concurrent connections per process")
+    args = parser.parse_args()
+
+    if args.processes > 1:
+        serve_prefork(args.port, args.processes, args.workers)
+    else:
+        with ImageHTTPServer(("", args.port), ImageRequestHandler, max_workers=args.workers) as httpd:
+            print(f"Image Server serving at port {args.port} ({httpd.max_workers} workers)")
+            try:
+                httpd.serve_forever()
+            except KeyboardInterrupt:
+                pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,334 @@
+"""Manifest of the image files under IMAGE_ROOT/hashed-data.
+
+Instead of probing every sharding layout and extension with os.path.exists
+for each card, the files are scanned once into a small SQLite file and
+looked up by hash afterwards. Re-running the scanner only re-lists
+directories whose mtime changed.
+
+Usage:
+    python manifest.py               # incremental scan
+    python manifest.py --full        # rescan everything
+    python manifest.py --workers 32
+"""
+import argparse
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+try:
+    import config
+    IMAGE_ROOT = config.IMAGE_ROOT
+except ImportError:
+    config = None
+    IMAGE_ROOT = "."
+
+MANIFEST_PATH = getattr(config, "MANIFEST_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "manifest.sqlite"))
+
+DATA_DIR = "hashed-data"
+
+# Real hashes are at least this long (md5)
+MIN_HASH_LEN = 32
+
+IMAGE_EXTENSIONS = (".png", ".webp", ".jpg", ".jpeg")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    hash TEXT PRIMARY KEY,
+    rel_path TEXT NOT NULL,
+    dir TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    format TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS images_dir ON images (dir);
+CREATE TABLE IF NOT EXISTS dirs (
+    rel_dir TEXT PRIMARY KEY,
+    mtime REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+ManifestEntry = namedtuple("ManifestEntry", "hash path rel_path size mtime format")
+
+HEX_DIGITS = frozenset("0123456789abcdefABCDEF")
+
+def looks_like_hash(text):
+    return len(text) >= MIN_HASH_LEN and all(c in HEX_DIGITS for c in text)
+
+def hash_from_parts(dirs, stem):
+    """Image hash for a file at hashed-data/<dirs...>/<stem>[.ext].
+
+    Handles all layouts app.py knows: split filename sharding (e/b/0/c83a...),
+    nested or simple sharding where the file name is the full hash (e/b/eb0c...,
+    e/eb0c...), flat files and hash-named directories holding an image
+    somewhere below them, themselves sharded or split (e/b/0/c83a.../img.png).
+    """
+    for i, name in enumerate(dirs):
+        if len(name) >= MIN_HASH_LEN or looks_like_hash("".join(dirs[:i + 1])):
+            # Deep layout: the directory is named after the hash
+            return hash_from_parts(dirs[:i], name)
+    prefix = "".join(dirs)
+    if len(stem) >= MIN_HASH_LEN and stem.startswith(prefix):
+        return stem
+    return prefix + stem
+
+def hash_from_rel_path(rel_path):
+    """Image hash for a path relative to hashed-data (with or without extension)."""
+    parts = [p for p in rel_path.replace("\\", "/").split("/") if p]
+    if not parts:
+        return None
+    stem, ext = os.path.splitext(parts[-1])
+    if ext.lower() not in IMAGE_EXTENSIONS:
+        stem = parts[-1]
+    return hash_from_parts(parts[:-1], stem) or None
+
+def sniff_format(path):
+    """Image format from the file's magic bytes (files on disk have no extension)."""
+    try:
+        with open(path, "rb") as f:
+            head = f.read(12)
+    except OSError:
+        return None
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if head[:4] == b"GIF8":
+        return "gif"
+    return "bin"
+
+def _list_dir(abs_dir, stat_files):
+    """Runs on a worker thread: (dir mtime, subdirectory names, file records)."""
+    dir_mtime = os.stat(abs_dir).st_mtime
+    subdirs = []
+    files = []
+    with os.scandir(abs_dir) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.name)
+            elif stat_files and entry.is_file():
+                st = entry.stat()
+                files.append((entry.name, st.st_size, st.st_mtime, sniff_format(entry.path) or "bin"))
+    return dir_mtime, subdirs, files
+
+def scan(image_root=IMAGE_ROOT, manifest_path=MANIFEST_PATH, workers=16, full=False):
+    """Builds or updates the manifest. Returns counters for reporting."""
+    data_root = os.path.join(image_root, DATA_DIR)
+    db = sqlite3.connect(manifest_path)
+    db.executescript(SCHEMA)
+    if full:
+        db.execute("DELETE FROM images")
+        db.execute("DELETE FROM dirs")
+    known_dirs = dict(db.execute("SELECT rel_dir, mtime FROM dirs"))
+    seen_dirs = set()
+    counters = {"dirs": 0, "changed_dirs": 0, "files": 0, "removed_dirs": 0}
+
+    def submit(pool, rel_dir):
+        # Unchanged directories are still listed (for their subdirectories),
+        # but their files are neither stat'ed nor sniffed
+        abs_dir = os.path.join(data_root, rel_dir) if rel_dir else data_root
+        try:
+            mtime = os.stat(abs_dir).st_mtime
+        except FileNotFoundError:
+            return None
+        changed = known_dirs.get(rel_dir) != mtime
+        return pool.submit(_list_dir, abs_dir, changed), rel_dir, changed
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+        first = submit(pool, "")
+        if first:
+            pending[first[0]] = first[1:]
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                rel_dir, changed = pending.pop(fut)
+                try:
+                    dir_mtime, subdirs, files = fut.result()
+                except FileNotFoundError:
+                    continue
+                seen_dirs.add(rel_dir)
+                counters["dirs"] += 1
+                for name in subdirs:
+                    item = submit(pool, f"{rel_dir}/{name}" if rel_dir else name)
+                    if item:
+                        pending[item[0]] = item[1:]
+                if not changed:
+                    continue
+
+                counters["changed_dirs"] += 1
+                dirs = rel_dir.split("/") if rel_dir else []
+                rows = []
+                for name, size, mtime, fmt in files:
+                    stem, ext = os.path.splitext(name)
+                    if ext.lower() not in IMAGE_EXTENSIONS:
+                        if ext:
+                            # Not an image (and not an extensionless hash file)
+                            continue
+                        stem = name
+                    image_hash = hash_from_parts(dirs, stem)
+                    rel_path = f"{rel_dir}/{name}" if rel_dir else name
+                    rows.append((image_hash, rel_path, rel_dir, size, mtime, fmt))
+                with db:
+                    db.execute("DELETE FROM images WHERE dir = ?", (rel_dir,))
+                    # First file wins when several layouts hold the same hash
+                    db.executemany("INSERT OR IGNORE INTO images VALUES (?, ?, ?, ?, ?, ?)", rows)
+                    db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?)", (rel_dir, dir_mtime))
+                counters["files"] += len(rows)
+
+    removed = [d for d in known_dirs if d not in seen_dirs]
+    with db:
+        for rel_dir in removed:
+            db.execute("DELETE FROM images WHERE dir = ?", (rel_dir,))
+            db.execute("DELETE FROM dirs WHERE rel_dir = ?", (rel_dir,))
+    counters["removed_dirs"] = len(removed)
+    counters["total_files"] = db.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+    db.close()
+    return counters
+
+class Manifest:
+    """Read-only view on the manifest; one SQLite connection per thread."""
+
+    def __init__(self, manifest_path=MANIFEST_PATH, image_root=IMAGE_ROOT):
+        self.manifest_path = manifest_path
+        self.data_root = os.path.join(image_root, DATA_DIR)
+        self._local = threading.local()
+
+    def _db(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            uri = "file:" + os.path.abspath(self.manifest_path) + "?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            conn.execute("PRAGMA mmap_size = 268435456")
+            self._local.conn = conn
+        return conn
+
+    def _entry(self, row):
+        image_hash, rel_path, size, mtime, fmt = row
+        return ManifestEntry(image_hash, os.path.join(self.data_root, rel_path), rel_path, size, mtime, fmt)
+
+    def lookup(self, image_hash):
+        row = self._db().execute(
+            "SELECT hash, rel_path, size, mtime, format FROM images WHERE hash = ?", (image_hash,)
+        ).fetchone()
+        return self._entry(row) if row else None
+
+    def lookup_many(self, hashes):
+        """dict hash -> ManifestEntry for all hashes that are in the manifest."""
+        hashes = list(hashes)
+        found = {}
+        for i in range(0, len(hashes), 500):
+            chunk = hashes[i:i + 500]
+            marks = ",".join("?" * len(chunk))
+            for row in self._db().execute(
+                f"SELECT hash, rel_path, size, mtime, format FROM images WHERE hash IN ({marks})", chunk
+            ):
+                found[row[0]] = self._entry(row)
+        return found
+
+    def entries(self, batch=1000):
+        """All ManifestEntry rows, read in batches."""
+        cur = self._db().execute("SELECT hash, rel_path, size, mtime, format FROM images")
+        while True:
+            rows = cur.fetchmany(batch)
+            if not rows:
+                return
+            for row in rows:
+                yield self._entry(row)
+
+_manifest = None
+_manifest_checked = 0.0
+_manifest_lock = threading.Lock()
+
+def get_manifest():
+    """The shared Manifest, or None while no manifest file exists (re-checked every minute)."""
+    global _manifest, _manifest_checked
+    with _manifest_lock:
+        if _manifest is None and time.monotonic() - _manifest_checked > 60:
+            _manifest_checked = time.monotonic()
+            if os.path.exists(MANIFEST_PATH):
+                _manifest = Manifest()
+        return _manifest
+
+def find_image(image_hash, debug=False):
+    """Path of the image for a hash plus the candidates checked (for debugging).
+
+    Uses the manifest when available and falls back to probing every
+    sharding layout (and a recursive search in hash-named directories).
+    """
+    if not image_hash: return None, []
+
+    # Fast path: one primary key lookup instead of up to 20 stat() calls
+    m = get_manifest()
+    if m:
+        entry = m.lookup(image_hash)
+        if entry:
+            return entry.path, [f"[MANIFEST] {entry.rel_path}"]
+    
+    extensions = [".png", ".webp", ".jpg", ".jpeg", ""]
+    candidates = []
+    
+    # Paths to check
+    checks = []
+    
+    # 0. User Specific: Split Filename Sharding (hashed-data/a/b/c/defg...)
+    # Hash: 2b2b9b... -> Path: hashed-data/2/b/2/b9b...
+    if len(image_hash) > 3:
+        checks.append(os.path.join(IMAGE_ROOT, DATA_DIR, image_hash[0], image_hash[1], image_hash[2], image_hash[3:]))
+
+    # 1. Nested Sharding (hashed-data/a/b/abcde...)
+    if len(image_hash) >= 2:
+        checks.append(os.path.join(IMAGE_ROOT, DATA_DIR, image_hash[0], image_hash[1], image_hash))
+
+    # 2. Simple Sharding (hashed-data/a/abcde...)
+    if len(image_hash) >= 1:
+        checks.append(os.path.join(IMAGE_ROOT, DATA_DIR, image_hash[0], image_hash))
+        
+    # 3. Flat (hashed-data/abcde...)
+    checks.append(os.path.join(IMAGE_ROOT, DATA_DIR, image_hash))
+    
+    # Generate Candidate List (with Exts) for Debugging
+    for c in checks:
+        for ext in extensions:
+            candidates.append(c + ext)
+            
+    # Real Search
+    for path_base in checks:
+        # Check Direct File + Ext
+        for ext in extensions:
+            p = path_base + ext
+            if os.path.exists(p) and os.path.isfile(p):
+                return p, candidates
+
+        # Check Directory (Deep Search) - Fallback
+        if os.path.exists(path_base) and os.path.isdir(path_base):
+            if debug: candidates.append(f"[DIR FOUND] {path_base} -> Scanning...")
+            for root, _, files in os.walk(path_base):
+                for f in files:
+                    if f.lower().endswith(IMAGE_EXTENSIONS):
+                        found = os.path.join(root, f)
+                        if debug: candidates.append(f"[DEEP MATCH] {found}")
+                        return found, candidates
+            
+    return None, candidates
+
+def main():
+    parser = argparse.ArgumentParser(description="Scan IMAGE_ROOT/hashed-data into the image manifest.")
+    parser.add_argument("--root", default=IMAGE_ROOT, help="Image root (default: IMAGE_ROOT from config.py)")
+    parser.add_argument("--manifest", default=MANIFEST_PATH, help="Manifest file")
+    parser.add_argument("--workers", type=int, default=16, help="Parallel directory listers")
+    parser.add_argument("--full", action="store_true", help="Ignore directory mtimes and rescan everything")
+    args = parser.parse_args()
+
+    start = time.time()
+    counters = scan(args.root, args.manifest, workers=args.workers, full=args.full)
+    print(f"Scanned {counters['dirs']} dirs ({counters['changed_dirs']} changed, "
+          f"{counters['removed_dirs']} removed), indexed {counters['files']} files, "
+          f"{counters['total_files']} in manifest, {time.time() - start:.1f}s")
+
+if __name__ == "__main__":
+    main()
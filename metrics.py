@@ -0,0 +1,279 @@
+"""Prometheus metrics and access logs for the image server.
+
+There is no client library dependency: counters, gauges and histograms live
+in a small thread-safe Registry and are rendered in the text exposition
+format on /metrics.
+
+Every process has its own registry. Under the pre-fork server the workers
+additionally write snapshots into a shared directory (see flush), and
+/metrics sums the snapshots of all workers, so a scrape that lands on any
+worker sees the whole server. Gauges only count for workers that are still
+alive; counters of exited workers are kept so rates stay monotonic.
+
+Cache hit ratios are derived in PromQL, e.g.
+    rate(charasearch_cache_hits_total[5m])
+      / (rate(charasearch_cache_hits_total[5m]) + rate(charasearch_cache_misses_total[5m]))
+"""
+import datetime
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import config
+except ImportError:
+    config = None
+
+# "text" (http.server's default lines), "json" (one object per request) or None
+ACCESS_LOG_FORMAT = getattr(config, "IMAGE_SERVER_ACCESS_LOG", "text")
+# Shared snapshot directory for pre-fork workers; None = a fresh temp directory per server start
+METRICS_DIR = getattr(config, "METRICS_DIR", None)
+# Seconds between snapshots of a pre-fork worker
+METRICS_FLUSH_INTERVAL = getattr(config, "METRICS_FLUSH_INTERVAL", 5)
+
+# Upper bounds in seconds, +Inf is implied
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# name -> (type, help)
+METRICS = {
+    "charasearch_http_requests_total": ("counter", "HTTP requests by route and status."),
+    "charasearch_http_request_duration_seconds": ("histogram", "Time from the parsed request line to the last byte sent."),
+    "charasearch_http_request_phase_seconds": ("histogram", "Time per request spent in a phase (resolve, db, render, send)."),
+    "charasearch_http_response_bytes_total": ("counter", "Bytes sent including headers."),
+    "charasearch_http_requests_in_flight": ("gauge", "Requests being handled right now."),
+    "charasearch_cache_hits_total": ("counter", "Cache hits (definition cache: including remembered misses)."),
+    "charasearch_cache_misses_total": ("counter", "Cache misses."),
+    "charasearch_cache_evictions_total": ("counter", "Entries evicted to stay within the size limit."),
+    "charasearch_cache_bytes": ("gauge", "Current size of the in-memory cache."),
+    "charasearch_disk_cache_bytes": ("gauge", "Current size of the on-disk cache (shared by all processes)."),
+    "charasearch_db_pool_connections": ("gauge", "DB pool connections by state."),
+    "charasearch_db_pool_waits_total": ("counter", "Checkouts that had to wait for a free connection."),
+    "charasearch_db_pool_timeouts_total": ("counter", "Checkouts that gave up waiting."),
+}
+
+# Gauges every process reports the same shared value for: the maximum is shown, not the sum
+SHARED_GAUGES = {"charasearch_disk_cache_bytes"}
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class Registry:
+    """Thread-safe store of the metrics of one process."""
+
+    def __init__(self):
+        self.shared_dir = None
+        self._values = {}      # (name, label key) -> value of counters and gauges
+        self._histograms = {}  # (name, label key) -> [count per bucket..., +Inf count, sum]
+        self._collectors = []
+        self._lock = threading.Lock()
+        self._last_flush = 0.0
+
+    def inc(self, name, value=1, **labels):
+        """Adds to a counter, or to a gauge (negative values allowed)."""
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            buckets = self._histograms.get(key)
+            if buckets is None:
+                buckets = self._histograms[key] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    buckets[i] += 1
+                    break
+            else:
+                buckets[len(LATENCY_BUCKETS)] += 1
+            buckets[-1] += value
+
+    def add_collector(self, collect):
+        """collect() is called per snapshot and yields (name, labels dict, value), e.g. cache stats."""
+        self._collectors.append(collect)
+
+    def snapshot(self):
+        """Current state as a JSON-serializable dict."""
+        with self._lock:
+            values = [[name, list(labels), value] for (name, labels), value in self._values.items()]
+            histograms = [[name, list(labels), list(buckets)] for (name, labels), buckets in self._histograms.items()]
+        for collect in self._collectors:
+            try:
+                for name, labels, value in collect():
+                    values.append([name, list(_label_key(labels)), value])
+            except Exception as e:
+                print(f"Metrics collector failed: {e}")
+        return {"pid": os.getpid(), "values": values, "histograms": histograms}
+
+    def flush(self, force=False):
+        """Writes this process' snapshot into shared_dir (at most every METRICS_FLUSH_INTERVAL seconds)."""
+        if not self.shared_dir:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_flush < METRICS_FLUSH_INTERVAL:
+            return
+        self._last_flush = now
+        fd, tmp_path = tempfile.mkstemp(dir=self.shared_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, os.path.join(self.shared_dir, f"{os.getpid()}.json"))
+
+    def _snapshots(self):
+        own = self.snapshot()
+        if not self.shared_dir:
+            return [own]
+        snapshots = [own]
+        for entry in os.scandir(self.shared_dir):
+            if not entry.name.endswith(".json") or entry.name == f"{own['pid']}.json":
+                continue
+            try:
+                with open(entry.path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue  # being replaced right now
+        return snapshots
+
+    def render(self):
+        """All metrics (summed over the workers) in the Prometheus text format."""
+        values = {}
+        histograms = {}
+        for snap in self._snapshots():
+            alive = snap["pid"] == os.getpid() or _pid_alive(snap["pid"])
+            for name, labels, value in snap["values"]:
+                if METRICS.get(name, ("gauge",))[0] == "gauge" and not alive:
+                    continue
+                key = (name, tuple(map(tuple, labels)))
+                if name in SHARED_GAUGES:
+                    values[key] = max(values.get(key, value), value)
+                else:
+                    values[key] = values.get(key, 0) + value
+            for name, labels, buckets in snap["histograms"]:
+                key = (name, tuple(map(tuple, labels)))
+                merged = histograms.get(key)
+                histograms[key] = buckets if merged is None else [a + b for a, b in zip(merged, buckets)]
+
+        lines = []
+        for name, (kind, help_text) in METRICS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind != "histogram":
+                for (metric, labels), value in sorted(values.items()):
+                    if metric == name:
+                        lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                continue
+            for (metric, labels), buckets in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + (float("inf"),), buckets):
+                    cumulative += count
+                    le = labels + (("le", _format_value(bound)),)
+                    lines.append(f"{name}_bucket{_format_labels(le)} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(buckets[-1])}")
+                lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+def init_shared_dir():
+    """Prepares the snapshot directory before the pre-fork workers start."""
+    directory = METRICS_DIR or tempfile.mkdtemp(prefix="charasearch-metrics-")
+    os.makedirs(directory, exist_ok=True)
+    # Snapshots of a previous server run would add old counters
+    for entry in os.scandir(directory):
+        if entry.name.endswith((".json", ".tmp")):
+            os.unlink(entry.path)
+    registry.shared_dir = directory
+    return directory
+
+class CountingWriter:
+    """Wraps a handler's wfile and counts the bytes written through it."""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.bytes = 0
+
+    def write(self, data):
+        self.raw.write(data)
+        self.bytes += len(data)
+        return len(data)
+
+    def count(self, n):
+        """Bytes sent past the writer (sendfile)."""
+        self.bytes += n
+
+    def flush(self):
+        self.raw.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+class RequestMetrics:
+    """Timings of one request: total duration plus time per phase."""
+
+    def __init__(self, bytes_before=0):
+        self.start = time.perf_counter()
+        self.bytes_before = bytes_before
+        self.route = "other"
+        self.status = None
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def finish(self, bytes_after, method, path, client):
+        """Records the request in the registry and writes the JSON access log line."""
+        duration = time.perf_counter() - self.start
+        status = str(self.status or 0)
+        sent = bytes_after - self.bytes_before
+        registry.inc("charasearch_http_requests_total", route=self.route, status=status)
+        registry.observe("charasearch_http_request_duration_seconds", duration, route=self.route, status=status)
+        registry.inc("charasearch_http_response_bytes_total", sent, route=self.route)
+        for phase, seconds in self.phases.items():
+            registry.observe("charasearch_http_request_phase_seconds", seconds, route=self.route, phase=phase)
+
+        if ACCESS_LOG_FORMAT == "json":
+            entry = {
+                "ts": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="milliseconds"),
+                "pid": os.getpid(),
+                "client": client,
+                "method": method,
+                "path": path,
+                "route": self.route,
+                "status": self.status,
+                "bytes": sent,
+                "duration_ms": round(duration * 1000, 3),
+                "phases_ms": {k: round(v * 1000, 3) for k, v in self.phases.items()},
+            }
+            sys.stderr.write(json.dumps(entry) + "\n")
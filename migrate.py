@@ -0,0 +1,338 @@
+"""Creates the database objects the search relies on.
+
+Run once after setting up the database and again after updating:
+
+    python migrate.py              # create missing indexes
+    python migrate.py --dry-run    # only print the SQL
+    python migrate.py --no-fts     # skip the full-text columns
+    python migrate.py --refresh    # refresh the card_search view (cron job)
+    python migrate.py --refresh --every 900
+
+Everything is idempotent. Indexes are built with CREATE INDEX CONCURRENTLY
+so the search stays usable while they build; an index left INVALID by an
+interrupted run is dropped and rebuilt.
+
+The trigram indexes are generated from the expression registry in search.py
+(FIELD_EXPRESSIONS / BOORU_FIELD_EXPRESSIONS), so they always match the
+predicates the search builder emits and can serve ILIKE '%term%' and ~*.
+
+For the full-text mode every source table gets a stored generated tsvector
+column (search.fts_document) and a GIN index on it. Adding the column
+rewrites the table under an exclusive lock, so run it in a quiet moment;
+--rebuild-fts recreates the columns after SEARCH_FTS_CONFIG changed.
+
+Tags get the same treatment: a generated tags_norm text[] column with the
+lowercased tags of the card and a GIN index, so tag searches are exact
+`@>` lookups. The tag text expressions therefore get no trigram indexes;
+the ones earlier versions created are dropped.
+
+card_search is a materialized view over all source tables with the searched
+fields pre-extracted and one set of indexes (trigram, full-text, tags, one
+btree per sort order). It only changes on REFRESH, so run --refresh
+regularly; --rebuild-search recreates it after the search fields changed.
+"""
+import argparse
+import hashlib
+import re
+import time
+
+import psycopg2
+
+import db
+from search import (SOURCES, SORT_OPTIONS, SORT_NULLS_LAST, TAGS_TEXT_FUNCTION, CARD_TAGS_FUNCTION, CARD_SEARCH_VIEW,
+                    FTS_COLUMN, TAGS_COLUMN, field_registry, fts_document, card_tags_expr, build_card_search_view)
+
+# PostgreSQL truncates identifiers after 63 bytes
+MAX_IDENTIFIER_LEN = 63
+
+SETUP_STATEMENTS = [
+    ("extension pg_trgm", "CREATE EXTENSION IF NOT EXISTS pg_trgm"),
+    (f"function {TAGS_TEXT_FUNCTION}", f"""
+        CREATE OR REPLACE FUNCTION {TAGS_TEXT_FUNCTION}(text[]) RETURNS text
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE
+        AS $$ SELECT array_to_string($1, ',') $$
+    """),
+    (f"function {CARD_TAGS_FUNCTION}(text[])", f"""
+        CREATE OR REPLACE FUNCTION {CARD_TAGS_FUNCTION}(text[]) RETURNS text[]
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE
+        AS $$
+            SELECT COALESCE(array_agg(DISTINCT tag ORDER BY tag), '{{}}')
+            FROM (SELECT lower(btrim(t)) AS tag FROM unnest($1) AS t) AS tags
+            WHERE tag <> ''
+        $$
+    """),
+    # Tags are a JSON array in most cards, a comma separated string in some
+    (f"function {CARD_TAGS_FUNCTION}(jsonb, jsonb)", f"""
+        CREATE OR REPLACE FUNCTION {CARD_TAGS_FUNCTION}(metadata jsonb, definition jsonb) RETURNS text[]
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE
+        AS $$
+            SELECT {CARD_TAGS_FUNCTION}(array_agg(t))
+            FROM (VALUES ($1->'tags'), ($2->'tags'), ($2->'data'->'tags')) AS v(tags)
+            CROSS JOIN LATERAL jsonb_array_elements_text(
+                CASE jsonb_typeof(v.tags)
+                    WHEN 'array' THEN v.tags
+                    WHEN 'string' THEN to_jsonb(string_to_array(v.tags #>> '{{}}', ','))
+                    ELSE '[]'::jsonb
+                END
+            ) AS t
+        $$
+    """),
+]
+
+def index_name(table, kind, expr):
+    """Readable, stable index name; hashed if it would be too long."""
+    slug = re.sub(r"[^a-z0-9]+", "_", expr.lower()).strip("_")
+    name = f"{table}_{kind}_{slug}"
+    if len(name) > MAX_IDENTIFIER_LEN:
+        digest = hashlib.sha1(expr.encode("utf-8")).hexdigest()[:8]
+        name = f"{name[:MAX_IDENTIFIER_LEN - 9]}_{digest}"
+    return name
+
+def source_expressions(key):
+    """Unique text search expressions of one source (or card_search), in registry order."""
+    registry = field_registry(key)
+    seen = []
+    for field, exprs in registry.items():
+        if field == "tags":
+            # Served by the tag arrays
+            continue
+        for expr, _ in exprs:
+            if expr not in seen:
+                seen.append(expr)
+    return seen
+
+def trigram_indexes():
+    """(table, index name, CREATE INDEX statement) for every searched expression."""
+    for key, (table, _, _) in SOURCES.items():
+        for expr in source_expressions(key):
+            name = index_name(table, "trgm", expr)
+            sql = (f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} "
+                   f"ON {table} USING gin (({expr}) gin_trgm_ops)")
+            yield table, name, sql
+
+def card_search_indexes():
+    """Indexes of the card_search view; the unique one comes first (needed for REFRESH CONCURRENTLY)."""
+    view = CARD_SEARCH_VIEW
+    yield view, f"{view}_key", f"CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {view}_key ON {view} (src, image_hash)"
+    for expr in source_expressions(view):
+        name = index_name(view, "trgm", expr)
+        yield view, name, f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {view} USING gin (({expr}) gin_trgm_ops)"
+    yield view, f"{view}_fts", f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {view}_fts ON {view} USING gin ({FTS_COLUMN})"
+    yield view, f"{view}_tags", f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {view}_tags ON {view} USING gin (tags)"
+    # One btree per sort order, same tie-breakers as the keyset pagination
+    # (scanned backwards for DESC). Relevance is computed per query.
+    for option, (key_expr, _, _) in SORT_OPTIONS.items():
+        if key_expr == "rank":
+            continue
+        name = sort_index_name(option)
+        columns = f"({key_expr})"
+        if option in SORT_NULLS_LAST:
+            columns = f"({SORT_NULLS_LAST[option]}), {columns}"
+        yield view, name, f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {view} ({columns}, src, image_hash)"
+
+def sort_index_name(option):
+    key_expr = SORT_OPTIONS[option][0]
+    if option in SORT_NULLS_LAST:
+        key_expr = f"{SORT_NULLS_LAST[option]}, {key_expr}"
+    return f"{CARD_SEARCH_VIEW}_sort_{hashlib.sha1(key_expr.encode('utf-8')).hexdigest()[:8]}"
+
+def obsolete_indexes():
+    """(table, index name) of indexes earlier versions created and the search no longer uses."""
+    # Tag text expressions, trigram-indexed until tags moved to the tag arrays
+    tables = {key: table for key, (table, _, _) in SOURCES.items()}
+    tables[CARD_SEARCH_VIEW] = CARD_SEARCH_VIEW
+    for key, table in tables.items():
+        for expr, _ in field_registry(key).get("tags", []):
+            yield table, index_name(table, "trgm", expr)
+    # Name sort before NULL names went last: key without the flag column
+    yield CARD_SEARCH_VIEW, f"{CARD_SEARCH_VIEW}_sort_{hashlib.sha1(SORT_OPTIONS['Name (A-Z)'][0].encode('utf-8')).hexdigest()[:8]}"
+
+def hash_indexes():
+    """Lookups by image_hash (page hydration, image server) on every source table."""
+    for table, _, _ in SOURCES.values():
+        name = f"{table}_image_hash"
+        yield table, name, f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} (image_hash)"
+
+def has_leading_index(cur, table, column):
+    """True if some index of the table starts with the column (under any name)."""
+    cur.execute("SELECT 1 FROM pg_index i JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0] "
+                "WHERE i.indrelid = to_regclass(%s) AND a.attname = %s", (table, column))
+    return cur.fetchone() is not None
+
+def generated_columns(fts=True):
+    """(table, column, ALTER TABLE statement) for the generated search columns."""
+    for key, (table, _, _) in SOURCES.items():
+        yield table, TAGS_COLUMN, (f"ALTER TABLE {table} ADD COLUMN {TAGS_COLUMN} text[] "
+                                   f"GENERATED ALWAYS AS ({card_tags_expr(key)}) STORED")
+        if fts:
+            yield table, FTS_COLUMN, (f"ALTER TABLE {table} ADD COLUMN {FTS_COLUMN} tsvector "
+                                      f"GENERATED ALWAYS AS ({fts_document(key)}) STORED")
+
+def column_indexes(fts=True):
+    """GIN indexes on the generated columns."""
+    for table, _, _ in SOURCES.values():
+        yield table, f"{table}_tags", f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {table}_tags ON {table} USING gin ({TAGS_COLUMN})"
+        if fts:
+            name = f"{table}_fts"
+            yield table, name, f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} USING gin ({FTS_COLUMN})"
+
+def table_exists(cur, table):
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL", (table,))
+    return cur.fetchone()[0]
+
+def column_exists(cur, table, column):
+    cur.execute("SELECT 1 FROM information_schema.columns WHERE table_name = %s AND column_name = %s "
+                "AND table_schema = ANY(current_schemas(false))", (table, column))
+    return cur.fetchone() is not None
+
+def index_state(cur, name):
+    """None if the index does not exist, else whether it is valid."""
+    cur.execute("SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = %s", (name,))
+    row = cur.fetchone()
+    return None if row is None else row[0]
+
+def create_index(cur, name, sql):
+    """Creates a missing or invalid index; True if something was built."""
+    state = index_state(cur, name)
+    if state:
+        print(f"exists  {name}")
+        return False
+    if state is False:
+        print(f"rebuild {name} (invalid)")
+        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    start = time.time()
+    cur.execute(sql)
+    print(f"created {name} ({time.time() - start:.1f}s)")
+    return True
+
+def refresh(every=None):
+    """REFRESH MATERIALIZED VIEW CONCURRENTLY card_search, once or every N seconds."""
+    while True:
+        conn = psycopg2.connect(**db.DB_CONFIG)
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cur:
+                start = time.time()
+                cur.execute(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {CARD_SEARCH_VIEW}")
+                print(f"refreshed {CARD_SEARCH_VIEW} ({time.time() - start:.1f}s)", flush=True)
+        except psycopg2.Error as e:
+            if not every:
+                raise
+            print(f"refresh failed: {str(e).strip()}", flush=True)
+        finally:
+            conn.close()
+        if not every:
+            return
+        time.sleep(every)
+
+def run(dry_run=False, maintenance_work_mem=None, fts=True, rebuild_fts=False, card_search=True, rebuild_search=False):
+    indexes = list(trigram_indexes()) + list(column_indexes(fts))
+    if card_search:
+        indexes += list(hash_indexes()) + list(card_search_indexes())
+
+    if dry_run:
+        for label, sql in SETUP_STATEMENTS:
+            print(f"-- {label}\n{sql.strip()};")
+        for _, _, sql in generated_columns(fts):
+            print(f"{sql};")
+        if card_search:
+            print(f"CREATE MATERIALIZED VIEW IF NOT EXISTS {CARD_SEARCH_VIEW} AS {build_card_search_view(SOURCES)};")
+        for _, name in obsolete_indexes():
+            print(f"DROP INDEX CONCURRENTLY IF EXISTS {name};")
+        for _, _, sql in indexes:
+            print(f"{sql};")
+        return
+
+    conn = psycopg2.connect(**db.DB_CONFIG)
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            if maintenance_work_mem:
+                cur.execute("SELECT set_config('maintenance_work_mem', %s, false)", (maintenance_work_mem,))
+
+            for label, sql in SETUP_STATEMENTS:
+                try:
+                    cur.execute(sql)
+                    print(f"ok      {label}")
+                except psycopg2.Error as e:
+                    print(f"failed  {label}: {str(e).strip()}")
+
+            cur.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+            if cur.fetchone() is None:
+                print("skip    trigram indexes (pg_trgm not installed on the server)")
+                indexes = [i for i in indexes if "gin_trgm_ops" not in i[2]]
+
+            touched = []
+            for table, column, sql in generated_columns(fts):
+                if not table_exists(cur, table):
+                    print(f"skip    {table}.{column} (no table)")
+                    continue
+                if column_exists(cur, table, column):
+                    if not (rebuild_fts and column == FTS_COLUMN):
+                        print(f"exists  {table}.{column}")
+                        continue
+                    # Drops the GIN index with it
+                    cur.execute(f"ALTER TABLE {table} DROP COLUMN {column}")
+                start = time.time()
+                cur.execute(sql)
+                print(f"added   {table}.{column} ({time.time() - start:.1f}s)")
+
+            if card_search:
+                if rebuild_search:
+                    cur.execute(f"DROP MATERIALIZED VIEW IF EXISTS {CARD_SEARCH_VIEW}")
+                if not table_exists(cur, CARD_SEARCH_VIEW):
+                    # Only over the source tables this database actually has
+                    present = [key for key, (table, _, _) in SOURCES.items() if table_exists(cur, table)]
+                    start = time.time()
+                    cur.execute(f"CREATE MATERIALIZED VIEW {CARD_SEARCH_VIEW} AS {build_card_search_view(present)}")
+                    print(f"created {CARD_SEARCH_VIEW} over {', '.join(present)} ({time.time() - start:.1f}s)")
+                else:
+                    print(f"exists  {CARD_SEARCH_VIEW}")
+
+            for table, name in obsolete_indexes():
+                if index_state(cur, name) is not None:
+                    cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+                    print(f"dropped {name} (no longer used)")
+
+            for table, name, sql in indexes:
+                if not table_exists(cur, table):
+                    print(f"skip    {name} (no table {table})")
+                    continue
+                if name.endswith("_image_hash") and index_state(cur, name) is None and has_leading_index(cur, table, "image_hash"):
+                    print(f"exists  {name} (other index on image_hash)")
+                    continue
+                if create_index(cur, name, sql) and table not in touched:
+                    touched.append(table)
+
+            # Expression indexes get their own statistics, which the planner
+            # needs to estimate the selectivity of the search predicates
+            for table in touched:
+                cur.execute(f"ANALYZE {table}")
+                print(f"analyzed {table}")
+    finally:
+        conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Create the search indexes and helper functions.")
+    parser.add_argument("--dry-run", action="store_true", help="Print the SQL instead of running it")
+    parser.add_argument("--maintenance-work-mem", metavar="SIZE",
+                        help="maintenance_work_mem for the index builds, e.g. 1GB")
+    parser.add_argument("--no-fts", action="store_true", help="Skip the full-text columns and indexes")
+    parser.add_argument("--rebuild-fts", action="store_true",
+                        help="Recreate existing full-text columns (after changing SEARCH_FTS_CONFIG)")
+    parser.add_argument("--no-search-table", action="store_true", help=f"Skip the {CARD_SEARCH_VIEW} view")
+    parser.add_argument("--rebuild-search", action="store_true",
+                        help=f"Recreate the {CARD_SEARCH_VIEW} view (after changing the search fields)")
+    parser.add_argument("--refresh", action="store_true", help=f"Only refresh the {CARD_SEARCH_VIEW} view")
+    parser.add_argument("--every", type=int, metavar="SECONDS", help="With --refresh: keep refreshing at this interval")
+    args = parser.parse_args()
+    if args.refresh:
+        refresh(every=args.every)
+        return
+    run(dry_run=args.dry_run, maintenance_work_mem=args.maintenance_work_mem,
+        fts=not args.no_fts, rebuild_fts=args.rebuild_fts,
+        card_search=not args.no_search_table, rebuild_search=args.rebuild_search)
+
+if __name__ == "__main__":
+    main()
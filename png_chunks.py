@@ -0,0 +1,116 @@
+"""Chunk-level PNG editing.
+
+Adding the `chara` text chunk does not need the pixel data, so instead of
+decoding and re-encoding the image with Pillow we copy the original chunks
+byte for byte and only build the new tEXt chunk (and its CRC) ourselves.
+"""
+import struct
+import zlib
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Text chunk types that carry a keyword in front of a NUL byte
+TEXT_CHUNK_TYPES = (b"tEXt", b"zTXt", b"iTXt")
+
+# Keywords of embedded character cards. SillyTavern prefers ccv3 over chara,
+# so a stale V3 card left in the file would shadow the one we embed.
+CARD_KEYWORDS = ("chara", "ccv3")
+
+# PNG keywords are 1-79 bytes
+MAX_KEYWORD_LEN = 79
+
+COPY_BUFSIZE = 64 * 1024
+
+def is_png(path):
+    """True if the file starts with the PNG signature (files on disk have no extension)."""
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(PNG_SIGNATURE)) == PNG_SIGNATURE
+    except OSError:
+        return False
+
+def build_text_chunk(keyword, text):
+    """Encodes a complete tEXt chunk (length, type, data, CRC)."""
+    key = keyword.encode("latin-1")
+    if not 1 <= len(key) <= MAX_KEYWORD_LEN:
+        raise ValueError(f"Invalid PNG keyword: {keyword!r}")
+    data = key + b"\0" + text.encode("latin-1")
+    body = b"tEXt" + data
+    return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body) & 0xFFFFFFFF)
+
+def read_chunk_layout(f):
+    """Scans the chunk headers of an open PNG file without reading pixel data.
+
+    Returns a list of (chunk_type, offset, total_size, keyword) tuples, where
+    offset points at the length field and total_size includes length, type
+    and CRC. keyword is only set for text chunks. Raises ValueError if the
+    file is not a complete PNG.
+    """
+    f.seek(0)
+    if f.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+        raise ValueError("Not a PNG file")
+
+    layout = []
+    offset = len(PNG_SIGNATURE)
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            raise ValueError("Truncated PNG: no IEND chunk")
+        length, chunk_type = struct.unpack(">I4s", header)
+        keyword = None
+        if chunk_type in TEXT_CHUNK_TYPES:
+            head = f.read(min(length, MAX_KEYWORD_LEN + 1))
+            keyword = head.split(b"\0", 1)[0].decode("latin-1")
+        total = 12 + length
+        layout.append((chunk_type, offset, total, keyword))
+        if chunk_type == b"IEND":
+            return layout
+        offset += total
+        f.seek(offset)
+
+class PngTextSplice:
+    """A PNG with one text chunk inserted or replaced, streamed from the original file.
+
+    Existing text chunks with the same keyword or one of `drop_keywords`
+    (tEXt, zTXt and iTXt alike) are dropped and the new tEXt chunk is placed
+    right before IEND. All other chunks are copied verbatim, CRCs included.
+    """
+
+    def __init__(self, path, keyword, text, drop_keywords=CARD_KEYWORDS):
+        self.path = path
+        self.new_chunk = build_text_chunk(keyword, text)
+        dropped = {keyword.lower()} | {k.lower() for k in drop_keywords}
+
+        with open(path, "rb") as f:
+            layout = read_chunk_layout(f)
+
+        # Segments to emit: (offset, size) ranges of the source file or bytes objects
+        segments = [(0, len(PNG_SIGNATURE))]
+        for chunk_type, offset, total, chunk_keyword in layout:
+            if chunk_type in TEXT_CHUNK_TYPES and chunk_keyword.lower() in dropped:
+                continue
+            if chunk_type == b"IEND":
+                segments.append(self.new_chunk)
+            last = segments[-1]
+            if isinstance(last, tuple) and last[0] + last[1] == offset:
+                # Merge adjacent ranges to copy them in one go
+                segments[-1] = (last[0], last[1] + total)
+            else:
+                segments.append((offset, total))
+        self.segments = segments
+        self.content_length = sum(len(s) if isinstance(s, bytes) else s[1] for s in segments)
+
+    def iter_bytes(self, bufsize=COPY_BUFSIZE):
+        with open(self.path, "rb") as f:
+            for segment in self.segments:
+                if isinstance(segment, bytes):
+                    yield segment
+                    continue
+                offset, remaining = segment
+                f.seek(offset)
+                while remaining > 0:
+                    buf = f.read(min(bufsize, remaining))
+                    if not buf:
+                        raise ValueError("Source PNG changed while streaming")
+                    remaining -= len(buf)
+                    yield buf
@@ -0,0 +1,203 @@
+"""Batch pre-rendering of metadata-embedded cards into the image server's render cache.
+
+Cards are rendered on their first request otherwise. This walks every
+image_hash of the *_character_def tables (keyset-paginated by hash, one
+source after the other), resolves the definition exactly like the image
+server does and renders the missing cards on a process pool. Cache keys
+contain the definition, so cards whose definition changed are rendered
+again and unchanged ones are skipped.
+
+Progress is checkpointed per source and hash, an interrupted run resumes
+where it stopped.
+
+The run stops when its cards no longer fit into IMAGE_CACHE_MAX_BYTES
+(they would evict each other); --keep-going renders on regardless.
+
+Usage:
+    python pregen.py                       # everything not in the cache yet
+    python pregen.py --since last          # only rows added since the last completed run
+    python pregen.py --since 2024-05-01 --rate 2000 --workers 8
+    python pregen.py --reset               # ignore the checkpoint, start over
+"""
+import argparse
+import datetime
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import db
+from cache import render_key
+from image_server import DEFINITION_TABLES, render_cache, lookup_definitions, render_card
+from manifest import find_image
+
+try:
+    import config
+except ImportError:
+    config = None
+
+PREGEN_CHECKPOINT = getattr(config, "PREGEN_CHECKPOINT",
+                            os.path.join(os.path.dirname(os.path.abspath(__file__)), "pregen.checkpoint.json"))
+
+# Every table with cards, in the image server's lookup order
+PREGEN_TABLES = DEFINITION_TABLES + [("booru", "booru_character_def")]
+
+def load_checkpoint(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_checkpoint(path, checkpoint):
+    """Written atomically, a crash never leaves a half-written checkpoint."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(tmp_path, path)
+
+def render_job(job):
+    """Runs in a worker process: renders one card into the render cache -> (result, bytes).
+
+    RenderCache keeps its size in the cache directory under a lock, so the
+    workers, the parent and a running image server share one bound.
+    """
+    image_hash, character_data = job
+    full_path, _ = find_image(image_hash)
+    if not full_path:
+        return "missing", 0
+    try:
+        # The length, not the file: another process may evict it right after put()
+        length, chunks = render_card(full_path, character_data)
+        render_cache.put(render_key(image_hash, character_data), chunks)
+    except Exception as e:
+        print(f"{image_hash}: {e}")
+        return "failed", 0
+    return "rendered", length
+
+class CacheTooSmall(Exception):
+    """The cards of this run no longer fit into the render cache."""
+
+def fetch_hashes(table, after, since, batch):
+    """Next batch of hashes of a table behind `after`, ordered by hash (uses the image_hash index)."""
+    sql = f"SELECT image_hash FROM {table} WHERE image_hash > %s"
+    params = [after]
+    if since:
+        sql += " AND added >= %s"
+        params.append(since)
+    sql += " ORDER BY image_hash LIMIT %s"
+    params.append(batch)
+    return [row[0] for row in db.fetch_all(sql, params)]
+
+def run(sources, since=None, workers=None, batch=500, rate=0, force=False, checkpoint_path=PREGEN_CHECKPOINT, reset=False,
+        keep_going=False):
+    checkpoint = {} if reset else load_checkpoint(checkpoint_path)
+    if checkpoint.get("progress") is not None:
+        # Resume the interrupted run with its original settings
+        since = checkpoint.get("since")
+        print(f"Resuming run from {checkpoint['run_started']}")
+    else:
+        if since == "last":
+            since = checkpoint.get("last_completed")
+            if not since:
+                print("No completed run yet, rendering everything")
+        checkpoint.update(run_started=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                          since=since, progress={})
+        save_checkpoint(checkpoint_path, checkpoint)
+
+    counters = {"rows": 0, "cached": 0, "no_definition": 0, "rendered": 0, "missing": 0, "failed": 0}
+    # Bytes of the cards this run rendered or found; past the cache's sweep
+    # target, new cards evict the ones rendered earlier in the same run
+    working_set = 0
+    fits = int(render_cache.max_bytes * render_cache.SWEEP_TARGET)
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for src, table in PREGEN_TABLES:
+            if src not in sources:
+                continue
+            after = checkpoint["progress"].get(src, "")
+            if after is None:
+                continue  # finished in the interrupted run
+            while True:
+                batch_start = time.monotonic()
+                hashes = fetch_hashes(table, after, since, batch)
+                if not hashes:
+                    break
+                counters["rows"] += len(hashes)
+                with db.connection() as conn:
+                    with conn.cursor() as cur:
+                        definitions = lookup_definitions(cur, hashes)
+
+                jobs = []
+                for image_hash in hashes:
+                    character_data = definitions.get(image_hash)
+                    if not character_data:
+                        counters["no_definition"] += 1
+                        continue
+                    # get() also marks the card as recently used, so the sweep keeps it
+                    cached_path = None if force else render_cache.get(render_key(image_hash, character_data))
+                    if cached_path:
+                        counters["cached"] += 1
+                        try:
+                            working_set += os.path.getsize(cached_path)
+                        except FileNotFoundError:
+                            pass
+                    else:
+                        jobs.append((image_hash, character_data))
+                for result, size in pool.map(render_job, jobs, chunksize=16):
+                    counters[result] += 1
+                    working_set += size
+
+                after = hashes[-1]
+                checkpoint["progress"][src] = after
+                save_checkpoint(checkpoint_path, checkpoint)
+
+                if working_set > fits and not keep_going:
+                    raise CacheTooSmall(
+                        f"The cards so far take {working_set / 1024**2:.1f} MiB, the render cache keeps "
+                        f"{fits / 1024**2:.1f} MiB: further cards would evict the ones just rendered. "
+                        f"Raise IMAGE_CACHE_MAX_BYTES and run again (it resumes), or pass --keep-going.")
+
+                # Rate limit against the DB: at most `rate` rows per second
+                if rate:
+                    time.sleep(max(0.0, len(hashes) / rate - (time.monotonic() - batch_start)))
+            checkpoint["progress"][src] = None
+            save_checkpoint(checkpoint_path, checkpoint)
+            print(f"{src}: done, {counters['rendered']} rendered so far ({time.time() - start:.0f}s)")
+
+    checkpoint.update(last_completed=checkpoint["run_started"], progress=None)
+    save_checkpoint(checkpoint_path, checkpoint)
+    return counters
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-render metadata-embedded cards into the image server's cache.")
+    parser.add_argument("--sources", nargs="+", default=[src for src, _ in PREGEN_TABLES],
+                        choices=[src for src, _ in PREGEN_TABLES], help="Sources to walk (default: all)")
+    parser.add_argument("--since", help="Only rows added at or after this timestamp, or 'last' for the last completed run")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Render processes")
+    parser.add_argument("--batch", type=int, default=500, help="Hashes per DB round trip")
+    parser.add_argument("--rate", type=float, default=0, help="Max. rows per second read from the DB (0 = unlimited)")
+    parser.add_argument("--force", action="store_true", help="Render again even if the card is cached")
+    parser.add_argument("--checkpoint", default=PREGEN_CHECKPOINT, help="Checkpoint file")
+    parser.add_argument("--reset", action="store_true", help="Ignore the checkpoint and start a new run")
+    parser.add_argument("--keep-going", action="store_true",
+                        help="Continue when the cards no longer fit into IMAGE_CACHE_MAX_BYTES (older ones get evicted)")
+    args = parser.parse_args()
+
+    if render_cache is None:
+        parser.error("IMAGE_CACHE_DIR is disabled in config.py, there is nothing to pre-render into")
+
+    start = time.time()
+    try:
+        counters = run(args.sources, since=args.since, workers=args.workers, batch=args.batch, rate=args.rate,
+                       force=args.force, checkpoint_path=args.checkpoint, reset=args.reset, keep_going=args.keep_going)
+    except CacheTooSmall as e:
+        parser.exit(1, f"Stopped: {e}\n")
+    print(f"Walked {counters['rows']} rows: {counters['rendered']} rendered, {counters['cached']} already cached, "
+          f"{counters['no_definition']} without definition, {counters['missing']} without image, "
+          f"{counters['failed']} failed, {time.time() - start:.1f}s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""Timing of a single Streamlit rerun for the Debug panel of app.py.
+
+Top-level sections of the script are recorded as laps (time since the
+previous lap), smaller steps with phase(). A lap does not include the
+phases inside it, so the rows add up to the whole rerun. Steps inside a card are also
+attributed to that card, so a slow page shows whether it is one phase or a
+few expensive cards. Optionally the whole rerun is captured with cProfile
+(or pyinstrument, if installed); a capture the rerun did not finish is
+stopped by the next one (stop_capture).
+"""
+import cProfile
+import io
+import json
+import pstats
+import time
+from contextlib import contextmanager
+
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+CAPTURE_MODES = ["cProfile"] + (["pyinstrument"] if pyinstrument else [])
+
+# Rows of the cProfile report
+CPROFILE_LINES = 40
+
+class RunProfiler:
+    """Phase and per-card timings of one rerun."""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.total = None
+        self.phases = {}  # name -> [seconds, calls], in order of first use
+        self.cards = []
+        self.capture_mode = None
+        self.capture_report = None
+        self._lap = self.start
+        self._in_phases = 0.0  # phase time since the last lap
+        self._card = None
+        self._capture = None
+
+    def _record(self, name, seconds):
+        entry = self.phases.setdefault(name, [0.0, 0])
+        entry[0] += seconds
+        entry[1] += 1
+        if self._card is not None:
+            self._card["phases"][name] = self._card["phases"].get(name, 0.0) + seconds
+
+    def lap(self, name):
+        """Records the time since the previous lap (or the start), minus its phases, as `name`."""
+        now = time.perf_counter()
+        self._record(name, now - self._lap - self._in_phases)
+        self._lap = now
+        self._in_phases = 0.0
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self._in_phases += seconds
+            self._record(name, seconds)
+
+    def start_card(self, image_hash, src):
+        self._card = {"hash": image_hash, "src": src, "phases": {}, "start": time.perf_counter()}
+
+    def end_card(self):
+        card, self._card = self._card, None
+        if card is None:
+            return
+        card["total"] = time.perf_counter() - card.pop("start")
+        self.cards.append(card)
+
+    def start_capture(self, mode):
+        """Profiles the rest of this rerun with cProfile or pyinstrument."""
+        self.capture_mode = mode
+        try:
+            if mode == "pyinstrument" and pyinstrument:
+                capture = pyinstrument.Profiler()
+                capture.start()
+            else:
+                self.capture_mode = "cProfile"
+                capture = cProfile.Profile()
+                capture.enable()
+        except (RuntimeError, ValueError) as e:
+            # Another profiler is active (one per thread, or per process with sys.monitoring)
+            self.capture_report = f"Capture not started: {e}"
+            return
+        self._capture = capture
+
+    def stop_capture(self):
+        """Stops a running capture without a report.
+
+        For reruns that ended before finish() (st.rerun, st.stop, an
+        exception): call it at the start of the next rerun, otherwise the
+        profiler stays enabled and keeps slowing down every later rerun.
+        """
+        capture, self._capture = self._capture, None
+        if capture is None:
+            return
+        try:
+            if self.capture_mode == "pyinstrument":
+                capture.stop()
+            else:
+                capture.disable()
+        except Exception:
+            # Started on a script thread that has ended since
+            pass
+
+    def finish(self):
+        """Stops the clock (and a running capture); call once at the end of the script."""
+        if self.total is not None:
+            return
+        self.total = time.perf_counter() - self.start
+        if self._capture is None:
+            return
+        if self.capture_mode == "pyinstrument":
+            self._capture.stop()
+            self.capture_report = self._capture.output_text(unicode=True, color=False)
+        else:
+            self._capture.disable()
+            out = io.StringIO()
+            pstats.Stats(self._capture, stream=out).sort_stats("cumulative").print_stats(CPROFILE_LINES)
+            self.capture_report = out.getvalue()
+        self._capture = None
+
+    def phase_rows(self):
+        """Table rows: phase, total ms, calls, share of the rerun."""
+        total = self.total or (time.perf_counter() - self.start)
+        return [
+            {"phase": name, "ms": round(seconds * 1000, 1), "calls": calls,
+             "share": f"{100 * seconds / total:.0f}%" if total else "-"}
+            for name, (seconds, calls) in self.phases.items()
+        ]
+
+    def slowest_cards(self, n=10):
+        rows = []
+        for card in sorted(self.cards, key=lambda c: c["total"], reverse=True)[:n]:
+            row = {"card": card["hash"][:12], "source": card["src"], "ms": round(card["total"] * 1000, 1)}
+            row.update({name: round(seconds * 1000, 1) for name, seconds in card["phases"].items()})
+            rows.append(row)
+        return rows
+
+    def to_json(self):
+        """Everything recorded, for the download button."""
+        return json.dumps({
+            "started_at": self.started_at,
+            "total_ms": round((self.total or 0) * 1000, 3),
+            "phases": {name: {"ms": round(seconds * 1000, 3), "calls": calls}
+                       for name, (seconds, calls) in self.phases.items()},
+            "cards": [{"hash": c["hash"], "src": c["src"], "total_ms": round(c["total"] * 1000, 3),
+                       "phases_ms": {k: round(v * 1000, 3) for k, v in c["phases"].items()}}
+                      for c in self.cards],
+            "capture_mode": self.capture_mode,
+            "capture_report": self.capture_report,
+        }, indent=2)
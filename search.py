@@ -0,0 +1,662 @@
+"""SQL-Builder für die Charakter-Suche.
+
+Liegt außerhalb von app.py, damit sich die Suche ohne laufende
+Streamlit-Session bauen (und testen / benchmarken) lässt.
+"""
+import heapq
+import itertools
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+
+try:
+    import config
+except ImportError:
+    config = None
+
+# Source key -> (table, src label in the results, tagline expression)
+SOURCES = {
+    "chub": ("chub_character_def", "chub", "NULL"),
+    "risuai": ("risuai_character_def", "risuai", "NULL"),
+    "char_tavern": ("char_tavern_character_def", "tavern", "NULL"),
+    "generic": ("generic_character_def", "generic", "tagline"),
+    "chub_lorebook": ("chub_lorebook_def", "lorebook", "NULL"),
+    "booru": ("booru_character_def", "booru", "tagline"),
+    "nyaime": ("nyaime_character_def", "nyaime", "NULL"),
+    "webring": ("webring_character_def", "webring", "tagline"),
+}
+
+# Sort option -> (sort key over the result columns, direction, SQL type of the key).
+# Keys never evaluate to NULL, so (sort_key, src, image_hash) can be compared
+# as a row value for keyset pagination. NULL dates map to +-infinity to keep
+# the old NULLS LAST behaviour.
+SORT_OPTIONS = {
+    "Neueste zuerst": ("COALESCE(added, '-infinity')", "DESC", "timestamptz"),
+    "Älteste zuerst": ("COALESCE(added, 'infinity')", "ASC", "timestamptz"),
+    "Name (A-Z)": ("COALESCE(name, '')", "ASC", "text"),
+    # Nutze tokens_count column
+    "Token Count (Viel)": ("tokens_count", "DESC", "integer"),
+    # Unbekannte (0) ans Ende
+    "Token Count (Wenig)": ("CASE WHEN tokens_count = 0 THEN 9999999 ELSE tokens_count END", "ASC", "integer"),
+    # ts_rank, nur im Volltext-Modus (sonst DEFAULT_SORT)
+    "Relevanz": ("rank", "DESC", "real"),
+}
+DEFAULT_SORT = "Name (A-Z)"
+RELEVANCE_SORT = "Relevanz"
+
+# Sort option -> flag expression for rows the key cannot order (cards without
+# a name). Flagged rows go last like with the old ORDER BY name ASC; the flag
+# leads the row value (flag, sort_key, src, image_hash). Only for ASC keys.
+SORT_NULLS_LAST = {
+    "Name (A-Z)": "name IS NULL",
+}
+
+# Suchmodus (Sidebar) -> mode for the builder
+SEARCH_MODES = {
+    "Teilwort": "ilike",
+    "Volltext": "fts",
+}
+DEFAULT_SEARCH_MODE = "Teilwort"
+
+# helper for tokens_count expression
+TOKENS_EXPR = "COALESCE((metadata->>'totalTokens')::int, (metadata->>'total_token_count')::int, (definition->'data'->>'total_token_count')::int, 0)"
+
+# Search field -> [(expression, operator)] as emitted into the WHERE clause.
+# migrate.py creates one pg_trgm GIN index per expression from these tables,
+# so every predicate the builder writes has an index that can serve it.
+# Keep the expressions byte-identical to the index definitions.
+# Tags are matched exactly against TAGS_COLUMN once migrate.py created it;
+# the tag expressions below are the text renderings for the full-text
+# document and the fallback: Regex with boundaries (\y) for precision ('ntr'
+# not in 'country'). Other fields use standard ILIKE for flexibility.
+FIELD_EXPRESSIONS = {
+    "name": [("name", "ILIKE")],
+    "author": [("author", "ILIKE")],
+    "tags": [("metadata->>'tags'", "~*"), ("definition->>'tags'", "~*"), ("definition->'data'->>'tags'", "~*")],
+    "description": [("definition->>'description'", "ILIKE"), ("definition->'data'->>'description'", "ILIKE")],
+    "creator_notes": [("definition->>'creator_notes'", "ILIKE"), ("definition->'data'->>'creator_notes'", "ILIKE")],
+    "first_mes": [("definition->>'first_message'", "ILIKE"), ("definition->'data'->>'first_message'", "ILIKE")],
+    "scenario": [("definition->>'scenario'", "ILIKE"), ("definition->'data'->>'scenario'", "ILIKE")],
+}
+
+# array_to_string() is only STABLE and cannot be indexed; migrate.py creates
+# this IMMUTABLE wrapper. Until then the builder falls back to the plain call.
+TAGS_TEXT_FUNCTION = "charasearch_tags_text"
+BOORU_TAGS_EXPR = f"{TAGS_TEXT_FUNCTION}(tags)"
+BOORU_TAGS_FALLBACK = "array_to_string(tags, ',')"
+
+# Booru hat ein eigenes Schema (summary, tags als Array)
+BOORU_FIELD_EXPRESSIONS = {
+    "name": [("name", "ILIKE")],
+    "author": [("author", "ILIKE")],
+    "description": [("summary", "ILIKE")],
+    "tags": [(BOORU_TAGS_EXPR, "~*")],
+}
+
+# Full-text mode: weighted tsvector per source over these fields. migrate.py
+# stores it as the generated column FTS_COLUMN with a GIN index; sources
+# without the column get the same document computed inline (slow, but the
+# same results).
+FTS_COLUMN = "search_tsv"
+FTS_CONFIG = getattr(config, "SEARCH_FTS_CONFIG", "english")
+FTS_FIELD_WEIGHTS = {
+    "name": "A",
+    "tags": "B",
+    "description": "C",
+    "scenario": "C",
+    "first_mes": "D",
+    "creator_notes": "D",
+}
+
+def fts_document(key, fallbacks=None):
+    """tsvector-Ausdruck einer Quelle (auch die Definition der generierten Spalte)"""
+    registry = field_registry(key)
+    fallbacks = fallbacks or {}
+    parts = []
+    for field, weight in FTS_FIELD_WEIGHTS.items():
+        for expr, _ in registry.get(field, []):
+            expr = fallbacks.get(expr, expr)
+            parts.append(f"setweight(to_tsvector('{FTS_CONFIG}'::regconfig, COALESCE({expr}, '')), '{weight}')")
+    return " || ".join(parts)
+
+def fts_query_expr():
+    return f"websearch_to_tsquery('{FTS_CONFIG}'::regconfig, %s)"
+
+# Unified search table: one materialized view over all sources with the
+# searched fields pre-extracted (migrate.py creates it, `migrate.py --refresh`
+# refreshes it CONCURRENTLY). Once it exists, searches and sorts run on it
+# instead of the UNION ALL and only the rows of the page are hydrated with
+# metadata/definition from the source tables.
+CARD_SEARCH_VIEW = "card_search"
+USE_CARD_SEARCH = getattr(config, "SEARCH_USE_MATERIALIZED", True)
+
+# charasearch_card_tags(metadata, definition) / charasearch_card_tags(text[]):
+# lowercased, de-duplicated tag array of a card (created by migrate.py)
+CARD_TAGS_FUNCTION = "charasearch_card_tags"
+
+# Search field -> expressions on card_search, same operators as FIELD_EXPRESSIONS
+CARD_SEARCH_FIELD_EXPRESSIONS = {
+    "name": [("name", "ILIKE")],
+    "author": [("author", "ILIKE")],
+    "tags": [("tags_text", "~*")],
+    "description": [("description", "ILIKE")],
+    "creator_notes": [("creator_notes", "ILIKE")],
+    "first_mes": [("first_message", "ILIKE")],
+    "scenario": [("scenario", "ILIKE")],
+}
+
+# Normalized tags: lowercased, trimmed, de-duplicated text[] per card. On the
+# source tables a generated column (migrate.py), on card_search the `tags` column.
+# Tag searches become `@>` containment lookups on a GIN index.
+TAGS_COLUMN = "tags_norm"
+
+def card_tags_expr(key):
+    """Ausdruck für das normalisierte Tag-Array einer Quelle"""
+    if key == "booru":
+        return f"{CARD_TAGS_FUNCTION}(tags)"
+    return f"{CARD_TAGS_FUNCTION}(metadata, definition)"
+
+def normalize_tags(search_query):
+    """Suchbegriff -> Tag-Liste wie in TAGS_COLUMN ("Dark Elf, Fantasy" -> ['dark elf', 'fantasy'])"""
+    return sorted({t.strip().lower() for t in search_query.split(",") if t.strip()})
+
+# Characters with a meaning in PostgreSQL regular expressions
+REGEX_SPECIAL_RE = re.compile(r"([\\.^$|?*+()\[\]{}])")
+
+def escape_regex(text):
+    return REGEX_SPECIAL_RE.sub(r"\\\1", text)
+
+# Metadata/definition shim for booru rows (has neither column)
+BOORU_METADATA_EXPR = "jsonb_build_object('tags', tags, 'totalTokens', 0)"
+BOORU_DEFINITION_EXPR = "jsonb_build_object('description', summary)"
+
+# Columns of a result row (build_page_query). The list only needs a few
+# display fields, so they are extracted in SQL instead of shipping the full
+# metadata/definition JSONB of every card; the full card is loaded on demand
+# (build_card_query).
+RESULT_COLUMNS = (
+    "name", "image_hash", "src", "added", "author", "tagline", "tokens_count",
+    "creator_notes", "description", "tags", "badge_meta", "has_definition", "sort_cursor",
+)
+
+# Longest creator notes shown in the list; description only up to the first line
+SUMMARY_MAX_CHARS = 2000
+DESCRIPTION_MAX_CHARS = 201
+
+def json_tags(expr):
+    """Tags-JSON oder SQL-NULL, wenn es in Python falsy wäre (null, [], "") -> nächste Quelle"""
+    return f"NULLIF(NULLIF(NULLIF({expr}, 'null'::jsonb), '[]'::jsonb), '\"\"'::jsonb)"
+
+def display_columns(metadata="metadata", definition="definition"):
+    """SELECT list der Anzeige-Felder (creator_notes .. has_definition) aus metadata/definition
+
+    Gleiche Reihenfolge wie vorher in der App auf dem vollen JSON; booru
+    läuft über seine metadata/definition-Nachbildung durch dieselben Ausdrücke.
+    """
+    m, d = metadata, definition
+    # Wie früher in der App: metadata.tags, sonst data.tags, sonst tags der Definition
+    meta_tags, data_tags = json_tags(f"{m}->'tags'"), json_tags(f"{d}->'data'->'tags'")
+    tags = f"COALESCE({meta_tags}, {data_tags}, {d}->'tags')"
+    return ", ".join([
+        f"left(COALESCE(NULLIF({d}->'data'->>'creator_notes', ''), NULLIF({d}->>'creator_notes', '')), {SUMMARY_MAX_CHARS}) AS creator_notes",
+        f"left(split_part(COALESCE(NULLIF({d}->'data'->>'description', ''), NULLIF({d}->>'description', ''), "
+        f"NULLIF({d}->>'personality', '')), E'\\n', 1), {DESCRIPTION_MAX_CHARS}) AS description",
+        f"{tags} AS tags",
+        # Everything get_safety_badges looks at
+        f"jsonb_strip_nulls(jsonb_build_object('safety', {m}->'safety', 'nsfw', {m}->'nsfw', 'tags', {m}->'tags')) AS badge_meta",
+        f"COALESCE({d} <> '{{}}'::jsonb, false) AS has_definition",
+    ])
+
+def build_card_query(src, image_hash):
+    """metadata/definition einer einzelnen Karte (Details, Raw) -> (sql, params) oder (None, [])"""
+    for key, (table, label, _) in SOURCES.items():
+        if label != src:
+            continue
+        if key == "booru":
+            columns = f"{BOORU_METADATA_EXPR} AS metadata, {BOORU_DEFINITION_EXPR} AS definition"
+        else:
+            columns = "metadata, definition"
+        return f"SELECT {columns} FROM {table} WHERE image_hash = %s LIMIT 1", [image_hash]
+    return None, []
+
+def field_registry(key):
+    """Ausdrucks-Registry für einen Quell-Key oder die card_search-View"""
+    if key == CARD_SEARCH_VIEW:
+        return CARD_SEARCH_FIELD_EXPRESSIONS
+    return BOORU_FIELD_EXPRESSIONS if key == "booru" else FIELD_EXPRESSIONS
+
+def build_card_search_view(source_keys):
+    """SELECT hinter der card_search-View, über die angegebenen Quell-Keys"""
+    # No index on the view needs the IMMUTABLE tags-text wrapper, so use the plain
+    # call. The tag array does depend on CARD_TAGS_FUNCTION, which migrate.py
+    # creates before the view.
+    fallbacks = {BOORU_TAGS_EXPR: BOORU_TAGS_FALLBACK}
+    parts = []
+    for key, (table, src, tagline_expr) in SOURCES.items():
+        if key not in source_keys:
+            continue
+        registry = field_registry(key)
+        columns = []
+        for field, exprs in CARD_SEARCH_FIELD_EXPRESSIONS.items():
+            column = exprs[0][0]
+            source_exprs = [fallbacks.get(e, e) for e, _ in registry.get(field, [])]
+            if not source_exprs:
+                value = "NULL::text"
+            elif len(source_exprs) == 1:
+                value = source_exprs[0]
+            else:
+                # Newline between the renderings: ILIKE/\y matches cannot span them
+                value = f"concat_ws(E'\\n', {', '.join(source_exprs)})"
+            columns.append(f"{value} AS {column}")
+        tokens = "0" if key == "booru" else TOKENS_EXPR
+        tags = card_tags_expr(key)
+        parts.append(
+            f"SELECT '{src}'::text AS src, image_hash, {', '.join(columns)}, "
+            f"{tagline_expr}::text AS tagline, added, {tokens} AS tokens_count, {tags} AS tags "
+            f"FROM {table} WHERE image_hash IS NOT NULL"
+        )
+    # (src, image_hash) is the unique key REFRESH CONCURRENTLY needs
+    return (
+        f"SELECT DISTINCT ON (src, image_hash) cards.*, {fts_document(CARD_SEARCH_VIEW)} AS {FTS_COLUMN} "
+        f"FROM ({' UNION ALL '.join(parts)}) AS cards ORDER BY src, image_hash"
+    )
+
+def use_card_search():
+    return USE_CARD_SEARCH and CARD_SEARCH_VIEW in db_features()
+
+# Fan-out: without card_search, query every selected source on its own pooled
+# connection in parallel and merge the sorted results in Python, so latency
+# follows the slowest source instead of the sum of all of them.
+SEARCH_FANOUT = getattr(config, "SEARCH_FANOUT", True)
+SEARCH_FANOUT_WORKERS = getattr(config, "SEARCH_FANOUT_WORKERS", 8)
+
+# Sort key type -> merge key that orders the same in Python as in PostgreSQL.
+# Text keys are missing on purpose: Python cannot reproduce the database
+# collation, so name sorts stay on the single UNION ALL statement.
+MERGE_KEYS = {
+    "timestamptz": "extract(epoch FROM sort_key)",
+    "integer": "sort_key",
+    "real": "sort_key::float8",
+}
+
+_fanout_executor = None
+_fanout_lock = threading.Lock()
+
+def fanout_executor():
+    global _fanout_executor
+    with _fanout_lock:
+        if _fanout_executor is None:
+            _fanout_executor = ThreadPoolExecutor(max_workers=SEARCH_FANOUT_WORKERS, thread_name_prefix="search-fanout")
+        return _fanout_executor
+
+# Re-check the database for migrate.py objects this often (seconds)
+FEATURE_RECHECK = 300
+_features = None
+_features_checked = 0.0
+_features_lock = threading.Lock()
+
+def db_features():
+    """Namen der von migrate.py angelegten Objekte, die es in der DB gibt
+
+    Extensions/Funktionen/befüllte Views per Name, tsvector-Spalten als
+    "tabelle.spalte".
+    """
+    global _features, _features_checked
+    with _features_lock:
+        if _features is not None and time.monotonic() - _features_checked < FEATURE_RECHECK:
+            return _features
+        try:
+            rows = db.fetch_all(
+                "SELECT extname FROM pg_extension WHERE extname = 'pg_trgm' "
+                "UNION ALL SELECT proname FROM pg_proc WHERE proname = %s "
+                "UNION ALL SELECT table_name || '.' || column_name FROM information_schema.columns "
+                "WHERE column_name IN (%s, %s) AND table_schema = ANY(current_schemas(false)) "
+                "UNION ALL SELECT matviewname FROM pg_matviews WHERE matviewname = %s AND ispopulated",
+                (TAGS_TEXT_FUNCTION, FTS_COLUMN, TAGS_COLUMN, CARD_SEARCH_VIEW)
+            )
+            _features = frozenset(r[0] for r in rows)
+        except Exception as e:
+            print(f"Search: feature detection failed: {e}")
+            _features = frozenset()
+        _features_checked = time.monotonic()
+        return _features
+
+def field_predicates(expressions, fields_to_search, search_query, fallbacks=None, tags_column=None):
+    """(conditions, params) für die gewählten Felder, in Registry-Reihenfolge
+
+    Mit `tags_column` werden Tags exakt per Array-Containment gesucht,
+    sonst per Regex über die Text-Ausdrücke (Eingabe escaped).
+    """
+    tag_param = f"\\y{escape_regex(search_query)}\\y"
+    def_param = f"%{search_query}%"
+    fallbacks = fallbacks or {}
+
+    conditions = []
+    params = []
+    for field, exprs in expressions.items():
+        if field not in fields_to_search:
+            continue
+        if field == "tags" and tags_column:
+            tags = normalize_tags(search_query)
+            if tags:
+                conditions.append(f"{tags_column} @> %s::text[]")
+                params.append(tags)
+            else:
+                conditions.append("FALSE")
+            continue
+        for expr, op in exprs:
+            conditions.append(f"{fallbacks.get(expr, expr)} {op} %s")
+            params.append(tag_param if op == "~*" else def_param)
+    return conditions, params
+
+def expression_fallbacks():
+    """Ersatz-Ausdrücke für Hilfsfunktionen, die migrate.py noch nicht angelegt hat"""
+    if TAGS_TEXT_FUNCTION not in db_features():
+        return {BOORU_TAGS_EXPR: BOORU_TAGS_FALLBACK}
+    return {}
+
+def branch_filter(key, table, fields_to_search, search_query, mode):
+    """(rank_sql, where_sql, params) eines UNION-Zweigs; params in SQL-Reihenfolge"""
+    if mode == "fts":
+        if f"{table}.{FTS_COLUMN}" in db_features():
+            document = FTS_COLUMN
+        else:
+            document = f"({fts_document(key, expression_fallbacks())})"
+        query = fts_query_expr()
+        return (f"ts_rank({document}, {query}, 1)", f"{document} @@ {query}", [search_query, search_query])
+
+    tags_column = TAGS_COLUMN if f"{table}.{TAGS_COLUMN}" in db_features() else None
+    conds, params = field_predicates(field_registry(key), fields_to_search, search_query,
+                                     expression_fallbacks(), tags_column)
+    if conds:
+        where = " OR ".join(conds)
+    else:
+        # Booru without searchable fields matches nothing, the others everything
+        where = "FALSE" if key == "booru" else "1=1"
+    return "0::real", where, params
+
+def build_booru_branch(fields_to_search, search_query, mode="ilike"):
+    """Booru hat ein eigenes Schema (summary, tags als Array) -> eigener Zweig"""
+    rank_sql, booru_str, booru_params = branch_filter("booru", SOURCES["booru"][0], fields_to_search, search_query, mode)
+
+    sql = f"""
+            SELECT name, image_hash, 'booru' AS src, {BOORU_METADATA_EXPR} AS metadata, added, author, tagline,
+            {BOORU_DEFINITION_EXPR} as definition, 0 as tokens_count, {rank_sql} AS rank
+            FROM booru_character_def
+            WHERE {booru_str}
+        """
+    return sql, booru_params
+
+def build_branches(selected_sources, selected_fields, search_query, mode="ilike"):
+    """Ein SELECT je gewählter Quelle -> [(sql, params)]
+
+    mode "ilike": Teilwort-Suche in den gewählten Feldern (FIELD_EXPRESSIONS),
+    mode "fts": Volltext über das gewichtete Dokument, rank = ts_rank.
+    """
+    branches = []
+
+    # Standard Fields + Full Definition
+    # 1. Name, 2. Image, 3. Source, 4. Metadata, 5. Added, 6. Author, 7. Tagline, 8. Definition, 9. tokens_count, 10. rank
+    base_select = f"SELECT name, image_hash, '{{src}}' AS src, metadata, added, author, {{tagline_expr}} AS tagline, definition, {TOKENS_EXPR} as tokens_count, {{rank_sql}} AS rank FROM {{table}}"
+
+    # Same order as the source list in the sidebar
+    for key, (table, src, tagline_expr) in SOURCES.items():
+        if key not in selected_sources:
+            continue
+        if key == "booru":
+            branches.append(build_booru_branch(selected_fields, search_query, mode))
+            continue
+        rank_sql, where_clause, branch_params = branch_filter(key, table, selected_fields, search_query, mode)
+        q = base_select.format(src=src, tagline_expr=tagline_expr, table=table, rank_sql=rank_sql)
+        q += f" WHERE {where_clause}"
+        branches.append((q, branch_params))
+    return branches
+
+def build_card_search_relation(selected_sources, selected_fields, search_query, mode="ilike"):
+    """Wie build_branches, aber ein einziger Zweig auf card_search (ohne metadata/definition)"""
+    labels = [src for key, (_, src, _) in SOURCES.items() if key in selected_sources]
+    if not labels:
+        return None, []
+    if mode == "fts":
+        query = fts_query_expr()
+        rank_sql, rank_params = f"ts_rank({FTS_COLUMN}, {query}, 1)", [search_query]
+        where, where_params = f"{FTS_COLUMN} @@ {query}", [search_query]
+    else:
+        conds, where_params = field_predicates(CARD_SEARCH_FIELD_EXPRESSIONS, selected_fields, search_query, tags_column="tags")
+        rank_sql, rank_params = "0::real", []
+        where = " OR ".join(conds) if conds else "TRUE"
+    sql = (f"SELECT name, image_hash, src, added, author, tagline, tokens_count, {rank_sql} AS rank "
+           f"FROM {CARD_SEARCH_VIEW} WHERE src = ANY(%s) AND ({where})")
+    return sql, rank_params + [labels] + where_params
+
+def hydrate_page(page_sql, selected_sources, order_by):
+    """Holt die Anzeige-Felder der Seitenzeilen aus den Quelltabellen nach"""
+    branches = []
+    for key, (table, src, _) in SOURCES.items():
+        if key not in selected_sources:
+            continue
+        if key == "booru":
+            columns = f"{BOORU_METADATA_EXPR} AS metadata, {BOORU_DEFINITION_EXPR} AS definition"
+        else:
+            columns = "metadata, definition"
+        branches.append(f"SELECT {columns} FROM {table} WHERE page.src = '{src}' AND {table}.image_hash = page.image_hash")
+    return (
+        "SELECT page.name, page.image_hash, page.src, page.added, page.author, page.tagline, page.tokens_count, "
+        f"{display_columns('hydrated.metadata', 'hydrated.definition')}, "
+        f"page.sort_cursor FROM ({page_sql}) AS page "
+        f"LEFT JOIN LATERAL ({' UNION ALL '.join(branches)} LIMIT 1) AS hydrated ON TRUE "
+        f"{order_by}"
+    )
+
+def token_range_condition(token_range, unlimited_tokens):
+    """WHERE-Bedingung für den Token-Filter (Werte sind ints aus dem Slider)"""
+    min_tokens, max_tokens = token_range
+    if not unlimited_tokens:
+        return f"tokens_count BETWEEN {int(min_tokens)} AND {int(max_tokens)}"
+    return f"tokens_count >= {int(min_tokens)}"
+
+def resolve_sort_option(sort_option, mode):
+    """Name der tatsächlich genutzten Sortierung; Relevanz nur im Volltext-Modus"""
+    if sort_option == RELEVANCE_SORT and mode != "fts":
+        return DEFAULT_SORT
+    return sort_option if sort_option in SORT_OPTIONS else DEFAULT_SORT
+
+def resolve_sort(sort_option, mode):
+    """(key_expr, direction, key_type) der Sortierung"""
+    return SORT_OPTIONS[resolve_sort_option(sort_option, mode)]
+
+class SearchPlan:
+    """Eine Suche (Quellen, Felder, Begriff, Token-Filter, Sortierung) -> SQL
+
+    Die Quellen bleiben einzelne Zweige: Token-Filter, Keyset-Bedingung und
+    ORDER BY <key> LIMIT offset+limit werden in jeden Zweig geschoben, so
+    liefert jede Tabelle nur ihre obersten Zeilen (per Index, falls es einen
+    gibt) und erst die wenigen Kandidaten werden gemeinsam sortiert.
+    Mit card_search gibt es nur einen Zweig (build_card_search_relation).
+    """
+
+    def __init__(self, selected_sources, selected_fields, search_query, token_range, unlimited_tokens,
+                 sort_option=DEFAULT_SORT, mode="ilike"):
+        self.selected_sources = selected_sources
+        self.mode = mode
+        self.key_expr, self.direction, self.key_type = resolve_sort(sort_option, mode)
+        self.null_expr = SORT_NULLS_LAST.get(resolve_sort_option(sort_option, mode))
+        self.range_cond = token_range_condition(token_range, unlimited_tokens)
+        self.via_view = use_card_search()
+        if self.via_view:
+            sql, params = build_card_search_relation(selected_sources, selected_fields, search_query, mode)
+            self.branches = [(sql, params)] if sql else []
+        else:
+            self.branches = build_branches(selected_sources, selected_fields, search_query, mode)
+
+    def order_by(self, prefix=""):
+        d = self.direction
+        nulls = f"{prefix}sort_null, " if self.null_expr else ""
+        return f"ORDER BY {nulls}{prefix}sort_key {d}, {prefix}src {d}, {prefix}image_hash {d}"
+
+    def sort_columns(self):
+        """sort_key (und sort_null) eines Zweigs"""
+        columns = f"{self.key_expr} AS sort_key"
+        if self.null_expr:
+            columns = f"{self.null_expr} AS sort_null, {columns}"
+        return columns
+
+    def page_query(self, limit, offset=0, after=None, merge_key=False):
+        """Query für eine Ergebnisseite -> (sql, params) oder (None, [])
+
+        Mit `after` (Cursor der letzten Zeile der Vorseite, siehe row_cursor)
+        wird per Keyset/Seek paginiert: nur Zeilen hinter (sort_key, src, image_hash).
+        Postgres muss dann keine Zeilen der vorherigen Seiten mehr verwerfen.
+        OFFSET bleibt nur für Sprünge auf beliebige Seiten.
+
+        Über card_search wird erst die Seite bestimmt und dann nur für deren
+        Zeilen die Anzeige-Felder nachgeladen (hydrate_page).
+        """
+        if not self.branches:
+            return None, []
+
+        # Rows each branch has to deliver so the merged page is complete
+        branch_limit = int(limit) if after is not None else int(offset) + int(limit)
+        push_down = len(self.branches) > 1
+
+        parts = []
+        params = []
+        for sql, branch_params in self.branches:
+            part = f"SELECT b.*, {self.sort_columns()} FROM ({sql}) AS b WHERE {self.range_cond}"
+            params.extend(branch_params)
+            if after is not None:
+                cmp = "<" if self.direction == "DESC" else ">"
+                if self.null_expr:
+                    # A cursor without key comes from a flagged row (see sort_cursor below)
+                    part += (f" AND ({self.null_expr}, {self.key_expr}, src, image_hash) {cmp} "
+                             f"(%s::boolean, %s::{self.key_type}, %s, %s)")
+                    params.extend([after[0] is None, after[0] or ""] + list(after[1:]))
+                else:
+                    part += f" AND ({self.key_expr}, src, image_hash) {cmp} (%s::{self.key_type}, %s, %s)"
+                    params.extend(after)
+            if push_down:
+                part = f"({part} {self.order_by()} LIMIT {branch_limit})"
+            parts.append(part)
+
+        # sort_key goes out as text: the cursor survives the round trip through
+        # session_state (e.g. '-infinity' has no Python datetime) and is cast back
+        if self.via_view:
+            columns = "ranked.*"
+        else:
+            columns = f"name, image_hash, src, added, author, tagline, tokens_count, {display_columns()}"
+        if self.null_expr:
+            columns += ", CASE WHEN sort_null THEN NULL ELSE sort_key::text END AS sort_cursor"
+        else:
+            columns += ", sort_key::text AS sort_cursor"
+        if merge_key:
+            columns += f", {MERGE_KEYS[self.key_type]} AS merge_key"
+        sql = f"SELECT {columns} FROM ({' UNION ALL '.join(parts)}) AS ranked {self.order_by()} LIMIT {int(limit)}"
+        if after is None and offset:
+            sql += f" OFFSET {int(offset)}"
+        if self.via_view:
+            sql = hydrate_page(sql, self.selected_sources, self.order_by("page."))
+        return sql, params
+
+    def export_query(self):
+        """Alle Treffer in Sortierreihenfolge als (src, image_hash, name) -> (sql, params) oder (None, [])
+
+        Ohne LIMIT und ohne Anzeige-Felder: gedacht für einen serverseitigen
+        Cursor (image_server /export.zip), der die Zeilen blockweise abholt.
+        Jeder image_hash kommt nur einmal vor (erste Zeile in Sortierreihenfolge),
+        der Export muss sich keine Hashes merken.
+        """
+        if not self.branches:
+            return None, []
+        parts = []
+        params = []
+        for sql, branch_params in self.branches:
+            parts.append(f"SELECT b.src, b.image_hash, b.name, {self.sort_columns()} FROM ({sql}) AS b WHERE {self.range_cond}")
+            params.extend(branch_params)
+        # The same card can match in several sources
+        ranked = (f"SELECT ranked.*, row_number() OVER (PARTITION BY image_hash {self.order_by()}) AS occurrence "
+                  f"FROM ({' UNION ALL '.join(parts)}) AS ranked")
+        return f"SELECT src, image_hash, name FROM ({ranked}) AS deduped WHERE occurrence = 1 {self.order_by()}", params
+
+    def count_query(self, cap=None):
+        """Anzahl der Treffer -> (sql, params) oder (None, [])
+
+        Mit `cap` wird höchstens bis cap + 1 gezählt (auch je Zweig): für
+        breite Suchen reicht "10.000+" und Postgres kann danach aufhören.
+        """
+        if not self.branches:
+            return None, []
+        parts = []
+        params = []
+        for sql, branch_params in self.branches:
+            part = f"SELECT 1 FROM ({sql}) AS b WHERE {self.range_cond}"
+            if cap:
+                part = f"({part} LIMIT {int(cap) + 1})"
+            parts.append(part)
+            params.extend(branch_params)
+        inner = " UNION ALL ".join(parts)
+        if cap:
+            inner = f"SELECT 1 FROM ({inner}) AS capped LIMIT {int(cap) + 1}"
+        return f"SELECT COUNT(*) FROM ({inner}) AS matches", params
+
+def build_page_query(selected_sources, selected_fields, search_query, token_range, unlimited_tokens,
+                     sort_option, limit, offset=0, after=None, mode="ilike", merge_key=False):
+    """Query für eine Ergebnisseite -> (sql, params) oder (None, []), siehe SearchPlan.page_query
+
+    Die Gesamtzahl kommt separat aus build_count_query, die Seite selbst
+    braucht so nur die obersten `limit` Zeilen.
+
+    Ergebnis-Spalten: RESULT_COLUMNS (+ merge_key für fetch_page_fanout)
+    """
+    plan = SearchPlan(selected_sources, selected_fields, search_query, token_range, unlimited_tokens, sort_option, mode)
+    return plan.page_query(limit, offset=offset, after=after, merge_key=merge_key)
+
+def can_fan_out(selected_sources, sort_option, mode="ilike"):
+    """True wenn die Seite per fetch_page_fanout geholt werden kann/soll"""
+    if not SEARCH_FANOUT or len(selected_sources) < 2 or use_card_search():
+        return False
+    return resolve_sort(sort_option, mode)[2] in MERGE_KEYS
+
+def fetch_page_fanout(selected_sources, selected_fields, search_query, token_range, unlimited_tokens,
+                      sort_option, limit, offset=0, after=None, mode="ilike"):
+    """Eine Ergebnisseite, je Quelle parallel abgefragt und per k-way merge zusammengeführt
+
+    Jede Quelle liefert sortiert höchstens offset + limit Zeilen (mit Keyset-
+    Cursor nur limit), Python mischt die Ströme und schneidet die Seite aus.
+    Gleiche Zeilen wie build_page_query.
+    """
+    _, direction, _ = resolve_sort(sort_option, mode)
+    per_source = limit if after is not None else offset + limit
+    queries = []
+    for key in SOURCES:
+        if key in selected_sources:
+            queries.append(build_page_query([key], selected_fields, search_query, token_range, unlimited_tokens,
+                                            sort_option, per_source, after=after, mode=mode, merge_key=True))
+
+    executor = fanout_executor()
+    futures = [executor.submit(db.fetch_all, sql, tuple(params)) for sql, params in queries]
+    streams = [f.result() for f in futures]
+
+    # Same order as the SQL: (sort_key, src, image_hash), all in one direction
+    merged = heapq.merge(*streams, key=lambda r: (r[-1], r[2], r[1]), reverse=(direction == "DESC"))
+    start = 0 if after is not None else offset
+    return [row[:-1] for row in itertools.islice(merged, start, start + limit)]
+
+def build_count_query(selected_sources, selected_fields, search_query, token_range, unlimited_tokens, cap=None, mode="ilike"):
+    """Anzahl der Treffer -> (sql, params) oder (None, []), siehe SearchPlan.count_query"""
+    plan = SearchPlan(selected_sources, selected_fields, search_query, token_range, unlimited_tokens, mode=mode)
+    return plan.count_query(cap)
+
+def build_export_query(selected_sources, selected_fields, search_query, token_range, unlimited_tokens,
+                       sort_option=DEFAULT_SORT, mode="ilike"):
+    """Alle Treffer für den ZIP-Export -> (sql, params) oder (None, []), siehe SearchPlan.export_query"""
+    plan = SearchPlan(selected_sources, selected_fields, search_query, token_range, unlimited_tokens, sort_option, mode)
+    return plan.export_query()
+
+_CURSOR_INDEX = RESULT_COLUMNS.index("sort_cursor")
+
+def row_cursor(row):
+    """Keyset-Cursor (sort_key, src, image_hash) einer Ergebniszeile; sort_key None = Zeile ohne Namen"""
+    return (row[_CURSOR_INDEX], row[2], row[1])
@@ -0,0 +1,96 @@
+import json
+import os
+import types
+
+import pytest
+
+import cache
+from cache import MISS, DefinitionCache, RenderCache
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache, "time", types.SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+def size(definition):
+    return len(json.dumps(definition, ensure_ascii=False))
+
+def test_ttl(clock):
+    c = DefinitionCache(ttl=60, max_bytes=10_000, negative_ttl=5)
+    assert c.get("a") is MISS
+    c.put("a", {"name": "A"})
+    clock.now += 59
+    assert c.get("a") == {"name": "A"}
+    clock.now += 1
+    assert c.get("a") is MISS
+    assert c.stats()["entries"] == 0
+    assert c.stats()["bytes"] == 0
+
+def test_negative_ttl(clock):
+    c = DefinitionCache(ttl=60, max_bytes=10_000, negative_ttl=5)
+    c.put("gone", None)
+    clock.now += 4
+    assert c.get("gone") is None
+    clock.now += 1
+    assert c.get("gone") is MISS
+    stats = c.stats()
+    assert (stats["hits"], stats["negative_hits"], stats["misses"]) == (0, 1, 1)
+    assert stats["hit_ratio"] == 0.5
+    assert stats["negative_entries"] == 0
+
+def test_found_definition_replaces_negative_entry(clock):
+    c = DefinitionCache(ttl=60, max_bytes=10_000, negative_ttl=5)
+    c.put("a", None)
+    c.put("a", {"name": "A"})
+    assert c.get("a") == {"name": "A"}
+    assert c.stats()["negative_entries"] == 0
+
+def test_negative_entries_are_bounded(clock):
+    c = DefinitionCache(ttl=60, max_bytes=10_000, negative_ttl=5, max_negative=3)
+    for key in "abcd":
+        c.put(key, None)
+    assert c.get("a") is MISS
+    assert [c.get(key) for key in "bcd"] == [None, None, None]
+
+def test_size_bound_evicts_least_recently_used(clock):
+    d = {"name": "x" * 20}
+    c = DefinitionCache(ttl=60, max_bytes=2 * size(d), negative_ttl=5)
+    c.put("a", d)
+    c.put("b", d)
+    assert c.get("a") == d
+    c.put("c", d)
+    assert c.get("b") is MISS
+    assert c.get("a") == d and c.get("c") == d
+    assert c.stats()["bytes"] == 2 * size(d)
+
+    # Too big for the whole cache: not stored, nothing evicted
+    c.put("huge", {"name": "x" * 1000})
+    assert c.get("huge") is MISS
+    assert c.stats()["entries"] == 2
+
+def test_put_replaces_entry(clock):
+    c = DefinitionCache(ttl=60, max_bytes=10_000, negative_ttl=5)
+    c.put("a", {"name": "A"})
+    c.put("a", {"name": "Anna"})
+    assert c.get("a") == {"name": "Anna"}
+    assert c.stats()["bytes"] == size({"name": "Anna"})
+
+def test_render_cache_open_survives_eviction(tmp_path):
+    c = RenderCache(str(tmp_path), 10_000)
+    key = "ab" * 20
+    assert c.open(key) is None
+    c.put(key, [b"rendered", b" card"])
+    with c.open(key) as f:
+        # Another process sweeps the entry while this one sends it
+        os.unlink(c.path_for(key))
+        assert f.read() == b"rendered card"
+    assert c.open(key) is None
+    assert (c.stats()["hits"], c.stats()["misses"]) == (1, 2)
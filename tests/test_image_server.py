@@ -0,0 +1,195 @@
+import base64
+import http.client
+import io
+import json
+import os
+import threading
+import zipfile
+
+import pytest
+from PIL import Image
+
+import image_server
+from cache import DefinitionCache, RenderCache
+from image_server import ChunkedWriter, ImageHTTPServer, ImageRequestHandler, parse_range, write_export_entry
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", (0, 99)),
+    ("bytes=100-", (100, 999)),
+    ("bytes=-100", (900, 999)),
+    ("bytes=-5000", (0, 999)),
+    ("bytes=990-5000", (990, 999)),
+    ("bytes=999-999", (999, 999)),
+    ("Bytes = 0 - 1", (0, 1)),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 1000) == expected
+
+@pytest.mark.parametrize("header", [
+    "bytes=0-1,5-6",   # multiple ranges: whole file
+    "items=0-1",
+    "bytes=",
+    "bytes=-",
+    "bytes=abc",
+    "bytes=1-a",
+    "bytes=-1-2",
+    "bytes=5-2",       # last < first is malformed, not unsatisfiable
+    "0-99",
+])
+def test_parse_range_ignored(header):
+    assert parse_range(header, 1000) is None
+
+@pytest.mark.parametrize("header, size", [
+    ("bytes=1000-", 1000),
+    ("bytes=5000-6000", 1000),
+    ("bytes=-0", 1000),
+    ("bytes=0-", 0),
+    ("bytes=-10", 0),
+])
+def test_parse_range_unsatisfiable(header, size):
+    with pytest.raises(ValueError):
+        parse_range(header, size)
+
+def dechunk(data):
+    """Body of an HTTP/1.1 chunked message, checking the framing."""
+    body = bytearray()
+    pos = 0
+    while True:
+        line_end = data.index(b"\r\n", pos)
+        length = int(data[pos:line_end], 16)
+        start = line_end + 2
+        assert data[start + length:start + length + 2] == b"\r\n"
+        if length == 0:
+            assert start + 2 == len(data)
+            return bytes(body)
+        body += data[start:start + length]
+        pos = start + length + 2
+
+def test_chunked_writer_framing():
+    wire = io.BytesIO()
+    out = ChunkedWriter(wire, bufsize=10)
+    assert out.write(b"abc") == 3
+    assert wire.getvalue() == b""
+    out.write(b"defghijk")
+    assert wire.getvalue() == b"b\r\nabcdefghijk\r\n"
+    out.write(b"xy")
+    out.flush()
+    out.flush()
+    out.close()
+    assert wire.getvalue().endswith(b"2\r\nxy\r\n0\r\n\r\n")
+    assert dechunk(wire.getvalue()) == b"abcdefghijkxy"
+
+@pytest.fixture
+def card_image(tmp_path, monkeypatch):
+    path = tmp_path / "image"
+    Image.new("RGB", (8, 8), (0, 128, 255)).save(path, format="PNG")
+    monkeypatch.setattr(image_server, "find_image", lambda image_hash: (str(path), []))
+    monkeypatch.setattr(image_server, "render_cache", None)
+    return path
+
+def test_streamed_zip(card_image):
+    h1, h2 = "a" * 32, "b" * 32
+    wire = io.BytesIO()
+    out = ChunkedWriter(wire, bufsize=64)
+    with zipfile.ZipFile(out, "w") as zf:
+        assert write_export_entry(zf, h1, {"data": {"name": "Elf/Queen"}}, "both")
+        assert write_export_entry(zf, h2, {"name": None}, "json")
+    out.close()
+
+    with zipfile.ZipFile(io.BytesIO(dechunk(wire.getvalue()))) as zf:
+        assert zf.testzip() is None
+        infos = {info.filename: info for info in zf.infolist()}
+        assert list(infos) == [f"Elf_Queen_{h1[:8]}.png", f"Elf_Queen_{h1[:8]}.json", f"{h2}.json"]
+        # Unseekable output: sizes follow the data in a data descriptor
+        assert all(info.flag_bits & 0x08 for info in infos.values())
+        assert infos[f"Elf_Queen_{h1[:8]}.png"].compress_type == zipfile.ZIP_STORED
+
+        with Image.open(zf.open(f"Elf_Queen_{h1[:8]}.png")) as img:
+            assert img.size == (8, 8)
+            card = json.loads(base64.b64decode(img.text["chara"]))
+        assert card == {"data": {"name": "Elf/Queen"}}
+        assert json.loads(zf.read(f"{h2}.json")) == {"name": None}
+
+def test_export_entry_without_image(card_image, monkeypatch):
+    monkeypatch.setattr(image_server, "find_image", lambda image_hash: (None, []))
+    with zipfile.ZipFile(io.BytesIO(), "w") as zf:
+        assert not write_export_entry(zf, "c" * 32, {"name": "x"}, "png")
+        assert zf.namelist() == []
+
+@pytest.fixture
+def server(card_image, monkeypatch):
+    """Image server on a free port; definitions come from the `definitions` dict."""
+    definitions = {}
+    monkeypatch.setattr(image_server, "query_character_definition", lambda image_hash: definitions.get(image_hash))
+    monkeypatch.setattr(image_server, "definition_cache", DefinitionCache(60, 10**6, 30))
+    httpd = ImageHTTPServer(("127.0.0.1", 0), ImageRequestHandler, max_workers=2)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+
+    def get(path):
+        conn = http.client.HTTPConnection("127.0.0.1", httpd.server_port, timeout=10)
+        try:
+            conn.request("GET", path)
+            response = conn.getresponse()
+            return response, response.read()
+        finally:
+            conn.close()
+
+    yield get, definitions
+    httpd.shutdown()
+    httpd.server_close()
+
+@pytest.mark.parametrize("definition", [None, {}])
+def test_card_png_without_definition_is_the_image(server, card_image, definition):
+    get, definitions = server
+    h = "d" * 32
+    definitions[h] = definition
+
+    response, body = get(f"/card/{h}.png?download=1")
+    assert response.status == 200
+    assert body == card_image.read_bytes()
+    assert response.getheader("Content-Disposition") == f'attachment; filename="{h}.png"; filename*=UTF-8\'\'{h}.png'
+    assert response.getheader("Cache-Control") == image_server.RAW_FALLBACK_CACHE_CONTROL
+
+    response, body = get(f"/card/{h}.png")
+    assert response.status == 200 and body == card_image.read_bytes()
+    assert response.getheader("Content-Disposition") is None
+
+    # The JSON download has nothing to fall back to
+    response, _ = get(f"/card/{h}.json?download=1")
+    assert response.status == 404
+
+def test_card_png_with_definition(server):
+    get, definitions = server
+    h = "e" * 32
+    definitions[h] = {"data": {"name": "Elf"}}
+
+    response, body = get(f"/card/{h}.png?download=1")
+    assert response.status == 200
+    assert 'filename="Elf.png"' in response.getheader("Content-Disposition")
+    with Image.open(io.BytesIO(body)) as img:
+        assert json.loads(base64.b64decode(img.text["chara"])) == definitions[h]
+
+class EvictingRenderCache(RenderCache):
+    """Another worker sweeps every card right after it was stored."""
+
+    def put(self, key, chunks):
+        path = super().put(key, chunks)
+        os.unlink(path)
+        return path
+
+def test_card_png_evicted_after_render(server, tmp_path, monkeypatch):
+    get, definitions = server
+    monkeypatch.setattr(image_server, "render_cache", EvictingRenderCache(str(tmp_path / "cards"), 10**6))
+    h = "f" * 32
+    definitions[h] = {"data": {"name": "Gone"}}
+
+    response, body = get(f"/card/{h}.png")
+    assert response.status == 200
+    assert int(response.getheader("Content-Length")) == len(body)
+    with Image.open(io.BytesIO(body)) as img:
+        assert json.loads(base64.b64decode(img.text["chara"])) == definitions[h]
+
+    # Export of the same card: the cache has nothing, so it is rendered into the archive
+    with zipfile.ZipFile(io.BytesIO(), "w") as zf:
+        assert write_export_entry(zf, h, definitions[h], "png")
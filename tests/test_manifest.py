@@ -0,0 +1,64 @@
+import os
+
+import pytest
+
+from manifest import DATA_DIR, Manifest, hash_from_rel_path, scan
+
+H = "eb0c83ae1f2a4b5c6d7e8f9012345678"
+
+@pytest.mark.parametrize("rel_path", [
+    # Split filename sharding, with and without extension
+    f"e/b/0/{H[3:]}.png",
+    f"e/b/0/{H[3:]}",
+    # Nested, simple and flat, the file name is the full hash
+    f"e/b/{H}.webp",
+    f"e/{H}.jpg",
+    f"{H}.jpeg",
+    H,
+    # Hash-named directories holding an image
+    f"{H}/card.png",
+    f"e/b/{H}/card.png",
+    f"e/b/{H}/sub/card.png",
+    # Split-sharded hash directories (e/b/0/<29 chars>/img.png)
+    f"e/b/0/{H[3:]}/img.png",
+    f"e/b/0/{H[3:]}/img",
+    f"e/b/0/{H[3:]}/sub/img.png",
+    f"e/b/{H[2:]}/img.png",
+    # Windows separators and stray slashes
+    f"e\\b\\0\\{H[3:]}.png",
+    f"/e//b/0/{H[3:]}.png",
+])
+def test_hash_from_rel_path(rel_path):
+    assert hash_from_rel_path(rel_path) == H
+
+def test_hash_from_rel_path_keeps_non_image_extensions():
+    # Extensionless files may contain dots; only image extensions are stripped
+    assert hash_from_rel_path(f"e/b/0/{H[3:]}.json") == f"{H}.json"
+
+def test_hash_from_rel_path_empty():
+    assert hash_from_rel_path("") is None
+    assert hash_from_rel_path("/") is None
+
+def test_short_shard_dirs_are_not_hash_dirs():
+    # Only the file completes the hash; eb0 alone is not a hash directory
+    assert hash_from_rel_path("e/b/0/c83a.png") == "eb0c83a"
+
+def test_scan_split_sharded_directory(tmp_path):
+    png = b"\x89PNG\r\n\x1a\n" + b"\0" * 16
+    split_dir = tmp_path / DATA_DIR / "e" / "b" / "0" / H[3:]
+    split_dir.mkdir(parents=True)
+    (split_dir / "img.png").write_bytes(png)
+    other = "0123456789abcdef0123456789abcdef"
+    (tmp_path / DATA_DIR / "0" / "1" / "2").mkdir(parents=True)
+    (tmp_path / DATA_DIR / "0" / "1" / "2" / other[3:]).write_bytes(png)
+
+    manifest_path = str(tmp_path / "manifest.sqlite")
+    counters = scan(image_root=str(tmp_path), manifest_path=manifest_path, workers=2)
+    assert counters["total_files"] == 2
+
+    m = Manifest(manifest_path=manifest_path, image_root=str(tmp_path))
+    entry = m.lookup(H)
+    assert entry.rel_path == f"e/b/0/{H[3:]}/img.png"
+    assert entry.format == "png"
+    assert os.path.isfile(entry.path)
+    assert m.lookup(other).rel_path == f"0/1/2/{other[3:]}"
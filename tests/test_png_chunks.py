@@ -0,0 +1,66 @@
+import struct
+import zlib
+
+import pytest
+from PIL import Image, PngImagePlugin
+
+from png_chunks import PNG_SIGNATURE, PngTextSplice, build_text_chunk, read_chunk_layout
+
+def parse_chunks(data):
+    """[(type, payload)] of a PNG byte string, checking every CRC."""
+    assert data.startswith(PNG_SIGNATURE)
+    chunks = []
+    pos = len(PNG_SIGNATURE)
+    while pos < len(data):
+        length, chunk_type = struct.unpack(">I4s", data[pos:pos + 8])
+        payload = data[pos + 8:pos + 8 + length]
+        (crc,) = struct.unpack(">I", data[pos + 8 + length:pos + 12 + length])
+        assert crc == zlib.crc32(chunk_type + payload) & 0xFFFFFFFF, chunk_type
+        chunks.append((chunk_type, payload))
+        pos += 12 + length
+    assert pos == len(data)
+    return chunks
+
+@pytest.fixture
+def card_png(tmp_path):
+    info = PngImagePlugin.PngInfo()
+    info.add_text("chara", "old-v2")
+    info.add_itxt("ccv3", "old-v3")
+    info.add_text("Comment", "keep me", zip=True)
+    path = tmp_path / "card"
+    Image.new("RGBA", (4, 3), (255, 0, 0, 128)).save(path, format="PNG", pnginfo=info)
+    return path
+
+def test_splice_layout_and_crcs(card_png):
+    source = parse_chunks(card_png.read_bytes())
+    splice = PngTextSplice(str(card_png), "chara", "new-v2")
+    out = b"".join(splice.iter_bytes(bufsize=7))
+
+    assert len(out) == splice.content_length
+    chunks = parse_chunks(out)
+    # Everything but the card chunks is copied verbatim and in order
+    kept = [c for c in source if c[0] not in (b"tEXt", b"iTXt") or not c[1].startswith((b"chara\0", b"ccv3\0"))]
+    assert chunks[:-2] == kept[:-1]
+    assert chunks[-2] == (b"tEXt", b"chara\0new-v2")
+    assert chunks[-1] == (b"IEND", b"")
+    assert splice.new_chunk == build_text_chunk("chara", "new-v2")
+
+def test_splice_drops_stale_v3_card(card_png):
+    out_path = card_png.with_name("out.png")
+    out_path.write_bytes(b"".join(PngTextSplice(str(card_png), "chara", "new-v2").iter_bytes()))
+    with Image.open(out_path) as img:
+        img.load()
+        assert img.text == {"Comment": "keep me", "chara": "new-v2"}
+        assert img.size == (4, 3)
+
+def test_layout_rejects_truncated_png(card_png, tmp_path):
+    truncated = tmp_path / "truncated"
+    truncated.write_bytes(card_png.read_bytes()[:-12])
+    with open(truncated, "rb") as f, pytest.raises(ValueError):
+        read_chunk_layout(f)
+
+def test_invalid_keyword():
+    with pytest.raises(ValueError):
+        build_text_chunk("", "x")
+    with pytest.raises(ValueError):
+        build_text_chunk("k" * 80, "x")
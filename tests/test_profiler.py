@@ -0,0 +1,37 @@
+import json
+import sys
+
+from profiler import RunProfiler
+
+def test_laps_exclude_phases():
+    p = RunProfiler()
+    with p.phase("query"):
+        pass
+    p.lap("render")
+    p.finish()
+    assert [row["phase"] for row in p.phase_rows()] == ["query", "render"]
+    assert sum(seconds for seconds, _ in p.phases.values()) <= p.total
+
+def test_capture_report():
+    p = RunProfiler()
+    p.start_capture("cProfile")
+    sum(range(1000))
+    p.finish()
+    assert sys.getprofile() is None
+    assert "function calls" in p.capture_report
+    assert json.loads(p.to_json())["capture_mode"] == "cProfile"
+
+def test_stop_capture_of_unfinished_run():
+    # A rerun cut short by st.rerun() never reaches finish()
+    interrupted = RunProfiler()
+    interrupted.start_capture("cProfile")
+    assert sys.getprofile() is not None
+
+    interrupted.stop_capture()
+    assert sys.getprofile() is None
+    assert interrupted.capture_report is None
+    interrupted.stop_capture()
+
+    p = RunProfiler()
+    p.finish()
+    assert p.capture_report is None
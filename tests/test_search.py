@@ -0,0 +1,107 @@
+import re
+
+import pytest
+
+import search
+from search import (CARD_SEARCH_VIEW, FTS_COLUMN, SORT_OPTIONS, SOURCES, TAGS_COLUMN, TAGS_TEXT_FUNCTION,
+                    RELEVANCE_SORT, SearchPlan)
+
+# Every migrate.py object, "table.column" for the per-source columns
+ALL_FEATURES = frozenset({"pg_trgm", TAGS_TEXT_FUNCTION, CARD_SEARCH_VIEW} |
+                         {f"{table}.{column}" for table, _, _ in SOURCES.values() for column in (FTS_COLUMN, TAGS_COLUMN)})
+
+@pytest.fixture(params=["tables", "view"])
+def features(request, monkeypatch):
+    """Builds the plans without a database, once per source tables and once via card_search."""
+    found = frozenset() if request.param == "tables" else ALL_FEATURES
+    monkeypatch.setattr(search, "db_features", lambda: found)
+    monkeypatch.setattr(search, "USE_CARD_SEARCH", True)
+    return request.param
+
+def placeholders(sql):
+    return len(re.findall(r"%s", sql.replace("%%", "")))
+
+def plan(sort_option=search.DEFAULT_SORT, mode="ilike", fields=("name", "tags"), query="elf"):
+    return SearchPlan(list(SOURCES), list(fields), query, (0, 8000), False, sort_option, mode)
+
+@pytest.mark.parametrize("mode", ["ilike", "fts"])
+@pytest.mark.parametrize("sort_option", list(SORT_OPTIONS))
+def test_param_counts(features, mode, sort_option):
+    p = plan(sort_option, mode)
+    assert p.via_view == (features == "view")
+    queries = [
+        p.page_query(20),
+        p.page_query(20, offset=40),
+        p.page_query(20, after=("x", "chub", "00" * 16)),
+        p.page_query(20, after=(None, "chub", "00" * 16)),
+        p.count_query(),
+        p.count_query(cap=10000),
+        p.export_query(),
+    ]
+    for sql, params in queries:
+        assert sql is not None
+        assert placeholders(sql) == len(params), sql
+
+def test_no_sources(features):
+    p = SearchPlan([], ["name"], "elf", (0, 8000), False)
+    assert p.page_query(20) == (None, [])
+    assert p.count_query() == (None, [])
+    assert p.export_query() == (None, [])
+
+def test_name_sort_puts_missing_names_last(features):
+    p = plan("Name (A-Z)")
+    sql, _ = p.page_query(20)
+    assert "name IS NULL AS sort_null" in sql
+    assert "ORDER BY sort_null, sort_key ASC, src ASC, image_hash ASC LIMIT 20" in sql
+    if p.via_view:
+        assert sql.endswith("ORDER BY page.sort_null, page.sort_key ASC, page.src ASC, page.image_hash ASC")
+    assert "CASE WHEN sort_null THEN NULL ELSE sort_key::text END AS sort_cursor" in sql
+
+    export_sql, _ = p.export_query()
+    assert export_sql.endswith("ORDER BY sort_null, sort_key ASC, src ASC, image_hash ASC")
+
+def test_name_keyset_cursor(features):
+    p = plan("Name (A-Z)")
+    branches = len(p.branches)
+
+    sql, params = p.page_query(20, after=("Alice", "chub", "ab" * 16))
+    assert "(name IS NULL, COALESCE(name, ''), src, image_hash) > (%s::boolean, %s::text, %s, %s)" in sql
+    assert params.count(False) == branches and params.count("Alice") == branches
+
+    # The cursor of a card without a name only continues among those cards
+    sql, params = p.page_query(20, after=(None, "chub", "ab" * 16))
+    assert params.count(True) == branches and params.count("") >= branches
+    assert None not in params
+
+def test_other_sorts_have_no_null_flag(features):
+    for option, (key_expr, direction, _) in SORT_OPTIONS.items():
+        if option in search.SORT_NULLS_LAST:
+            continue
+        sql, params = plan(option, "fts").page_query(20, after=("1", "chub", "ab" * 16))
+        assert "sort_null" not in sql
+        assert f"ORDER BY sort_key {direction}, src {direction}, image_hash {direction}" in sql
+
+def test_relevance_needs_fulltext(features):
+    assert plan(RELEVANCE_SORT, "ilike").key_expr == SORT_OPTIONS[search.DEFAULT_SORT][0]
+    assert plan(RELEVANCE_SORT, "ilike").null_expr == "name IS NULL"
+    assert plan(RELEVANCE_SORT, "fts").key_expr == "rank"
+    assert plan(RELEVANCE_SORT, "fts").null_expr is None
+    assert plan("no such sort").key_expr == SORT_OPTIONS[search.DEFAULT_SORT][0]
+
+def test_count_cap(features):
+    sql, _ = plan().count_query(cap=100)
+    assert sql.startswith("SELECT COUNT(*) FROM (SELECT 1 FROM (")
+    assert sql.endswith("LIMIT 101) AS matches")
+
+def test_export_keeps_one_row_per_card(features):
+    p = plan("Neueste zuerst")
+    sql, _ = p.export_query()
+    assert f"row_number() OVER (PARTITION BY image_hash {p.order_by()}) AS occurrence" in sql
+    assert sql.endswith(f"WHERE occurrence = 1 {p.order_by()}")
+
+def test_display_tags_fall_back_like_the_app():
+    tags = search.display_columns("m", "d").split(" AS description, ")[1].split(" AS tags")[0]
+    assert tags == ("COALESCE("
+                    "NULLIF(NULLIF(NULLIF(m->'tags', 'null'::jsonb), '[]'::jsonb), '\"\"'::jsonb), "
+                    "NULLIF(NULLIF(NULLIF(d->'data'->'tags', 'null'::jsonb), '[]'::jsonb), '\"\"'::jsonb), "
+                    "d->'tags')")
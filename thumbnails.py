@@ -0,0 +1,139 @@
+"""Resized thumbnails for the result grid.
+
+The grid shows cards roughly 300px wide, the full cards are often several
+MB. Thumbnails depend only on the image (files are content-addressed by
+hash), the width and the format, so they are cached on disk for good and
+can be generated ahead of time from the manifest.
+
+Usage:
+    python thumbnails.py                      # all images in the manifest, all THUMB_SIZES
+    python thumbnails.py --sizes 320 --workers 8
+"""
+import argparse
+import hashlib
+import io
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageOps, features
+
+from cache import RenderCache
+from manifest import get_manifest
+
+try:
+    import config
+except ImportError:
+    config = None
+
+# Widths the server renders; other sizes are rejected so clients cannot fill the cache
+THUMB_SIZES = tuple(getattr(config, "THUMB_SIZES", (160, 320, 640)))
+THUMB_QUALITY = getattr(config, "THUMB_QUALITY", 80)
+# On-disk cache of thumbnails; set THUMB_CACHE_DIR = None to disable
+THUMB_CACHE_DIR = getattr(config, "THUMB_CACHE_DIR", os.path.join(tempfile.gettempdir(), "charasearch-thumbs"))
+THUMB_CACHE_MAX_BYTES = getattr(config, "THUMB_CACHE_MAX_BYTES", 1024**3)
+
+# Bump when the rendered thumbnails change
+THUMB_VERSION = 1
+
+# URL extension -> (Pillow format, content type)
+THUMB_FORMATS = {
+    "webp": ("WEBP", "image/webp"),
+    "jpg": ("JPEG", "image/jpeg"),
+}
+# WebP if this Pillow build can write it
+DEFAULT_THUMB_FORMAT = "webp" if features.check("webp") else "jpg"
+
+thumb_cache = RenderCache(THUMB_CACHE_DIR, THUMB_CACHE_MAX_BYTES, suffix=".thumb") if THUMB_CACHE_DIR else None
+
+def thumb_key(image_hash, width, fmt):
+    """Cache key / ETag of a thumbnail."""
+    raw = f"{THUMB_VERSION}:{image_hash}:{width}:{fmt}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:40]
+
+def render_thumbnail(full_path, width, fmt):
+    """Scales the image down to `width` (never up) and encodes it, returns the bytes."""
+    pil_format, _ = THUMB_FORMATS[fmt]
+    with Image.open(full_path) as img:
+        # JPEG sources can be decoded at a reduced scale right away
+        img.draft("RGB", (width, width * 4))
+        img = ImageOps.exif_transpose(img)
+        # Palette images cannot be resampled smoothly, and JPEG has no alpha
+        if pil_format == "JPEG" or img.mode not in ("RGB", "RGBA"):
+            has_alpha = img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info)
+            img = img.convert("RGBA" if has_alpha and pil_format != "JPEG" else "RGB")
+        if img.width > width:
+            img = img.resize((width, max(1, round(img.height * width / img.width))), Image.LANCZOS)
+
+        options = {"quality": THUMB_QUALITY}
+        if pil_format == "WEBP":
+            options["method"] = 4
+        output = io.BytesIO()
+        img.save(output, format=pil_format, **options)
+    return output.getvalue()
+
+def cached_thumbnail(image_hash, full_path, width, fmt):
+    """Bytes of the thumbnail from thumb_cache, rendered and stored on a miss. Needs thumb_cache."""
+    key = thumb_key(image_hash, width, fmt)
+    f = thumb_cache.open(key)
+    if f is not None:
+        with f:
+            return f.read()
+    body = render_thumbnail(full_path, width, fmt)
+    thumb_cache.put(key, [body])
+    return body
+
+def pregenerate(entries, sizes=THUMB_SIZES, fmt=DEFAULT_THUMB_FORMAT, workers=4):
+    """Renders all missing thumbnails for the given manifest entries -> counters."""
+    counters = {"rendered": 0, "cached": 0, "failed": 0}
+
+    def one(entry, width):
+        key = thumb_key(entry.hash, width, fmt)
+        if thumb_cache.get(key):
+            return "cached"
+        try:
+            thumb_cache.put(key, [render_thumbnail(entry.path, width, fmt)])
+        except Exception as e:
+            print(f"{entry.hash}: {e}")
+            return "failed"
+        return "rendered"
+
+    # Pillow releases the GIL while resizing and encoding, threads are enough
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        jobs = (pool.submit(one, entry, width) for entry in entries for width in sizes)
+        # Bounded window, the manifest can hold millions of entries
+        pending = []
+        for job in jobs:
+            pending.append(job)
+            if len(pending) >= workers * 16:
+                for done in pending:
+                    counters[done.result()] += 1
+                pending = []
+        for done in pending:
+            counters[done.result()] += 1
+    return counters
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-generate grid thumbnails for all images in the manifest.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(THUMB_SIZES), help="Widths (default: THUMB_SIZES)")
+    parser.add_argument("--format", choices=sorted(THUMB_FORMATS), default=DEFAULT_THUMB_FORMAT)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    if thumb_cache is None:
+        parser.error("THUMB_CACHE_DIR is disabled in config.py")
+    unknown = [s for s in args.sizes if s not in THUMB_SIZES]
+    if unknown:
+        parser.error(f"Sizes not served by the image server (THUMB_SIZES): {unknown}")
+    m = get_manifest()
+    if m is None:
+        parser.error("No manifest found, run manifest.py first")
+
+    start = time.time()
+    counters = pregenerate(m.entries(), args.sizes, args.format, args.workers)
+    print(f"Thumbnails: {counters['rendered']} rendered, {counters['cached']} already cached, "
+          f"{counters['failed']} failed, {time.time() - start:.1f}s")
+
+if __name__ == "__main__":
+    main()